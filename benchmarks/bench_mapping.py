@@ -0,0 +1,60 @@
+"""Per-row vs batch mapping hooks on PostgresRepository.
+
+Maps rows out as the streaming reads do, with a subclass that converts types
+row by row in `_map_item_out`, and one that does the same per chunk in
+`map_batch_out`. Needs no database.
+
+Usage:
+  python -m benchmarks.bench_mapping
+"""
+from datetime import datetime, timedelta
+import timeit
+from typing import Dict, List, MutableMapping
+
+from dbi_repositories.postgres import PostgresRepository
+
+
+class PerRowRepository(PostgresRepository):
+
+    def _map_item_out(self, item: Dict) -> MutableMapping:
+        item['collected_at'] = item['collected_at'].isoformat()
+        item['num_likes'] = int(item['num_likes'])
+        return item
+
+
+class BatchRepository(PostgresRepository):
+
+    def map_batch_out(self, rows: List[Dict]) -> List[MutableMapping]:
+        # NOTE: one loop over the chunk, with no call per row.
+        for row in rows:
+            row['collected_at'] = row['collected_at'].isoformat()
+            row['num_likes'] = int(row['num_likes'])
+        return rows
+
+
+def get_rows(n: int) -> List[Dict]:
+    start = datetime(2022, 1, 1)
+    return [{'tweet_id': i,
+             'collected_at': start + timedelta(seconds=i),
+             'num_likes': i % 100}
+            for i in range(n)]
+
+
+def map_out(repo: PostgresRepository, rows: List[Dict]) -> None:
+    for chunk_start in range(0, len(rows), repo.chunk_size):
+        chunk = rows[chunk_start:chunk_start + repo.chunk_size]
+        _ = repo.map_batch_out([dict(x) for x in chunk])
+
+
+if __name__ == '__main__':
+    num_rows = 200_000
+    rows = get_rows(num_rows)
+    for repo_class in [PerRowRepository, BatchRepository]:
+        repo = repo_class(
+            connection_factory=None,
+            table_name='tweet_stats',
+            primary_keys=['tweet_id', 'collected_at'])
+        took = min(timeit.repeat(lambda: map_out(repo, rows),
+                                 number=1, repeat=5))
+        print(f'{repo_class.__name__}: {took * 1000:.1f}ms for {num_rows} '
+              f'rows ({num_rows / took:,.0f} rows/s)')
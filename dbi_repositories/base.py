@@ -1,9 +1,26 @@
-from typing import List, Optional
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+
+AGGREGATE_FUNCTIONS = ('avg', 'count', 'max', 'min', 'sum')
+INDEX_CHECK_MODES = ('warn', 'raise')
+
+
+class DeadlineExceeded(TimeoutError):
+    """A database call took longer than its timeout."""
+
+
+class UnindexedQueryError(Exception):
+    """A filter would not be served by any declared index."""
 
 
 class Repository:
     """Abstract base Repository class."""
 
+    # NOTE: one of `INDEX_CHECK_MODES`, or None to skip the check; set by the
+    # implementing constructors.
+    index_check = None
+
     def __init__(self, **kwargs):
         self._kwargs = kwargs
 
@@ -15,6 +32,71 @@ class Repository:
     def __exit__(self, exc_type, exc_value, traceback):
         self.dispose()
 
+    def _check_index(self, fields: Iterable[str]) -> None:
+        """Warn or raise if a filter on `fields` would not use an index.
+
+        A filter is considered served if it includes the leading field of at
+        least one index, as given by `_indexed_leading_fields`.
+        """
+        fields = list(fields)
+        if not self.index_check or not fields:
+            return
+        leading_fields = self._indexed_leading_fields()
+        if any(field in leading_fields for field in fields):
+            return
+        message = f'Filter on {sorted(fields)} is not served by an index ' \
+                  f'on {self._index_target()}.'
+        if self.index_check == 'raise':
+            raise UnindexedQueryError(message)
+        logging.warning(message)
+
+    @staticmethod
+    def _get_metrics(metrics: Dict[str, str]) -> List[Tuple[str, str, str]]:
+        """Validate `aggregate` metrics, and name their results.
+
+        A metric on `*` (only `count`) is named after the function, and any
+        other after the field and function, e.g. `num_likes_sum`.
+
+        Returns:
+          List of tuples of (name, field, function).
+        """
+        results = []
+        for field, function in metrics.items():
+            if function not in AGGREGATE_FUNCTIONS:
+                raise ValueError(f'Unexpected function: {function}. '
+                                 f'Expected one of {AGGREGATE_FUNCTIONS}.')
+            if field == '*':
+                if function != 'count':
+                    raise ValueError('Only count is defined on *.')
+                results.append((function, field, function))
+            else:
+                name = f'{field.replace(".", "_")}_{function}'
+                results.append((name, field, function))
+        return results
+
+    @staticmethod
+    def _get_sample_size(size: Union[int, float]) \
+            -> Tuple[Optional[int], Optional[float]]:
+        """Interpret a `sample` size as a number of records or a fraction.
+
+        Returns:
+          Tuple of (n, fraction), one of which is None.
+        """
+        if isinstance(size, int) and not isinstance(size, bool) and size >= 0:
+            return size, None
+        if isinstance(size, float) and 0. < size <= 1.:
+            return None, size
+        raise ValueError(f'Unexpected sample size: {size}. Expected an int n '
+                         f'or a float fraction in (0, 1].')
+
+    def _index_target(self) -> str:
+        """Name of the table/collection, for index check messages."""
+        raise NotImplementedError
+
+    def _indexed_leading_fields(self) -> List[str]:
+        """Leading fields of the primary key and all declared indexes."""
+        raise NotImplementedError
+
     def add(self, *args, **kwargs):
         """Add one item to the table/collection."""
         raise NotImplementedError
@@ -23,6 +105,24 @@ class Repository:
         """Add many items to this table/collection, where supported."""
         raise NotImplementedError
 
+    def aggregate(self,
+                  group_by: Optional[List[str]] = None,
+                  metrics: Optional[Dict[str, str]] = None,
+                  **filters):
+        """Group the records matching `filters` and compute metrics per group.
+
+        Args:
+          group_by: List, optional, of the fields to group by. If empty, there
+            is a single group.
+          metrics: Dict of field to one of `AGGREGATE_FUNCTIONS`, e.g.
+            `{'num_likes': 'sum', '*': 'count'}`. See `_get_metrics` for the
+            names of the results.
+
+        Yields:
+          Dicts of the group_by fields and the metrics, in group order.
+        """
+        raise NotImplementedError
+
     def all(self, **kwargs):
         """Get all records in the table/collection.
 
@@ -31,6 +131,14 @@ class Repository:
         """
         raise NotImplementedError
 
+    def changes_since(self, token=None, limit: Optional[int] = None):
+        """Get changes to the table/collection since `token`.
+
+        Yields:
+          Tuples of (token, change). Pass the last token back to resume.
+        """
+        raise NotImplementedError
+
     def commit(self):
         """Save changes to the database."""
         raise NotImplementedError
@@ -55,6 +163,10 @@ class Repository:
         """Dispose of this Repository."""
         raise NotImplementedError
 
+    def ensure_indexes(self):
+        """Create any declared indexes that do not yet exist."""
+        raise NotImplementedError
+
     def exists(self, *args, **kwargs) -> bool:
         """Check if an item exists in the table/collection."""
         raise NotImplementedError
@@ -63,6 +175,35 @@ class Repository:
         """Get an item from the table/collection."""
         raise NotImplementedError
 
+    def get_many(self,
+                 keys: List,
+                 projection: Optional[List[str]] = None,
+                 **kwargs) -> List:
+        """Get many items by key in one query.
+
+        Args:
+          keys: List of keys, as from `_get_key`.
+          projection: List, optional, of attributes to project. The key
+            attributes are always included.
+
+        Returns:
+          List of the items, in the order of `keys`, with None for any not
+            found.
+        """
+        raise NotImplementedError
+
+    def sample(self,
+               size: Union[int, float],
+               seed: Optional[int] = None,
+               **filters):
+        """Get a random sample of the records matching `filters`.
+
+        Args:
+          size: int, the number of records, or float, the fraction of records.
+          seed: int, optional, for a repeatable sample where supported.
+        """
+        raise NotImplementedError
+
     def search(self, *args, **kwargs):
         """Search for records in the table/collection."""
         raise NotImplementedError
@@ -82,3 +223,7 @@ class Repository:
     def upsert_many(self, *args, **kwargs):
         """Upsert many items."""
         raise NotImplementedError
+
+    def watch(self, token=None):
+        """Yield changes to the table/collection as they happen."""
+        raise NotImplementedError
@@ -0,0 +1,175 @@
+import asyncio
+from collections.abc import Mapping
+from concurrent.futures import Future
+import threading
+from typing import Any, Dict, List, Optional
+
+from dbi_repositories.base import Repository
+
+
+"""
+Coalescing of concurrent single-key lookups into batched queries.
+
+    loader = Dataloader(tweet_repository)
+    # NOTE: in each of many request handler threads
+    tweet = loader.get(tweet_id=tweet_id)
+
+The first `get` in a batch waits up to `window` seconds for others, or until
+`max_batch_size` distinct keys are waiting, then one `get_many` fetches them
+all, e.g. with a join on a list of the keys in Postgres or `$in` in Mongo, and
+each caller gets its own item back. The same key asked for twice in a batch is
+fetched once.
+
+Callers block, so this helps where lookups come from many threads at once. In
+asyncio code use `get_async` and `exists_async`, which wait in the loop's
+default executor; its number of workers limits how many lookups are batched.
+
+Ref:
+https://github.com/graphql/dataloader
+"""
+
+
+class _Batch:
+    """Keys waiting on one query, with a future for each."""
+
+    def __init__(self):
+        self.futures: Dict[Any, Future] = {}
+        self.full = threading.Event()
+
+
+class Dataloader:
+    """Batches concurrent `get` and `exists` calls on a repository.
+
+    Works with any Repository implementing `get_many` and `_get_key`, i.e.
+    PostgresRepository, MongoRepository and ShardedRepository.
+    """
+
+    def __init__(self,
+                 repository: Repository,
+                 window: float = 0.002,
+                 max_batch_size: int = 1000,
+                 timeout: Optional[float] = None):
+        """Create a new Dataloader.
+
+        Args:
+          repository: Repository, to get items from.
+          window: float, seconds the first lookup of a batch waits for more.
+          max_batch_size: int, number of distinct keys that sends a batch
+            without waiting for the rest of the window.
+          timeout: float, optional, seconds, passed to `get_many`.
+        """
+        if max_batch_size < 1:
+            raise ValueError(
+                f'max_batch_size must be positive, got {max_batch_size}.')
+        self.repository = repository
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        # NOTE: the open batch per kind of lookup, `get` or `exists`.
+        self._batches: Dict[str, _Batch] = {}
+        self._lock = threading.Lock()
+
+    def _get_call_key(self, *args, **kwargs) -> Any:
+        """Key of a lookup, given positionally, e.g. `get(1)`, or with all the
+        key fields as keyword arguments, e.g. `get(tweet_id=1)`.
+
+        Raises:
+          ValueError, if the lookup doesn't identify a key, or also filters on
+            other fields, e.g. `get(tweet_id=1, label='a')`, which a batch by
+            key can't answer. Use the repository for those.
+        """
+        if self._has_other_conditions(*args, **kwargs):
+            raise ValueError(f'Lookup filters on more than the key: '
+                             f'{args} {kwargs}.')
+        if args and not isinstance(args[0], Mapping):
+            return args[0]
+        conditions = args[0] if args else kwargs
+        try:
+            key = self.repository._get_key(conditions)
+        except KeyError:
+            key = None
+        if key is None:
+            raise ValueError(f'Lookup does not identify a key: {conditions}.')
+        return key
+
+    def _get_key_fields(self) -> List[str]:
+        # NOTE: shards all have the same key as the first.
+        repository = getattr(self.repository, 'shards', [self.repository])[0]
+        primary_keys = getattr(repository, 'primary_keys', None)
+        if primary_keys:
+            return primary_keys
+        return [x for x in ('_id', getattr(repository, '_id_attr', None)) if x]
+
+    def _get_projection(self) -> Optional[List[str]]:
+        # NOTE: only the key is needed for `exists`.
+        return self._get_key_fields()
+
+    def _has_other_conditions(self, *args, **kwargs) -> bool:
+        conditions = dict(kwargs)
+        if args and isinstance(args[0], Mapping):
+            conditions.update(args[0])
+        # NOTE: None values are not conditions, as in the repositories.
+        fields = [k for k, v in conditions.items() if v is not None]
+        key_fields = self._get_key_fields()
+        if args and not isinstance(args[0], Mapping):
+            # NOTE: the key was given positionally.
+            key_fields = []
+        return bool(set(fields) - set(key_fields))
+
+    def _load(self, kind: str, key: Any) -> Any:
+        """Wait for the item of `key` from the open batch of `kind`.
+
+        The caller that opens a batch waits for the window, or for the batch
+        to fill, then runs its query for all the callers.
+        """
+        with self._lock:
+            batch = self._batches.get(kind)
+            is_leader = batch is None
+            if is_leader:
+                batch = self._batches[kind] = _Batch()
+            future = batch.futures.get(key)
+            if future is None:
+                future = batch.futures[key] = Future()
+            if len(batch.futures) >= self.max_batch_size:
+                del self._batches[kind]
+                batch.full.set()
+        if is_leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._batches.get(kind) is batch:
+                    del self._batches[kind]
+            self._run(kind, batch)
+        return future.result()
+
+    def _run(self, kind: str, batch: _Batch) -> None:
+        keys = list(batch.futures)
+        projection = self._get_projection() if kind == 'exists' else None
+        try:
+            items = self.repository.get_many(
+                keys, projection=projection, timeout=self.timeout)
+        except Exception as e:
+            for future in batch.futures.values():
+                future.set_exception(e)
+            return
+        for key, item in zip(keys, items):
+            if kind == 'exists':
+                item = item is not None
+            batch.futures[key].set_result(item)
+
+    def exists(self, *args, **kwargs) -> bool:
+        """Check if the item of a key exists, batched with other lookups."""
+        return self._load('exists', self._get_call_key(*args, **kwargs))
+
+    async def exists_async(self, *args, **kwargs) -> bool:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, lambda: self.exists(*args, **kwargs))
+
+    def get(self, *args, **kwargs) -> Any:
+        """Get the item of a key, or None, batched with other lookups."""
+        return self._load('get', self._get_call_key(*args, **kwargs))
+
+    async def get_async(self, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, lambda: self.get(*args, **kwargs))
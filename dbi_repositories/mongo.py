@@ -1,21 +1,222 @@
-from collections.abc import MutableMapping
+import atexit
+from collections.abc import Mapping, MutableMapping
+from contextlib import contextmanager
 import logging
-from typing import Any, Dict, Generator, List, Optional
+import os
+import threading
+from typing import Any, Dict, Generator, Iterable, List, Optional, \
+    Tuple, Union
+import bson
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 import pydash
 import pymongo
-from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo import monitoring, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.read_preferences import _ServerMode
+from pymongo.errors import BulkWriteError, DuplicateKeyError, \
+    ExecutionTimeout, NetworkTimeout, PyMongoError
 
-from dbi_repositories import util
-from dbi_repositories.base import Repository
+from dbi_repositories import profiling, util
+from dbi_repositories.base import DeadlineExceeded, INDEX_CHECK_MODES, \
+    Repository
 
 
-def get_client(host: str, port: int, username: str, password: str) \
-        -> pymongo.MongoClient:
-    return pymongo.MongoClient(
+class ProfilingListener(monitoring.CommandListener,
+                        monitoring.ConnectionPoolListener):
+    """Reports commands and new connections to active profilers.
+
+    Attached to clients made by `get_client` with `profile=True`. See
+    `profiling.profile`.
+    """
+
+    def __init__(self):
+        # NOTE: shapes of started commands, by request id, until they finish.
+        self._started = {}
+
+    @staticmethod
+    def _get_shape(command: Mapping) -> Tuple[str, str]:
+        """The collection and the shape of a command, with values as `?`."""
+        name = next(iter(command))
+        collection = command[name] if isinstance(command[name], str) else ''
+        shape = name
+        for key in ('filter', 'q', 'query'):
+            if key in command:
+                shape += f' {get_value_shape(command[key])}'
+        if 'updates' in command and command['updates']:
+            shape += f' {get_value_shape(command["updates"][0].get("q"))}'
+        if 'deletes' in command and command['deletes']:
+            shape += f' {get_value_shape(command["deletes"][0].get("q"))}'
+        if 'pipeline' in command:
+            shape += f' {[next(iter(x)) for x in command["pipeline"]]}'
+        return collection, shape
+
+    @staticmethod
+    def _get_rows(reply: Mapping) -> Optional[int]:
+        cursor = reply.get('cursor')
+        if cursor:
+            return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+        return reply.get('n')
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if profiling.is_profiling():
+            self._started[event.request_id] = self._get_shape(event.command)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finished(event, self._get_rows(event.reply))
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finished(event, None)
+
+    def _finished(self, event: Any, rows: Optional[int]) -> None:
+        started = self._started.pop(event.request_id, None)
+        if started:
+            collection, shape = started
+            profiling.record(
+                'mongo', f'{event.database_name}.{collection}', shape,
+                event.duration_micros / 1e6, rows)
+
+    def connection_created(self, event: monitoring.ConnectionCreatedEvent) \
+            -> None:
+        host, port = event.address
+        profiling.record_connection('mongo', f'{host}:{port}')
+
+    # NOTE: the other pool events are not needed.
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+    def connection_check_out_started(self, event): pass
+    def connection_check_out_failed(self, event): pass
+    def connection_checked_out(self, event): pass
+    def connection_checked_in(self, event): pass
+
+
+def get_value_shape(value: Any) -> Any:
+    """A filter with its values replaced by `?`, keeping keys and operators."""
+    if isinstance(value, Mapping):
+        return {k: get_value_shape(v) for k, v in value.items()}
+    if isinstance(value, list) and value and isinstance(value[0], Mapping):
+        return [get_value_shape(x) for x in value]
+    return '?'
+
+
+_profiling_listener = ProfilingListener()
+
+# NOTE: process-wide registry of shared clients, keyed by connection
+# parameters. MongoClient is thread-safe and pools its own connections, so one
+# per process is what we want. It is not fork-safe, so a forked child drops the
+# inherited clients, and makes its own from the options kept for each key.
+_clients: Dict[str, pymongo.MongoClient] = {}
+_client_options: Dict[str, Dict[str, Any]] = {}
+_clients_lock = threading.Lock()
+
+
+def _reset_clients() -> None:
+    """Forget inherited clients in a forked child."""
+    global _clients_lock
+    # NOTE: inherited clients share sockets with the parent, so they are
+    # dropped rather than closed. The lock may have been held by a thread that
+    # doesn't exist in the child.
+    _clients_lock = threading.Lock()
+    _clients.clear()
+
+
+os.register_at_fork(after_in_child=_reset_clients)
+
+
+def get_client(host: str,
+               port: int,
+               username: str,
+               password: str,
+               max_pool_size: int = 100,
+               shared: bool = True,
+               socket_timeout: Optional[float] = None,
+               profile: bool = False,
+               **kwargs) -> pymongo.MongoClient:
+    """Get a MongoClient.
+
+    Args:
+      host: str.
+      port: int.
+      username: str.
+      password: str.
+      max_pool_size: int, the maximum number of connections in the pool.
+      socket_timeout: float, optional, seconds to wait on a socket read or
+        write before raising. This bounds calls that don't take a `timeout`,
+        like writes.
+      shared: bool, if True (the default) return the client shared by this
+        process for these parameters, creating it if necessary. If False,
+        always create a new client, which the caller is responsible for
+        closing.
+      profile: bool, if True, report the client's commands and connections to
+        any active `profiling.profile`. Off by default, as pymongo then builds
+        an event for every command and connection checkout.
+      kwargs: other options passed to the MongoClient constructor.
+    """
+    if socket_timeout:
+        kwargs['socketTimeoutMS'] = int(socket_timeout * 1000)
+    if profile:
+        kwargs['event_listeners'] = \
+            list(kwargs.get('event_listeners', [])) + [_profiling_listener]
+    options = dict(
         host=host,
         port=port,
         username=username,
-        password=password)
+        password=password,
+        maxPoolSize=max_pool_size,
+        **kwargs)
+    if not shared:
+        return pymongo.MongoClient(**options)
+    # NOTE: repr, as option values may be unhashable, e.g. a dict of
+    # `authMechanismProperties`.
+    key = repr(sorted(options.items()))
+    with _clients_lock:
+        _client_options.setdefault(key, options)
+    return get_shared_client(key)
+
+
+def get_shared_client(key: str) -> pymongo.MongoClient:
+    """Get the shared client for a registry key, creating it if necessary.
+
+    Args:
+      key: str, the registry key of a client from `get_client`.
+    """
+    with _clients_lock:
+        if key not in _clients:
+            client = pymongo.MongoClient(**_client_options[key])
+            # NOTE: so repositories can find this process's client after fork.
+            client._dbi_registry_key = key
+            _clients[key] = client
+        return _clients[key]
+
+
+@atexit.register
+def close_clients() -> None:
+    """Close all shared clients created by this process."""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+CONFLICT_MODES = ('error', 'ignore', 'upsert')
+# NOTE: the server's default maxMessageSizeBytes, less room for the command.
+MAX_MESSAGE_BYTES = 48000000 - 2 ** 16
+DUMP_FORMATS = ('jsonl',)
+# NOTE: canonical extended JSON keeps BSON types, e.g. int64 and double, so
+# `load` restores exactly what `dump` wrote.
+JSON_OPTIONS = json_util.CANONICAL_JSON_OPTIONS
+
+# NOTE: keyword arguments to `all` and `search` that control how the cursor is
+# read, rather than being part of the filter.
+READ_OPTIONS = ('projection', 'raw', 'batch_size', 'no_cursor_timeout',
+                'sort', 'hint', 'timeout', 'read_preference')
+RAW_MODES = ('document', 'bytes')
+
+IndexSpec = Union[str, List[Tuple[str, int]]]
 
 
 class MongoRepository(Repository):
@@ -28,29 +229,259 @@ class MongoRepository(Repository):
                  db_name: str,
                  collection_name: str,
                  _id_attr: Optional[str] = None,
-                 chunk_size: int = 1000):
+                 chunk_size: int = 1000,
+                 batch_size: Optional[int] = None,
+                 no_cursor_timeout: bool = False,
+                 indexes: Optional[List[IndexSpec]] = None,
+                 index_check: Optional[str] = None,
+                 timeout: Optional[float] = None,
+                 adaptive_chunking: bool = False):
         super().__init__()
+        if index_check is not None and index_check not in INDEX_CHECK_MODES:
+            raise ValueError(f'Unexpected index_check: {index_check}. '
+                             f'Expected one of {INDEX_CHECK_MODES}.')
 
         self.db_name = db_name
         self.collection_name = collection_name
         self._id_attr = _id_attr
         self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.no_cursor_timeout = no_cursor_timeout
+        # NOTE: each index is a key name, or a list of (key, direction) pairs,
+        # as taken by `create_index`.
+        self.indexes = indexes or []
+        self.index_check = index_check
+        # NOTE: default for reads, applied as maxTimeMS, and for writes,
+        # applied with `pymongo.timeout`.
+        self.timeout = timeout
+        # NOTE: if set, bulk writes are chunked by encoded size and latency,
+        # starting from `chunk_size` documents. See `util.AdaptiveChunker`.
+        self.chunker = None
+        if adaptive_chunking:
+            self.chunker = util.AdaptiveChunker(
+                size_of=self._get_encoded_size,
+                max_bytes=MAX_MESSAGE_BYTES,
+                initial_items=chunk_size)
+
+        self._client = client
+        # NOTE: a shared client is replaced by the forked child's own on first
+        # use there. An unshared one can't be, and pymongo warns if it's used.
+        self._client_key = getattr(client, '_dbi_registry_key', None)
+        self._pid = os.getpid()
+        self._db = client[db_name]
+        self._collection = self._get_collection(collection_name)
+
+    @property
+    def client(self) -> pymongo.MongoClient:
+        self._check_fork()
+        return self._client
 
-        self.client = client
-        self.db = self.client[db_name]
-        self.collection = self._get_collection(collection_name)
+    @property
+    def collection(self):
+        self._check_fork()
+        return self._collection
+
+    @property
+    def db(self):
+        self._check_fork()
+        return self._db
+
+    def _check_fork(self) -> None:
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        if self._client_key is not None:
+            self._client = get_shared_client(self._client_key)
+            self._db = self._client[self.db_name]
+            self._collection = self._get_collection(self.collection_name)
 
     def _get_collection(self, collection_name: str):
-        return self.db[collection_name]
+        return self._db[collection_name]
+
+    @contextmanager
+    def _deadline(self, timeout: Optional[float] = None):
+        try:
+            yield
+        except (ExecutionTimeout, NetworkTimeout) as e:
+            raise DeadlineExceeded(
+                f'Operation on {self._index_target()} took longer than '
+                f'{timeout or self.timeout}s.') from e
+        except PyMongoError as e:
+            # NOTE: e.g. a bulk write or server selection that ran out of the
+            # time given by `pymongo.timeout`. Without one, it's the client's
+            # own timeouts, and left as is.
+            if not e.timeout or (timeout or self.timeout) is None:
+                raise
+            raise DeadlineExceeded(
+                f'Operation on {self._index_target()} took longer than '
+                f'{timeout or self.timeout}s.') from e
+
+    @contextmanager
+    def _write_deadline(self, timeout: Optional[float] = None):
+        """Bound the writes in the block by `timeout`, or the default.
+
+        Writes don't take `maxTimeMS`, so this uses pymongo's client side
+        timeout, which covers server selection, the write and its write
+        concern.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        with self._deadline(timeout), pymongo.timeout(timeout):
+            yield
+
+    def _get_read_collection(self,
+                             raw: Optional[str] = None,
+                             read_preference: Optional[_ServerMode] = None):
+        collection = self.collection
+        if raw:
+            collection = collection.with_options(
+                codec_options=CodecOptions(document_class=RawBSONDocument))
+        if read_preference:
+            collection = collection.with_options(
+                read_preference=read_preference)
+        return collection
+
+    def _get_max_time_ms(self, timeout: Optional[float] = None) \
+            -> Optional[int]:
+        if timeout is None:
+            timeout = self.timeout
+        if timeout:
+            return int(timeout * 1000)
+        return None
+
+    def _find(self,
+              filter: Dict,
+              projection: Optional[List[str]] = None,
+              raw: Optional[str] = None,
+              batch_size: Optional[int] = None,
+              no_cursor_timeout: Optional[bool] = None,
+              sort: Optional[List[Tuple[str, int]]] = None,
+              hint: Optional[Union[str, List[Tuple[str, int]]]] = None,
+              timeout: Optional[float] = None,
+              read_preference: Optional[_ServerMode] = None) \
+            -> Generator:
+        """Iterate a find cursor with the given read options.
+
+        Args:
+          filter: Dict, the query filter.
+          projection: List, optional, of attributes to project.
+          raw: str, optional. If `document`, yield `RawBSONDocument`s, which are
+            only decoded on access. If `bytes`, yield the raw BSON bytes.
+          batch_size: int, optional, overrides the repository default.
+          no_cursor_timeout: bool, optional, overrides the repository default.
+          sort: List, optional, of (key, direction) pairs.
+          hint: optional index name or (key, direction) pairs.
+          timeout: float, optional, seconds, overrides the repository default.
+          read_preference: optional, e.g. `ReadPreference.SECONDARY_PREFERRED`,
+            overrides the client's for this read.
+        """
+        if raw is not None and raw not in RAW_MODES:
+            raise ValueError(f'Unexpected raw mode: {raw}. '
+                             f'Expected one of {RAW_MODES}.')
+        if batch_size is None:
+            batch_size = self.batch_size
+        if no_cursor_timeout is None:
+            no_cursor_timeout = self.no_cursor_timeout
+        collection = self._get_read_collection(raw, read_preference)
+        cursor = collection.find(
+            filter,
+            projection=projection,
+            no_cursor_timeout=no_cursor_timeout)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        if hint:
+            cursor = cursor.hint(hint)
+        max_time_ms = self._get_max_time_ms(timeout)
+        if max_time_ms:
+            cursor = cursor.max_time_ms(max_time_ms)
+        # NOTE: the context manager makes sure the server side cursor is
+        # closed, which matters when `no_cursor_timeout` is set.
+        with cursor, self._deadline(timeout):
+            for x in cursor:
+                if raw == 'bytes':
+                    yield x.raw
+                else:
+                    yield x
+
+    def _aggregate(self,
+                   pipeline: List[Dict],
+                   raw: Optional[str] = None,
+                   batch_size: Optional[int] = None,
+                   timeout: Optional[float] = None,
+                   read_preference: Optional[_ServerMode] = None,
+                   allow_disk_use: bool = False) -> Generator:
+        """Iterate the results of an aggregation pipeline. See `_find`."""
+        if raw is not None and raw not in RAW_MODES:
+            raise ValueError(f'Unexpected raw mode: {raw}. '
+                             f'Expected one of {RAW_MODES}.')
+        kwargs = {}
+        if allow_disk_use:
+            kwargs['allowDiskUse'] = True
+        batch_size = batch_size or self.batch_size
+        if batch_size:
+            kwargs['batchSize'] = batch_size
+        max_time_ms = self._get_max_time_ms(timeout)
+        if max_time_ms:
+            kwargs['maxTimeMS'] = max_time_ms
+        collection = self._get_read_collection(raw, read_preference)
+        with self._deadline(timeout):
+            with collection.aggregate(pipeline, **kwargs) as cursor:
+                for x in cursor:
+                    if raw == 'bytes':
+                        yield x.raw
+                    else:
+                        yield x
+
+    @staticmethod
+    def _get_encoded_size(item: Mapping) -> int:
+        if isinstance(item, RawBSONDocument):
+            return len(item.raw)
+        return len(bson.encode(item))
+
+    def _get_key(self, item: Mapping) -> Any:
+        """The `_id` of an item, inferred from `_id_attr` if not yet set."""
+        if '_id' in item:
+            return item['_id']
+        if self._id_attr:
+            return pydash.get(item, self._id_attr)
+        raise ValueError('Unable to infer _id. Specify in constructor.')
+
+    def _iter_chunks(self, items: Iterable) -> Generator[List, None, None]:
+        """Chunks of items for bulk writes, adaptive if `chunker` is set."""
+        if self.chunker:
+            return self.chunker.chunks(items)
+        return util.iter_chunks(items, self.chunk_size)
+
+    def _index_target(self) -> str:
+        return f'{self.db_name}.{self.collection_name}'
+
+    def _indexed_leading_fields(self) -> List[str]:
+        fields = ['_id']
+        for index in self.indexes:
+            if isinstance(index, str):
+                fields.append(index)
+            else:
+                fields.append(index[0][0])
+        return fields
+
+    @staticmethod
+    def _split_read_options(kwargs: Dict) -> Tuple[Dict, Dict]:
+        filter = {k: v for k, v in kwargs.items() if k not in READ_OPTIONS}
+        options = {k: v for k, v in kwargs.items() if k in READ_OPTIONS}
+        return filter, options
 
     def add(self,
             item: MutableMapping,
             error_duplicates: bool = False,
+            timeout: Optional[float] = None,
             **kwargs) -> None:
         if self._id_attr:
             item['_id'] = pydash.get(item, self._id_attr)
         try:
-            self.collection.insert_one(item)
+            with self._write_deadline(timeout):
+                self.collection.insert_one(item)
         except DuplicateKeyError as e:
             if error_duplicates:
                 raise e
@@ -59,12 +490,13 @@ class MongoRepository(Repository):
             self,
             items: List[MutableMapping],
             error_duplicates: bool = False,
+            timeout: Optional[float] = None,
             **kwargs
     ) -> None:
         if error_duplicates:
             raise ValueError('No longer supported for bulk writes due to chunking. '
                              'Consider requesting this feature if you really want it.')
-        for chunk in util.get_chunks(items, self.chunk_size):
+        for chunk in self._iter_chunks(items):
             if self._id_attr:
                 for item in chunk:
                     item['_id'] = pydash.get(item, self._id_attr)
@@ -74,14 +506,112 @@ class MongoRepository(Repository):
                 # in parallel, so the only ones that fail are the ones that are
                 # supposed to, so the way this function works is to insert all
                 # legitimate items.
-                self.collection.insert_many(chunk, ordered=False)
+                with self._write_deadline(timeout):
+                    self.collection.insert_many(chunk, ordered=False)
             except BulkWriteError:
                 pass
 
+    def aggregate(self,
+                  group_by: Optional[List[str]] = None,
+                  metrics: Optional[Dict[str, str]] = None,
+                  **kwargs) -> Generator:
+        """Group the documents matching `kwargs` and compute metrics per group.
+
+        Compiles to a `$match`, `$group` and `$sort` pipeline, which may spill
+        to disk. The `timeout`, `batch_size` and `read_preference` read
+        options are separated out from the filter.
+
+        Args:
+          group_by: List, optional, of the fields to group by; dotted paths are
+            allowed.
+          metrics: Dict of field to function, e.g.
+            `{'num_likes': 'sum', '*': 'count'}`.
+
+        Yields:
+          Dicts of the group_by fields and the metrics, in group order.
+        """
+        filter, options = self._split_read_options(kwargs)
+        self._check_index(filter.keys())
+        group_by = group_by or []
+        # NOTE: field names in `$group` can't contain dots.
+        aliases = {x: x.replace('.', '_') for x in group_by}
+        group = {'_id': {aliases[x]: f'${x}' for x in group_by} or None}
+        for name, field, function in self._get_metrics(metrics or {}):
+            if field == '*':
+                group[name] = {'$sum': 1}
+            elif function == 'count':
+                # NOTE: like COUNT(field), which skips nulls.
+                group[name] = {'$sum': {
+                    '$cond': [{'$gt': [f'${field}', None]}, 1, 0]}}
+            else:
+                group[name] = {f'${function}': f'${field}'}
+        pipeline = [{'$group': group}, {'$sort': {'_id': 1}}]
+        if filter:
+            pipeline.insert(0, {'$match': filter})
+        results = self._aggregate(
+            pipeline,
+            batch_size=options.get('batch_size'),
+            timeout=options.get('timeout'),
+            read_preference=options.get('read_preference'),
+            allow_disk_use=True)
+
+        def to_items():
+            for result in results:
+                keys = result.pop('_id') or {}
+                item = {x: keys.get(aliases[x]) for x in group_by}
+                item.update(result)
+                yield item
+
+        return to_items()
+
     def all(self, **kwargs) -> Generator:
-        cursor = self.collection.find({})
-        for x in cursor:
-            yield x
+        """Get all documents in the collection.
+
+        Takes the same read options as `_find`, e.g. `projection`, `raw`,
+        `batch_size`, `no_cursor_timeout`, `sort`, and `hint`.
+        """
+        _, options = self._split_read_options(kwargs)
+        return self._find({}, **options)
+
+    def changes_since(self,
+                      token: Optional[Mapping] = None,
+                      limit: Optional[int] = None,
+                      **kwargs) -> Generator:
+        """Get the changes available now on a change stream from `token`.
+
+        Change streams need a replica set or sharded cluster. Unlike `watch`,
+        this returns once there are no more changes waiting.
+
+        Args:
+          token: Mapping, optional, a resume token from a previous change. If
+            None, only changes from now on are seen.
+          limit: int, optional, maximum number of changes.
+
+        Yields:
+          Tuples of (token, change event). Once caught up, a last tuple of
+            (token, None), with the stream's resume token. Pass it back to
+            resume from here, even if there were no changes, so a poller
+            starting from None doesn't miss changes between calls.
+        """
+        with self.collection.watch(
+                resume_after=token,
+                full_document='updateLookup',
+                **kwargs) as stream:
+            num_changes = 0
+            while stream.alive and (not limit or num_changes < limit):
+                change = stream.try_next()
+                if change is None:
+                    # NOTE: the post-batch resume token, which is set even
+                    #  when the batch was empty.
+                    yield stream.resume_token, None
+                    break
+                num_changes += 1
+                yield change['_id'], change
+
+    @property
+    def chunk_stats(self) -> Optional[Dict]:
+        """Stats of the adaptive chunk sizes, if `adaptive_chunking` is on."""
+        return self.chunker.stats if self.chunker else None
 
     def commit(self):
         # not relevant
@@ -93,52 +623,324 @@ class MongoRepository(Repository):
         # done in the constructor, and no need to use __enter__
         pass
 
-    def count(self) -> int:
-        return self.collection.estimated_document_count()
+    def count(self,
+              timeout: Optional[float] = None,
+              read_preference: Optional[_ServerMode] = None) -> int:
+        kwargs = {}
+        max_time_ms = self._get_max_time_ms(timeout)
+        if max_time_ms:
+            kwargs['maxTimeMS'] = max_time_ms
+        collection = self._get_read_collection(read_preference=read_preference)
+        with self._deadline(timeout):
+            return collection.estimated_document_count(**kwargs)
 
-    def delete(self, key: Any, **kwargs):
-        self.collection.delete_one({'_id': key})
+    def delete(self, key: Any, timeout: Optional[float] = None, **kwargs):
+        with self._write_deadline(timeout):
+            self.collection.delete_one({'_id': key})
 
     def dispose(self):
         # no need to dispose here
         pass
 
+    def dump(self,
+             path: str,
+             format: str = 'jsonl',
+             compress: Optional[str] = None,
+             batch_size: Optional[int] = None,
+             timeout: Optional[float] = None) -> int:
+        """Write the whole collection to a file of extended JSON lines.
+
+        Documents are read as raw BSON, and written a batch at a time, so
+        memory use is constant.
+
+        Args:
+          path: str, the file to write.
+          format: str, one of `DUMP_FORMATS`.
+          compress: str, optional, one of `util.COMPRESSIONS`. If None, it is
+            inferred from the extension of `path`, e.g. `.gz`.
+          batch_size: int, optional, documents per batch; defaults to
+            `chunk_size`.
+          timeout: float, optional, seconds.
+
+        Returns:
+          Int, the number of documents written.
+        """
+        if format not in DUMP_FORMATS:
+            raise ValueError(f'Unexpected format: {format}. '
+                             f'Expected one of {DUMP_FORMATS}.')
+        batch_size = batch_size or self.chunk_size
+        documents = self._find(
+            {}, raw='document', batch_size=batch_size, timeout=timeout)
+        num_documents = 0
+        with util.open_file(path, 'wb', compress) as f:
+            for batch in util.iter_chunks(documents, batch_size):
+                lines = [json_util.dumps(x, json_options=JSON_OPTIONS)
+                         for x in batch]
+                f.write(('\n'.join(lines) + '\n').encode())
+                num_documents += len(batch)
+        return num_documents
+
+    def ensure_indexes(self) -> None:
+        # NOTE: `create_index` is a no-op for indexes that already exist.
+        for index in self.indexes:
+            self.collection.create_index(index)
+
     def exists(self, *args, **kwargs) -> bool:
-        if self.collection.find_one(locals()['kwargs']):
+        timeout = kwargs.pop('timeout', None)
+        read_preference = kwargs.pop('read_preference', None)
+        self._check_index(kwargs.keys())
+        collection = self._get_read_collection(read_preference=read_preference)
+        with self._deadline(timeout):
+            item = collection.find_one(
+                locals()['kwargs'],
+                projection=['_id'],
+                max_time_ms=self._get_max_time_ms(timeout))
+        if item:
             return True
         else:
             return False
 
-    def get(self, key: Any, **kwargs):
-        item = self.collection.find_one({'_id': key})
+    def get(self,
+            key: Any,
+            timeout: Optional[float] = None,
+            read_preference: Optional[_ServerMode] = None,
+            **kwargs):
+        collection = self._get_read_collection(read_preference=read_preference)
+        with self._deadline(timeout):
+            item = collection.find_one(
+                {'_id': key},
+                max_time_ms=self._get_max_time_ms(timeout))
         return item
 
-    def update(self, item: MutableMapping, **kwargs):
-        self.collection.replace_one(
-            filter={'_id': item['_id']},
-            replacement=item,
-            upsert=False)
+    def get_many(self,
+                 keys: List[Any],
+                 projection: Optional[List[str]] = None,
+                 timeout: Optional[float] = None,
+                 read_preference: Optional[_ServerMode] = None,
+                 **kwargs) -> List[Optional[Mapping]]:
+        """Get many documents by `_id` in one `$in` query.
+
+        Args:
+          keys: List of `_id`s.
+          projection: List, optional, of attributes to project. `_id` is
+            always included.
+          timeout: float, optional, seconds.
+          read_preference: optional, overrides the repository's.
+
+        Returns:
+          List of the documents, in the order of `keys`, with None for any not
+            found.
+        """
+        if not keys:
+            return []
+        collection = self._get_read_collection(read_preference=read_preference)
+        with self._deadline(timeout):
+            cursor = collection.find(
+                {'_id': {'$in': list(dict.fromkeys(keys))}},
+                projection=projection,
+                max_time_ms=self._get_max_time_ms(timeout))
+            items = {x['_id']: x for x in cursor}
+        return [items.get(x) for x in keys]
+
+    def load(self,
+             path: str,
+             format: str = 'jsonl',
+             compress: Optional[str] = None,
+             on_conflict: str = 'ignore',
+             timeout: Optional[float] = None) -> int:
+        """Load a file written by `dump`, a chunk at a time.
+
+        Args:
+          path: str, the file to read.
+          format: str, one of `DUMP_FORMATS`.
+          compress: str, optional, as in `dump`.
+          on_conflict: str, one of `CONFLICT_MODES`. `ignore` skips documents
+            whose `_id` exists, as `add_many` does, and `upsert` replaces
+            them. With `error`, other documents in the chunk are still
+            inserted before the error is raised.
+          timeout: float, optional, seconds per chunk. Overrides the
+            repository default.
+
+        Returns:
+          Int, the number of documents inserted or replaced.
+        """
+        if format not in DUMP_FORMATS:
+            raise ValueError(f'Unexpected format: {format}. '
+                             f'Expected one of {DUMP_FORMATS}.')
+        if on_conflict not in CONFLICT_MODES:
+            raise ValueError(f'Unexpected on_conflict: {on_conflict}. '
+                             f'Expected one of {CONFLICT_MODES}.')
+        num_documents = 0
+        with util.open_file(path, 'rb', compress) as f:
+            documents = (json_util.loads(x, json_options=JSON_OPTIONS)
+                         for x in f if x.strip())
+            for chunk in self._iter_chunks(documents):
+                if on_conflict == 'upsert':
+                    with self._write_deadline(timeout):
+                        result = self.collection.bulk_write(
+                            [ReplaceOne({'_id': x['_id']}, x, upsert=True)
+                             for x in chunk],
+                            ordered=False)
+                    num_documents += result.upserted_count \
+                        + result.matched_count
+                    continue
+                try:
+                    with self._write_deadline(timeout):
+                        result = self.collection.insert_many(
+                            chunk, ordered=False)
+                    num_documents += len(result.inserted_ids)
+                except BulkWriteError as e:
+                    if on_conflict == 'error':
+                        raise e
+                    num_documents += e.details['nInserted']
+        return num_documents
+
+    def update(self,
+               item: MutableMapping,
+               timeout: Optional[float] = None,
+               **kwargs):
+        with self._write_deadline(timeout):
+            self.collection.replace_one(
+                filter={'_id': item['_id']},
+                replacement=item,
+                upsert=False)
+
+    def update_attributes(self,
+                          key: Any,
+                          timeout: Optional[float] = None,
+                          **kwargs):
+        with self._write_deadline(timeout):
+            self.collection.update_one(
+                filter={'_id': key},
+                update={'$set': kwargs})
 
-    def update_attributes(self, key: Any, **kwargs):
-        self.collection.update_one(
-            filter={'_id': key},
-            update={'$set': kwargs})
+    def update_attributes_many(self,
+                               updates: Mapping,
+                               timeout: Optional[float] = None,
+                               **kwargs) -> int:
+        """Set attributes on many documents.
 
-    def search(self, *args, **kwargs):
-        cursor = self.collection.find(locals()['kwargs'])
-        for x in cursor:
-            yield x
+        Keys that get the same attributes are grouped into one `update_many`
+        on `{'_id': {'$in': keys}}`, and the rest are sent as `update_one`s,
+        all in chunked, unordered bulk writes.
 
-    def upsert(self, item: MutableMapping, **kwargs):
+        Args:
+          updates: Mapping of `_id` to a Dict of the attributes to set.
+          timeout: float, optional, seconds per chunk. Overrides the
+            repository default.
+
+        Returns:
+          Int, the number of documents modified.
+        """
+        # NOTE: payloads are grouped by their BSON encoding, since the values
+        # needn't be hashable.
+        groups = {}
+        for key, attributes in updates.items():
+            payload = bson.encode(attributes)
+            if payload not in groups:
+                groups[payload] = (attributes, [])
+            groups[payload][1].append(key)
+        operations = []
+        for attributes, keys in groups.values():
+            if len(keys) == 1:
+                operations.append(UpdateOne(
+                    filter={'_id': keys[0]},
+                    update={'$set': attributes}))
+                continue
+            for chunk in util.get_chunks(keys, self.chunk_size):
+                operations.append(UpdateMany(
+                    filter={'_id': {'$in': chunk}},
+                    update={'$set': attributes}))
+        modified = 0
+        for chunk in util.get_chunks(operations, self.chunk_size):
+            with self._write_deadline(timeout):
+                result = self.collection.bulk_write(chunk, ordered=False)
+            modified += result.modified_count
+        return modified
+
+    def sample(self,
+               size: Union[int, float],
+               seed: Optional[int] = None,
+               **kwargs) -> Generator:
+        """Get a random sample of the documents matching `kwargs`.
+
+        Uses `$sample`, which picks documents at random without a collection
+        scan when it is the first stage and `size` is under 5% of the
+        collection. With a filter, the matching documents are scanned first.
+        A fraction is converted to a number using the (estimated) count.
+
+        Args:
+          size: int, the number of documents, or float, the fraction.
+          seed: not supported, since `$sample` can't be seeded.
+
+        Read options (see `_find`) are separated out from the filter, though
+        only `batch_size`, `timeout`, `raw` and `read_preference` apply.
+        """
+        if seed is not None:
+            raise ValueError('$sample can not be seeded.')
+        filter, options = self._split_read_options(kwargs)
+        self._check_index(filter.keys())
+        timeout = options.get('timeout')
+        collection = self._get_read_collection(
+            options.get('raw'), options.get('read_preference'))
+        n, fraction = self._get_sample_size(size)
+        if fraction is not None:
+            # NOTE: counting may itself scan, but only the matching `_id`s.
+            with self._deadline(timeout):
+                if filter:
+                    num_documents = collection.count_documents(filter)
+                else:
+                    num_documents = collection.estimated_document_count()
+            n = int(round(num_documents * fraction))
+        pipeline = [{'$sample': {'size': n}}]
+        if filter:
+            pipeline.insert(0, {'$match': filter})
+        return self._aggregate(
+            pipeline,
+            raw=options.get('raw'),
+            batch_size=options.get('batch_size'),
+            timeout=timeout,
+            read_preference=options.get('read_preference'))
+
+    def search(self, *args, **kwargs) -> Generator:
+        """Search for documents matching the keyword arguments.
+
+        Read options (see `_find`) are separated out from the filter.
+        """
+        filter, options = self._split_read_options(kwargs)
+        self._check_index(filter.keys())
+        return self._find(filter, **options)
+
+    def upsert(self,
+               item: MutableMapping,
+               timeout: Optional[float] = None,
+               **kwargs):
         if '_id' not in item:
             if self._id_attr:
                 item['_id'] = item[self._id_attr]
             else:
                 raise ValueError('Unable to infer _id. Specify in constructor.')
-        self.collection.replace_one(
-            filter={'_id': item['_id']},
-            replacement=item,
-            upsert=True)
+        with self._write_deadline(timeout):
+            self.collection.replace_one(
+                filter={'_id': item['_id']},
+                replacement=item,
+                upsert=True)
 
     def update_many(self, items: List[MutableMapping], **kwargs):
         raise NotImplementedError('Have not found a good way yet.')
+
+    def watch(self,
+              token: Optional[Mapping] = None,
+              **kwargs) -> Generator:
+        """Yield changes as they happen, from `token` onwards, indefinitely.
+
+        Yields:
+          Tuples of (token, change event), as `changes_since`. Save the token
+            to resume from after a restart.
+        """
+        with self.collection.watch(
+                resume_after=token,
+                full_document='updateLookup',
+                **kwargs) as stream:
+            for change in stream:
+                yield change['_id'], change
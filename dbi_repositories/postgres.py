@@ -1,13 +1,32 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import csv
 import logging
-from typing import Any, Dict, Generator, List, MutableMapping, Optional, \
-    Tuple, Union
+import queue
+import select
+import threading
+import time
+from typing import Any, BinaryIO, Dict, Generator, Iterable, List, \
+    MutableMapping, Optional, Tuple, Union
+import uuid
+import zlib
 
-import psycopg2
-from psycopg2 import extensions
-from psycopg2.errors import UniqueViolation
-from psycopg2.extras import RealDictCursor
+try:
+    import psycopg2
+    from psycopg2 import extensions
+    from psycopg2.errors import QueryCanceled, UniqueViolation
+    from psycopg2.extras import execute_values, RealDictCursor
+except ImportError:
+    # NOTE: the psycopg 3 engine in `postgres3` builds on this module, and
+    # doesn't need psycopg2 installed. The psycopg2 paths check for it with
+    # `require_psycopg2`.
+    psycopg2 = None
 
-from dbi_repositories.base import Repository
+from dbi_repositories import profiling, util
+from dbi_repositories.base import DeadlineExceeded, INDEX_CHECK_MODES, \
+    Repository
 
 
 """
@@ -16,7 +35,45 @@ https://www.psycopg.org/docs/usage.html#transactions-control
 """
 
 
+CONFLICT_MODES = ('error', 'ignore', 'upsert')
+DUMP_FORMATS = ('csv', 'jsonl')
+REPLICA_STRATEGIES = ('round_robin', 'least_loaded')
+SAMPLE_METHODS = ('system', 'bernoulli')
+
+# NOTE: CSV with quote and delimiter characters that never occur in JSON text,
+# which escapes control characters, so each JSON line is copied as is.
+JSONL_COPY_OPTIONS = "FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02'"
+LOAD_STAGING_TABLE = '_load_staging'
+# NOTE: well under the server's 1GB limit on a statement, since item sizes
+# are only estimated.
+MAX_STATEMENT_BYTES = 2 ** 28
+# NOTE: seconds since the replica last replayed a transaction, or 0 if it has
+# replayed all the WAL it has received (so an idle primary doesn't read as lag).
+REPLICA_LAG_SQL = """
+SELECT CASE
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(
+        EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END;
+"""
+
+
+def require_psycopg2() -> None:
+    """Raise a clear ImportError if psycopg2 isn't installed."""
+    if psycopg2 is None:
+        raise ImportError(
+            'psycopg2 is not installed. Install it with '
+            '`pip install dbi_repositories[postgres]`, or use '
+            '`dbi_repositories.postgres3` with psycopg 3.')
+
+
 class ConnectionFactory:
+    """Makes connections to a primary, and optionally to read replicas.
+
+    Calling the factory always connects to the primary. Use `connection` with
+    `read_only=True` to route to a replica, which is what the repository read
+    methods do.
+    """
 
     def __init__(self,
                  host: str,
@@ -24,27 +81,138 @@ class ConnectionFactory:
                  user: str,
                  password: str,
                  db_name: str,
-                 ssl: bool = False):
+                 ssl: bool = False,
+                 connect_timeout: Optional[int] = None,
+                 replicas: Optional[List[Tuple[str, int]]] = None,
+                 replica_strategy: str = 'round_robin',
+                 max_replica_lag: Optional[float] = None):
+        """Create a new ConnectionFactory.
+
+        Args:
+          replicas: List, optional, of (host, port) pairs of read replicas,
+            which share the user, password and databases of the primary.
+          replica_strategy: str, `round_robin` or `least_loaded` (fewest open
+            connections from this factory).
+          max_replica_lag: float, optional, seconds. If given, replicas further
+            behind than this are skipped. If all are skipped, reads go to the
+            primary.
+        """
+        require_psycopg2()
+        if replica_strategy not in REPLICA_STRATEGIES:
+            raise ValueError(f'Unexpected replica_strategy: '
+                             f'{replica_strategy}. '
+                             f'Expected one of {REPLICA_STRATEGIES}.')
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.db_name = db_name
         self.ssl = ssl
+        self.connect_timeout = connect_timeout
+        self.replicas = list(replicas or [])
+        self.replica_strategy = replica_strategy
+        self.max_replica_lag = max_replica_lag
+        self._lock = threading.Lock()
+        self._next_replica = 0
+        self._in_flight = [0] * len(self.replicas)
 
     def __call__(
             self,
             db_name: Optional[str] = None
     ) -> extensions.connection:
+        return self._connect(self.host, self.port, db_name)
+
+    def _connect(self,
+                 host: str,
+                 port: int,
+                 db_name: Optional[str] = None) -> extensions.connection:
         if not db_name:
             db_name = self.db_name
-        return get_connection(
-            host=self.host,
-            port=self.port,
+        conn = get_connection(
+            host=host,
+            port=port,
             user=self.user,
             password=self.password,
             db_name=db_name,
-            ssl=self.ssl)
+            ssl=self.ssl,
+            connect_timeout=self.connect_timeout)
+        profiling.record_connection('postgres', f'{host}:{port}/{db_name}')
+        return conn
+
+    def _connect_replica(self, db_name: Optional[str] = None) \
+            -> Tuple[Optional[int], extensions.connection]:
+        """Connect to a replica, or the primary if none is usable.
+
+        Returns:
+          Tuple of the index of the replica (None for the primary) and the
+            connection. The replica's in flight count is incremented, and must
+            be decremented when the connection is closed.
+        """
+        with self._lock:
+            if self.replica_strategy == 'least_loaded':
+                candidates = sorted(range(len(self.replicas)),
+                                    key=lambda i: self._in_flight[i])
+            else:
+                start = self._next_replica
+                self._next_replica = (start + 1) % len(self.replicas)
+                candidates = [(start + i) % len(self.replicas)
+                              for i in range(len(self.replicas))]
+            for index in candidates:
+                self._in_flight[index] += 1
+        # NOTE: connect outside the lock, releasing the candidates not used.
+        chosen = None
+        conn = None
+        for index in candidates:
+            if chosen is None:
+                host, port = self.replicas[index]
+                try:
+                    conn = self._connect(host, port, db_name)
+                    if self._is_lagging(conn):
+                        conn.close()
+                        conn = None
+                    else:
+                        chosen = index
+                        continue
+                except (psycopg2.OperationalError, DeadlineExceeded) as e:
+                    logging.warning(f'Unable to connect to replica '
+                                    f'{host}:{port}: {e}')
+            with self._lock:
+                self._in_flight[index] -= 1
+        if chosen is None:
+            logging.warning('No usable replica, reading from the primary.')
+            conn = self(db_name)
+        return chosen, conn
+
+    def _is_lagging(self, conn: extensions.connection) -> bool:
+        if self.max_replica_lag is None:
+            return False
+        with conn.cursor() as cursor:
+            cursor.execute(REPLICA_LAG_SQL)
+            lag = float(cursor.fetchone()[0])
+        conn.rollback()
+        return lag > self.max_replica_lag
+
+    @contextmanager
+    def connection(self,
+                   db_name: Optional[str] = None,
+                   read_only: bool = False):
+        """Context yielding a connection, which is closed on exit.
+
+        Args:
+          db_name: str, optional, overrides the default database.
+          read_only: bool, if True, and there are replicas, connect to one.
+        """
+        if read_only and self.replicas:
+            index, conn = self._connect_replica(db_name)
+        else:
+            index, conn = None, self(db_name)
+        try:
+            yield conn
+        finally:
+            conn.close()
+            if index is not None:
+                with self._lock:
+                    self._in_flight[index] -= 1
 
 
 def get_connection(
@@ -53,32 +221,211 @@ def get_connection(
         user: str,
         password: str,
         db_name: str,
-        ssl: bool = True
+        ssl: bool = True,
+        connect_timeout: Optional[int] = None
 ) -> extensions.connection:
     # NOTE: on sslmode: https://ankane.org/postgres-sslmode-explained
-    return psycopg2.connect(
-        host=host,
-        port=port,
-        user=user,
-        password=password,
-        dbname=db_name,
-        sslmode='require' if ssl else 'allow')
+    # NOTE: libpq takes connect_timeout in whole seconds, and treats anything
+    # less than 2 as 2.
+    require_psycopg2()
+    kwargs = {}
+    if connect_timeout:
+        kwargs['connect_timeout'] = connect_timeout
+    try:
+        return psycopg2.connect(
+            host=host,
+            port=port,
+            user=user,
+            password=password,
+            dbname=db_name,
+            sslmode='require' if ssl else 'allow',
+            **kwargs)
+    except psycopg2.OperationalError as e:
+        if connect_timeout and 'timeout expired' in str(e):
+            raise DeadlineExceeded(
+                f'Connecting to {host}:{port} took longer than '
+                f'{connect_timeout}s.') from e
+        raise e
+
+
+def _execute_autocommit(connection_factory: ConnectionFactory,
+                        statements: List[Tuple[str, List[Any]]],
+                        db_name: Optional[str] = None) -> List[Any]:
+    """Execute statements outside a transaction, e.g. `CREATE DATABASE`.
+
+    Returns:
+      List of the first row returned by each statement, or None.
+    """
+    conn = connection_factory(db_name)
+    try:
+        conn.autocommit = True
+        results = []
+        with conn.cursor() as cursor:
+            for sql, values in statements:
+                cursor.execute(sql, values)
+                results.append(cursor.fetchone()
+                               if cursor.description else None)
+        return results
+    finally:
+        conn.close()
 
 
 def create_db(connection_factory: ConnectionFactory,
               db_name: str,
-              sql_schema: str):
-    connection = connection_factory()
-    connection.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-    with connection.cursor() as cursor:
-        sql = f'CREATE DATABASE {db_name};'
-        cursor.execute(sql)
-    connection.set_isolation_level(extensions.ISOLATION_LEVEL_DEFAULT)
-    connection.commit()
-    connection.close()
-    with connection_factory(db_name) as conn:
-        with conn.cursor() as cursor:
+              sql_schema: str,
+              template: bool = False) -> None:
+    """Create a database and its schema.
+
+    Args:
+      connection_factory: ConnectionFactory, connecting to an existing
+        (maintenance) database.
+      db_name: str, the database to create.
+      sql_schema: str, SQL creating the schema.
+      template: bool, if True, clone a template database built from
+        `sql_schema` (see `create_template_db`), rather than running the
+        schema, which is much faster for repeated creates.
+    """
+    if template:
+        template_name = create_template_db(connection_factory, sql_schema)
+        _execute_autocommit(connection_factory, [(
+            f'CREATE DATABASE {db_name} TEMPLATE {template_name};', [])])
+        return
+    _execute_autocommit(connection_factory, [
+        (f'CREATE DATABASE {db_name};', [])])
+    conn = connection_factory(db_name)
+    try:
+        with conn, conn.cursor() as cursor:
             cursor.execute(sql_schema)
+    finally:
+        conn.close()
+
+
+def create_template_db(connection_factory: ConnectionFactory,
+                       sql_schema: str) -> str:
+    """Build a template database from a schema, once.
+
+    The template is named after a hash of the schema, so a changed schema gets
+    a new template. It is built under a temporary name and renamed when done,
+    with an advisory lock against concurrent builds, so a crashed build never
+    leaves a broken template. Connections to it are disallowed, since
+    `CREATE DATABASE ... TEMPLATE` fails while anyone is connected.
+
+    Returns:
+      Str, the template database name.
+    """
+    template_name = get_template_name(sql_schema)
+    building_name = f'{template_name}_building'
+    lock_id = zlib.crc32(template_name.encode())
+    conn = connection_factory()
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock(%s);', [lock_id])
+            try:
+                cursor.execute(
+                    'SELECT 1 FROM pg_database WHERE datname = %s;',
+                    [template_name])
+                if cursor.fetchone():
+                    return template_name
+                cursor.execute(f'DROP DATABASE IF EXISTS {building_name};')
+                create_db(connection_factory, building_name, sql_schema)
+                cursor.execute(f'ALTER DATABASE {building_name} '
+                               f'RENAME TO {template_name};')
+                cursor.execute(f'ALTER DATABASE {template_name} '
+                               f'WITH IS_TEMPLATE true ALLOW_CONNECTIONS false;')
+                return template_name
+            finally:
+                cursor.execute('SELECT pg_advisory_unlock(%s);', [lock_id])
+    finally:
+        conn.close()
+
+
+def drop_db(connection_factory: ConnectionFactory, db_name: str) -> None:
+    """Drop a database if it exists, disconnecting anyone connected."""
+    _execute_autocommit(connection_factory, [
+        ('SELECT pg_terminate_backend(pid) FROM pg_stat_activity '
+         'WHERE datname = %s AND pid <> pg_backend_pid();', [db_name]),
+        (f'DROP DATABASE IF EXISTS {db_name};', []),
+    ])
+
+
+def get_template_name(sql_schema: str) -> str:
+    return f'template_{zlib.crc32(sql_schema.encode()):08x}'
+
+
+def recycle_db(connection_factory: ConnectionFactory,
+               db_name: str,
+               sql_schema: str) -> None:
+    """Drop a database if it exists, and clone it afresh from its template."""
+    drop_db(connection_factory, db_name)
+    create_db(connection_factory, db_name, sql_schema, template=True)
+
+
+class DatabasePool:
+    """A pool of pre-built databases with the same schema, e.g. for tests.
+
+    Databases are cloned from a template (see `create_template_db`). Released
+    databases are dropped and cloned afresh in a background thread, so that
+    `acquire` usually just takes a ready one.
+    """
+
+    def __init__(self,
+                 connection_factory: ConnectionFactory,
+                 sql_schema: str,
+                 size: int = 4,
+                 prefix: str = 'pooled'):
+        """Create a new DatabasePool, and build its databases.
+
+        Args:
+          connection_factory: ConnectionFactory, connecting to an existing
+            (maintenance) database.
+          sql_schema: str, SQL creating the schema.
+          size: int, number of databases to build up front.
+          prefix: str, of the database names.
+        """
+        self.connection_factory = connection_factory
+        self.sql_schema = sql_schema
+        self.prefix = prefix
+        self._db_names = set()
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        create_template_db(connection_factory, sql_schema)
+        for _ in range(size):
+            self._ready.put(self._create())
+
+    def _create(self) -> str:
+        # NOTE: random names, so pools in several processes don't collide.
+        db_name = f'{self.prefix}_{uuid.uuid4().hex[:12]}'
+        create_db(self.connection_factory, db_name, self.sql_schema,
+                  template=True)
+        with self._lock:
+            self._db_names.add(db_name)
+        return db_name
+
+    def _recycle(self, db_name: str) -> None:
+        recycle_db(self.connection_factory, db_name, self.sql_schema)
+        self._ready.put(db_name)
+
+    def acquire(self) -> str:
+        """Get the name of a fresh database, creating one if none is ready."""
+        try:
+            return self._ready.get_nowait()
+        except queue.Empty:
+            return self._create()
+
+    def close(self) -> None:
+        """Wait for pending recycles, and drop all the pool's databases."""
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            db_names = list(self._db_names)
+            self._db_names.clear()
+        for db_name in db_names:
+            drop_db(self.connection_factory, db_name)
+
+    def release(self, db_name: str) -> None:
+        """Return a database to be recycled for reuse."""
+        self._executor.submit(self._recycle, db_name)
 
 
 class PostgresRepository(Repository):
@@ -86,47 +433,204 @@ class PostgresRepository(Repository):
 
     This is meant to be opinionated, and the opinion is that all transactions
     are atomic (single transaction). Hence `add_many` and `delete_many`.
+
+    Every method takes an optional `timeout` in seconds, defaulting to the one
+    given to the constructor, which is applied as the `statement_timeout` of
+    its transaction. Exceeding it raises `DeadlineExceeded`.
     """
 
     def __init__(self,
                  connection_factory: ConnectionFactory,
                  table_name: str,
-                 primary_keys: List[str]):
+                 primary_keys: List[str],
+                 indexes: Optional[List[Union[str, List[str]]]] = None,
+                 index_check: Optional[str] = None,
+                 timeout: Optional[float] = None,
+                 change_column: Optional[str] = None,
+                 chunk_size: int = 1000,
+                 adaptive_chunking: bool = False):
         super().__init__()
+        if index_check is not None and index_check not in INDEX_CHECK_MODES:
+            raise ValueError(f'Unexpected index_check: {index_check}. '
+                             f'Expected one of {INDEX_CHECK_MODES}.')
         self.connection_factory = connection_factory
         self.table_name = table_name
         self.primary_keys = primary_keys
+        # NOTE: each index is a column name, or a list of column names.
+        self.indexes = [[x] if isinstance(x, str) else list(x)
+                        for x in indexes or []]
+        self.index_check = index_check
+        self.timeout = timeout
+        # NOTE: a column (or expression) that increases whenever a row is
+        # written, e.g. an `updated_at` set by a trigger, for `changes_since`.
+        self.change_column = change_column
+        # NOTE: number of items mapped, and rows fetched, at a time.
+        self.chunk_size = chunk_size
+        # NOTE: if set, bulk writes are chunked by estimated size and latency,
+        # starting from `chunk_size` items. See `util.AdaptiveChunker`.
+        self.chunker = None
+        if adaptive_chunking:
+            self.chunker = util.AdaptiveChunker(
+                size_of=self._estimate_item_bytes,
+                max_bytes=MAX_STATEMENT_BYTES,
+                initial_items=chunk_size)
+        # NOTE: SQL types of the primary key columns, cached by
+        # `_get_key_type_names`.
+        self._key_type_names = None
+
+    @contextmanager
+    def _transaction(self,
+                     timeout: Optional[float] = None,
+                     read_only: bool = False):
+        """Context for a single transaction, yielding the connection.
+
+        Args:
+          timeout: float, optional, seconds. Overrides the repository default.
+          read_only: bool, if True the connection may be to a read replica.
+            Anything that writes must leave this False, to stay on the primary.
+        """
+        # NOTE: here rather than in the constructor, as `postgres3` overrides
+        # this, and doesn't need psycopg2.
+        require_psycopg2()
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            with self.connection_factory.connection(read_only=read_only) \
+                    as conn, conn:
+                conn = profiling.wrap_connection(conn, self.table_name)
+                if timeout:
+                    self._set_statement_timeout(conn, timeout)
+                yield conn
+        except QueryCanceled as e:
+            # NOTE: without a timeout, the cancel came from elsewhere, e.g.
+            # `pg_cancel_backend` or Ctrl-C.
+            if not timeout:
+                raise
+            raise DeadlineExceeded(
+                f'Statement on {self.table_name} took longer than '
+                f'{timeout}s.') from e
+
+    @staticmethod
+    def _cursor(conn: extensions.connection) -> extensions.cursor:
+        """A cursor that returns rows as dicts."""
+        return conn.cursor(cursor_factory=RealDictCursor)
+
+    @staticmethod
+    def _set_statement_timeout(conn: extensions.connection,
+                               timeout: float) -> None:
+        # NOTE: set_config(..., true) is SET LOCAL, but takes parameters.
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT set_config('statement_timeout', %s, true);",
+                           [str(int(timeout * 1000))])
+
+    @staticmethod
+    def _wait_for_notify(conn: extensions.connection, timeout: float) -> None:
+        """Wait up to `timeout` seconds for a NOTIFY on a listening conn."""
+        ready, _, _ = select.select([conn], [], [], timeout)
+        if ready:
+            conn.poll()
+            conn.notifies.clear()
+
+    @staticmethod
+    def _copy_from(cursor: extensions.cursor, sql: str, file: BinaryIO) -> int:
+        """Run a `COPY ... FROM STDIN`, streaming from a binary file.
+
+        Returns:
+          Int, the number of rows copied.
+        """
+        cursor.copy_expert(sql, file)
+        return cursor.rowcount
+
+    @staticmethod
+    def _copy_to(cursor: extensions.cursor, sql: str, file: BinaryIO) -> int:
+        """Run a `COPY ... TO STDOUT`, streaming into a binary file.
+
+        Returns:
+          Int, the number of rows copied.
+        """
+        cursor.copy_expert(sql, file)
+        return cursor.rowcount
+
+    @staticmethod
+    def _execute_each(cursor: extensions.cursor,
+                      statements: Iterable[Tuple[str, List[Any]]]) -> None:
+        """Execute (sql, values) statements in turn, ignoring results."""
+        for sql, values in statements:
+            cursor.execute(sql, values)
 
     def _execute_generator_return(self,
                                   sql: str,
-                                  values: Optional[List[Any]] = None) \
+                                  values: Optional[List[Any]] = None,
+                                  timeout: Optional[float] = None,
+                                  read_only: bool = False,
+                                  map_out: bool = True) \
             -> Generator:
-        with self.connection_factory() as conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        with self._transaction(timeout, read_only) as conn:
+            with self._cursor(conn) as cursor:
                 cursor.execute(sql, values)
-                for item in cursor:
-                    yield self._map_item_out(dict(item))
+                for rows in iter(
+                        lambda: cursor.fetchmany(self.chunk_size), []):
+                    rows = [dict(x) for x in rows]
+                    if map_out:
+                        rows = self.map_batch_out(rows)
+                    for item in rows:
+                        yield item
 
     def _execute_no_return(self,
                            sql: str,
-                           values: Optional[List[Any]] = None) \
+                           values: Optional[List[Any]] = None,
+                           timeout: Optional[float] = None) \
             -> None:
-        with self.connection_factory() as conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        with self._transaction(timeout) as conn:
+            with self._cursor(conn) as cursor:
                 cursor.execute(sql, values)
 
     def _execute_single_return(self,
                                sql: str,
-                               values: Optional[List[Any]] = None) -> Any:
-        with self.connection_factory() as conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                               values: Optional[List[Any]] = None,
+                               timeout: Optional[float] = None,
+                               read_only: bool = False) -> Any:
+        with self._transaction(timeout, read_only) as conn:
+            with self._cursor(conn) as cursor:
                 cursor.execute(sql, values)
                 item = cursor.fetchone()
                 if item:
-                    return self._map_item_out(dict(item))
+                    return self.map_batch_out([dict(item)])[0]
                 else:
                     return None
 
+    @staticmethod
+    def _estimate_item_bytes(item: MutableMapping) -> int:
+        """Rough encoded size of an item, erring on the large side."""
+        num_bytes = 0
+        for value in item.values():
+            if value is None or isinstance(value, (bool, int, float)):
+                num_bytes += 8
+                continue
+            # NOTE: unwrap adapters, e.g. psycopg2's `Json` or psycopg's
+            #  `Jsonb`, to size what they wrap.
+            value = getattr(value, 'adapted', getattr(value, 'obj', value))
+            if isinstance(value, bytes):
+                num_bytes += len(value)
+            elif isinstance(value, str):
+                num_bytes += len(value.encode())
+            else:
+                # NOTE: e.g. dicts and lists sent as JSON or arrays, which
+                #  take about as many bytes as their repr.
+                num_bytes += len(repr(value).encode())
+        return num_bytes
+
+    def _estimate_count(self, timeout: Optional[float] = None) -> int:
+        """The planner's estimate of the number of rows, or -1 if unknown."""
+        # NOTE: reltuples is -1 (or 0 before PG 14) until the table is first
+        #  vacuumed or analyzed.
+        sql = 'SELECT reltuples::bigint AS estimate FROM pg_class ' \
+              'WHERE oid = %s::regclass;'
+        with self._transaction(timeout, read_only=True) as conn:
+            with self._cursor(conn) as cursor:
+                cursor.execute(sql, [self.table_name])
+                return cursor.fetchone()['estimate']
+
     @staticmethod
     def _get_conditions_and_values(
             alias: Optional[str] = None,
@@ -144,6 +648,122 @@ class PostgresRepository(Repository):
         conditions = join_char.join(conditions)
         return conditions, values
 
+    def _get_delete_sql_and_values(self,
+                                   columns: List[str],
+                                   rows: List[Tuple]) \
+            -> Tuple[str, List[Any]]:
+        """One DELETE for many rows matching on the same columns.
+
+        Args:
+          columns: List of the column names matched on.
+          rows: List of tuples of values, in the order of `columns`.
+        """
+        condition, values = self._get_in_condition_and_values(columns, rows)
+        sql = f'DELETE FROM {self.table_name} WHERE {condition};'
+        return sql, values
+
+    @staticmethod
+    def _get_filter_fields(**kwargs) -> List[str]:
+        # NOTE: mirrors `_get_conditions_and_values`, which skips None values.
+        return [k for k, v in kwargs.items()
+                if v is not None and k != 'projection']
+
+    @staticmethod
+    def _get_in_condition_and_values(columns: List[str],
+                                     rows: List[Tuple]) \
+            -> Tuple[str, List[Any]]:
+        """An IN condition matching any of `rows` on `columns`.
+
+        Args:
+          columns: List of the column names matched on.
+          rows: List of tuples of values, in the order of `columns`.
+        """
+        # NOTE: each value is compared with its column directly, so Postgres
+        #  types it by the column. An array, or a join on VALUES, would type a
+        #  string as text, and fail against e.g. a timestamp or uuid column.
+        if len(columns) == 1:
+            condition = f'{columns[0]} IN ' \
+                        f'({",".join(["%s"] * len(rows))})'
+        else:
+            placeholders = ','.join(['%s'] * len(columns))
+            rows_sql = ','.join([f'({placeholders})'] * len(rows))
+            condition = f'({",".join(columns)}) IN ({rows_sql})'
+        return condition, [x for row in rows for x in row]
+
+    def _get_key_type_names(self, cursor: Any) -> List[str]:
+        """SQL types of the primary key columns, in order, cached after the
+        first call."""
+        if self._key_type_names is None:
+            cursor.execute(
+                'SELECT attname, format_type(atttypid, atttypmod) AS type '
+                'FROM pg_attribute WHERE attrelid = %s::regclass '
+                'AND attnum > 0 AND NOT attisdropped;',
+                [self.table_name])
+            types = {x['attname']: x['type'] for x in cursor.fetchall()}
+            self._key_type_names = [types[x] for x in self.primary_keys]
+        return self._key_type_names
+
+    def _get_index_name(self, columns: List[str]) -> str:
+        return f'{self.table_name}_{"_".join(columns)}_idx'
+
+    def _get_invalid_index_names(self, cursor: Any) -> List[str]:
+        """Names of the table's indexes left INVALID, e.g. by a failed
+        `CREATE INDEX CONCURRENTLY`."""
+        cursor.execute(
+            'SELECT c.relname FROM pg_index i '
+            'JOIN pg_class c ON c.oid = i.indexrelid '
+            'WHERE i.indrelid = %s::regclass AND NOT i.indisvalid;',
+            [self.table_name])
+        return [x[0] for x in cursor.fetchall()]
+
+    def _get_index_statements(self) -> List[str]:
+        statements = []
+        for columns in self.indexes:
+            name = self._get_index_name(columns)
+            statements.append(
+                f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} '
+                f'ON {self.table_name} ({",".join(columns)});')
+        return statements
+
+    def _get_on_conflict_sql(self,
+                             columns: List[str],
+                             on_conflict: str = 'error') -> str:
+        """The ON CONFLICT clause of an INSERT of `columns`, if any.
+
+        Args:
+          on_conflict: str, one of `CONFLICT_MODES`. `error` raises on a
+            duplicate key, `ignore` skips the row, and `upsert` updates the
+            non-key columns to the new values.
+        """
+        if on_conflict not in CONFLICT_MODES:
+            raise ValueError(f'Unexpected on_conflict: {on_conflict}. '
+                             f'Expected one of {CONFLICT_MODES}.')
+        primary_keys = ','.join(self.primary_keys)
+        update_keys = [k for k in columns if k not in self.primary_keys]
+        if on_conflict == 'ignore' or (on_conflict == 'upsert'
+                                       and not update_keys):
+            return f' ON CONFLICT ({primary_keys}) DO NOTHING'
+        if on_conflict == 'upsert':
+            update_conditions = ', '.join(f'{k} = EXCLUDED.{k}'
+                                          for k in update_keys)
+            return f' ON CONFLICT ({primary_keys}) DO UPDATE ' \
+                   f'SET {update_conditions}'
+        return ''
+
+    @staticmethod
+    def _get_order_by_sql(sort: Optional[List[Tuple[str, int]]] = None) \
+            -> str:
+        """An ORDER BY clause, with a leading space, or '' if no `sort`.
+
+        Args:
+          sort: List, optional, of (column, direction) pairs, as in Mongo, with
+            1 for ascending and -1 for descending.
+        """
+        if not sort:
+            return ''
+        columns = [f'{k} {"DESC" if d == -1 else "ASC"}' for k, d in sort]
+        return f' ORDER BY {", ".join(columns)}'
+
     @staticmethod
     def _get_selector(**kwargs) -> str:
         selector = '*'
@@ -182,13 +802,37 @@ class PostgresRepository(Repository):
                f'WHERE {where_conditions};'
         return sql, values
 
+    def _get_skip_unchanged_upsert_sql(self, update_keys: List[str]) -> str:
+        """ON CONFLICT clause that only updates rows that would change.
+
+        Rows that are inserted or updated are returned with an `inserted`
+        flag, and rows left unchanged are not returned, so the caller can
+        count each.
+        """
+        primary_keys = ','.join(self.primary_keys)
+        if not update_keys:
+            return f' ON CONFLICT ({primary_keys}) DO NOTHING ' \
+                   f'RETURNING (xmax = 0) AS inserted;'
+        update_conditions = ', '.join(f'{k} = EXCLUDED.{k}'
+                                      for k in update_keys)
+        current = ','.join(f'tn.{k}' for k in update_keys)
+        excluded = ','.join(f'EXCLUDED.{k}' for k in update_keys)
+        # NOTE: xmax is 0 for a freshly inserted row version.
+        return f' ON CONFLICT ({primary_keys}) DO UPDATE ' \
+               f'SET {update_conditions} ' \
+               f'WHERE ({current}) IS DISTINCT FROM ({excluded}) ' \
+               f'RETURNING (xmax = 0) AS inserted;'
+
     def _item_to_insert_statement(self,
                                   item: MutableMapping,
                                   upsert: bool = False,
-                                  ignore_duplicates: bool = False) \
+                                  ignore_duplicates: bool = False,
+                                  skip_unchanged: bool = False) \
             -> Tuple[str, List[Any]]:
         if upsert and ignore_duplicates:
             raise ValueError('Pick one of `upsert` and `ignore_duplicates`.')
+        if skip_unchanged and not upsert:
+            raise ValueError('`skip_unchanged` only applies to `upsert`.')
         attrs = []
         values = []
         for attr, value in item.items():
@@ -203,6 +847,10 @@ class PostgresRepository(Repository):
         if ignore_duplicates:
             primary_keys = ','.join(self.primary_keys)
             sql += f' ON CONFLICT ({primary_keys}) DO NOTHING;'
+        elif skip_unchanged:
+            sql += self._get_skip_unchanged_upsert_sql(
+                update_keys=[k for k in item.keys()
+                             if k not in self.primary_keys])
         elif upsert:
             primary_keys = ','.join(self.primary_keys)
             update_statement, update_values = self._get_update_sql_and_values(
@@ -218,41 +866,248 @@ class PostgresRepository(Repository):
             sql += ';'
         return sql, values
 
+    def _get_key(self, item: MutableMapping) -> Any:
+        """The primary key value of an item, or a tuple for composite keys."""
+        key = tuple(item[k] for k in self.primary_keys)
+        return key[0] if len(key) == 1 else key
+
+    def _get_values_insert_sql(self,
+                               columns: List[str],
+                               on_conflict: str = 'error') -> str:
+        """Multi-row INSERT, with a single `VALUES %s` for `execute_values`.
+
+        Args:
+          columns: List of the column names, in the order of the values.
+          on_conflict: str, one of `CONFLICT_MODES`. See `_get_on_conflict_sql`.
+        """
+        sql = f'INSERT INTO {self.table_name} AS tn ' \
+              f'({",".join(columns)}) VALUES %s'
+        return sql + self._get_on_conflict_sql(columns, on_conflict) + ';'
+
+    def _get_value_rows(self,
+                        items: List[Dict],
+                        on_conflict: str = 'error') \
+            -> Generator[Tuple[List[str], List[Tuple]], None, None]:
+        """Group mapped items by column shape into rows of values.
+
+        Rows are in key order. Unless `on_conflict` is `error`, each key is
+        written once, since one statement can't affect the same row twice, with
+        the same result as writing the items in turn: with `ignore` the first
+        item for a key is kept, and with `upsert` the items for a key are
+        merged, later values winning.
+
+        Yields:
+          Tuples of (columns, rows).
+        """
+        if on_conflict != 'error':
+            by_key = {}
+            for item in items:
+                key = self._get_key(item)
+                if key not in by_key:
+                    by_key[key] = item
+                elif on_conflict == 'upsert':
+                    by_key[key] = {**by_key[key], **item}
+            items = by_key.values()
+        shapes = {}
+        for item in items:
+            shapes.setdefault(tuple(item.keys()), []).append(item)
+        for columns, shape_items in shapes.items():
+            try:
+                shape_items = sorted(shape_items, key=self._get_key)
+            except TypeError:
+                pass
+            rows = [tuple(x[k] for k in columns) for x in shape_items]
+            yield list(columns), rows
+
+    def _write_values(self,
+                      cursor: extensions.cursor,
+                      items: List[Dict],
+                      on_conflict: str = 'error') -> int:
+        """Write mapped items with one multi-row INSERT per column shape.
+
+        Returns:
+          Int, the number of rows inserted or updated.
+        """
+        num_rows = 0
+        for columns, rows in self._get_value_rows(items, on_conflict):
+            sql = self._get_values_insert_sql(columns, on_conflict)
+            execute_values(cursor, sql, rows, page_size=len(rows))
+            num_rows += cursor.rowcount
+        return num_rows
+
+    def _fetch_skip_unchanged_upsert(self,
+                                     cursor: extensions.cursor,
+                                     columns: List[str],
+                                     rows: List[Tuple]) -> List[Dict]:
+        """Upsert rows of one column shape with a single multi-row INSERT.
+
+        Returns:
+          List of the rows inserted or updated, each with an `inserted` flag.
+        """
+        sql = f'INSERT INTO {self.table_name} AS tn ' \
+              f'({",".join(columns)}) VALUES %s'
+        sql += self._get_skip_unchanged_upsert_sql(
+            update_keys=[k for k in columns if k not in self.primary_keys])
+        return execute_values(
+            cursor, sql, rows, page_size=len(rows), fetch=True)
+
+    def _iter_chunks(self, items: Iterable) -> Generator[List, None, None]:
+        """Chunks of items for bulk writes, adaptive if `chunker` is set."""
+        if self.chunker:
+            return self.chunker.chunks(items)
+        return util.iter_chunks(items, self.chunk_size)
+
+    def _index_target(self) -> str:
+        return self.table_name
+
+    def _indexed_leading_fields(self) -> List[str]:
+        fields = [self.primary_keys[0]] if self.primary_keys else []
+        fields += [columns[0] for columns in self.indexes]
+        return fields
+
     def _map_item_in(self, item: MutableMapping) -> Dict:
         return {k: v for k, v in item.items()}
 
     def _map_item_out(self, item: Dict) -> MutableMapping:
         return item
 
+    def map_batch_in(self, items: List[MutableMapping]) -> List[Dict]:
+        """Map a chunk of items to rows, for the write methods.
+
+        Defaults to `_map_item_in` per item. Override to convert a whole chunk
+        at once.
+        """
+        return [self._map_item_in(x) for x in items]
+
+    def map_batch_out(self, rows: List[Dict]) -> List[MutableMapping]:
+        """Map a chunk of fetched rows to items, for the reads.
+
+        Defaults to `_map_item_out` per row. Override to convert a whole chunk
+        at once.
+        """
+        return [self._map_item_out(x) for x in rows]
+
     def add(self,
             item: MutableMapping,
             ignore_duplicates: bool = False,
             **kwargs) -> None:
-        item = self._map_item_in(item)
+        item = self.map_batch_in([item])[0]
         sql, values = self._item_to_insert_statement(
             item=item,
             ignore_duplicates=ignore_duplicates,
             upsert=False)
-        self._execute_no_return(sql, values)
+        self._execute_no_return(sql, values, kwargs.get('timeout'))
 
     def add_many(self,
                  items: List[MutableMapping],
                  ignore_duplicates: bool = False,
                  **kwargs):
-        with self.connection_factory() as conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                for item in items:
-                    item = self._map_item_in(item)
-                    sql, values = self._item_to_insert_statement(
-                        item=item,
-                        ignore_duplicates=ignore_duplicates,
-                        upsert=False)
-                    _ = cursor.execute(sql, values)
+        with self._transaction(kwargs.get('timeout')) as conn:
+            with self._cursor(conn) as cursor:
+                for chunk in self._iter_chunks(items):
+                    self._write_values(
+                        cursor,
+                        self.map_batch_in(chunk),
+                        'ignore' if ignore_duplicates else 'error')
+
+    def aggregate(self,
+                  group_by: Optional[List[str]] = None,
+                  metrics: Optional[Dict[str, str]] = None,
+                  **kwargs) -> Generator:
+        """Group the rows matching `kwargs` and compute metrics per group.
+
+        Compiles to a single `GROUP BY` query. Filters, like `search`, only
+        handle `=` conditions. Results are not passed through `map_batch_out`.
+
+        Args:
+          group_by: List, optional, of the columns to group by.
+          metrics: Dict of column to function, e.g.
+            `{'num_likes': 'sum', '*': 'count'}`.
+          timeout: float, optional, seconds.
+
+        Yields:
+          Dicts of the group_by columns and the metrics, in group order, e.g.
+            `{'tweet_id': 1, 'num_likes_sum': 10, 'count': 2}`.
+        """
+        timeout = kwargs.pop('timeout', None)
+        group_by = group_by or []
+        self._check_index(self._get_filter_fields(**kwargs))
+        selectors = list(group_by)
+        for name, field, function in self._get_metrics(metrics or {}):
+            selectors.append(f'{function.upper()}({field}) AS {name}')
+        if not selectors:
+            raise ValueError('Nothing to group by or compute.')
+        sql = f'SELECT {", ".join(selectors)} FROM {self.table_name}'
+        conditions, values = self._get_conditions_and_values(
+            join_char=' AND ',
+            **kwargs)
+        if conditions:
+            sql += f' WHERE {conditions}'
+        if group_by:
+            sql += f' GROUP BY {", ".join(group_by)}' \
+                   f' ORDER BY {", ".join(group_by)}'
+        return self._execute_generator_return(
+            sql + ';', values, timeout, read_only=True, map_out=False)
 
     def all(self, **kwargs) -> Generator:
         selector = self._get_selector(**kwargs)
-        sql = f'SELECT {selector} FROM {self.table_name};'
-        return self._execute_generator_return(sql)
+        sql = f'SELECT {selector} FROM {self.table_name}' \
+              f'{self._get_order_by_sql(kwargs.get("sort"))};'
+        return self._execute_generator_return(
+            sql, timeout=kwargs.get('timeout'), read_only=True)
+
+    def changes_since(self,
+                      token: Optional[List[Any]] = None,
+                      limit: Optional[int] = None,
+                      **kwargs) -> Generator:
+        """Get rows written since `token`, in `change_column` order.
+
+        Rows are ordered by `change_column` then the primary keys, and the
+        token is those values for the last row seen, so paging is a range scan
+        when `(change_column, *primary_keys)` is indexed. Deletes are not
+        seen, and `change_column` values should only be assigned in commit
+        order (e.g. from a sequence in a trigger) for none to be missed.
+
+        Args:
+          token: List, optional, from a previous change. If None, start from
+            the first row.
+          limit: int, optional, maximum number of rows.
+
+        Yields:
+          Tuples of (token, item).
+        """
+        if not self.change_column:
+            raise ValueError('Specify `change_column` in the constructor '
+                             'to use changes_since.')
+        order_by = ','.join([self.change_column] + self.primary_keys)
+        sql = f'SELECT {self.change_column} AS _change_position, * ' \
+              f'FROM {self.table_name} '
+        values = []
+        if token is not None:
+            placeholders = ','.join(['%s'] * len(token))
+            sql += f'WHERE ({order_by}) > ({placeholders}) '
+            values += list(token)
+        sql += f'ORDER BY {order_by}'
+        if limit:
+            sql += ' LIMIT %s'
+            values.append(limit)
+        sql += ';'
+        with self._transaction(kwargs.get('timeout')) as conn:
+            with self._cursor(conn) as cursor:
+                cursor.execute(sql, values)
+                for rows in iter(
+                        lambda: cursor.fetchmany(self.chunk_size), []):
+                    rows = [dict(x) for x in rows]
+                    tokens = [[x.pop('_change_position')]
+                              + [x[k] for k in self.primary_keys]
+                              for x in rows]
+                    for token, item in zip(tokens, self.map_batch_out(rows)):
+                        yield token, item
+
+    @property
+    def chunk_stats(self) -> Optional[Dict]:
+        """Stats of the adaptive chunk sizes, if `adaptive_chunking` is on."""
+        return self.chunker.stats if self.chunker else None
 
     def commit(self) -> None:
         logging.warning(
@@ -261,84 +1116,549 @@ class PostgresRepository(Repository):
             'A call to this function is doing nothing and can be removed. '
             'Each base function is atomic and commits automatically.')
 
-    def count(self) -> int:
+    def count(self, timeout: Optional[float] = None) -> int:
         sql = f'SELECT COUNT(*) FROM {self.table_name};'
-        with self.connection_factory() as conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        with self._transaction(timeout, read_only=True) as conn:
+            with self._cursor(conn) as cursor:
                 cursor.execute(sql)
                 result = cursor.fetchone()
                 return result['count']
 
     def delete(self, conditions: Dict, **kwargs) -> None:
-        conditions, values = self._get_conditions_and_values(**conditions)
+        conditions, values = self._get_conditions_and_values(
+            join_char=' AND ',
+            **conditions)
         sql = f'DELETE FROM {self.table_name} WHERE {conditions};'
-        self._execute_no_return(sql, values)
+        self._execute_no_return(sql, values, kwargs.get('timeout'))
 
-    def delete_many(self, conditions: List[Dict], **kwargs) -> None:
-        with self.connection_factory() as conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                for cond in conditions:
-                    cond, values = self._get_conditions_and_values(**cond)
-                    sql = f'DELETE FROM {self.table_name} WHERE {cond};'
-                    cursor.execute(sql, values)
+    def delete_many(self, conditions: List[Dict], **kwargs) -> int:
+        """Delete the rows matching any of the conditions.
+
+        Conditions are grouped by the columns they match on, and each group is
+        deleted `chunk_size` conditions at a time in a single statement.
+
+        Args:
+          conditions: List of Dicts of column to value, e.g. primary keys. As
+            in `delete`, None values are ignored.
+
+        Returns:
+          Int, the number of rows deleted.
+        """
+        shapes = {}
+        for cond in conditions:
+            cond = {k: v for k, v in cond.items() if v is not None}
+            if not cond:
+                raise ValueError('Empty delete condition.')
+            columns = tuple(sorted(cond.keys()))
+            shapes.setdefault(columns, []).append(
+                tuple(cond[k] for k in columns))
+        num_rows = 0
+        with self._transaction(kwargs.get('timeout')) as conn:
+            with self._cursor(conn) as cursor:
+                for columns, rows in shapes.items():
+                    for chunk in util.iter_chunks(rows, self.chunk_size):
+                        sql, values = self._get_delete_sql_and_values(
+                            list(columns), chunk)
+                        cursor.execute(sql, values)
+                        num_rows += cursor.rowcount
+        return num_rows
+
+    def dump(self,
+             path: str,
+             format: str = 'csv',
+             compress: Optional[str] = None,
+             timeout: Optional[float] = None) -> int:
+        """Write the whole table to a file with `COPY ... TO STDOUT`.
+
+        Rows are streamed by the server straight into the file, without being
+        decoded, so memory use is constant. `map_batch_out` is not applied.
+
+        Args:
+          path: str, the file to write.
+          format: str, one of `DUMP_FORMATS`. `csv` has a header row, and
+            `jsonl` is one `row_to_json` object per line.
+          compress: str, optional, one of `util.COMPRESSIONS`. If None, it is
+            inferred from the extension of `path`, e.g. `.gz`.
+          timeout: float, optional, seconds.
+
+        Returns:
+          Int, the number of rows written.
+        """
+        if format not in DUMP_FORMATS:
+            raise ValueError(f'Unexpected format: {format}. '
+                             f'Expected one of {DUMP_FORMATS}.')
+        if format == 'csv':
+            sql = f'COPY {self.table_name} TO STDOUT ' \
+                  f'WITH (FORMAT csv, HEADER true);'
+        else:
+            sql = f'COPY (SELECT row_to_json(tn) FROM {self.table_name} ' \
+                  f'AS tn) TO STDOUT WITH ({JSONL_COPY_OPTIONS});'
+        with util.open_file(path, 'wb', compress) as f, \
+                self._transaction(timeout, read_only=True) as conn:
+            with conn.cursor() as cursor:
+                return self._copy_to(cursor, sql, f)
+
+    def load(self,
+             path: str,
+             format: str = 'csv',
+             compress: Optional[str] = None,
+             on_conflict: str = 'error',
+             timeout: Optional[float] = None) -> int:
+        """Load a file written by `dump` with `COPY ... FROM STDIN`.
+
+        The file is streamed to the server, so memory use is constant. CSV
+        columns are matched by the header row. A CSV file with `on_conflict`
+        `error` is copied straight into the table; otherwise it is copied into
+        a temporary table and inserted from there. JSON lines are parsed on the
+        server with `jsonb_populate_record`, so missing keys are loaded as
+        NULL. `map_batch_in` is not applied.
+
+        Args:
+          path: str, the file to read.
+          format: str, one of `DUMP_FORMATS`.
+          compress: str, optional, as in `dump`.
+          on_conflict: str, one of `CONFLICT_MODES`. A file with the same key
+            more than once can't be upserted.
+          timeout: float, optional, seconds.
+
+        Returns:
+          Int, the number of rows inserted or updated.
+        """
+        if format not in DUMP_FORMATS:
+            raise ValueError(f'Unexpected format: {format}. '
+                             f'Expected one of {DUMP_FORMATS}.')
+        if on_conflict not in CONFLICT_MODES:
+            raise ValueError(f'Unexpected on_conflict: {on_conflict}. '
+                             f'Expected one of {CONFLICT_MODES}.')
+        with util.open_file(path, 'rb', compress) as f, \
+                self._transaction(timeout) as conn:
+            with conn.cursor() as cursor:
+                if format == 'csv':
+                    header = f.readline()
+                    if not header:
+                        return 0
+                    columns = next(csv.reader([header.decode()]))
+                    column_sql = ','.join(columns)
+                    if on_conflict == 'error':
+                        return self._copy_from(
+                            cursor,
+                            f'COPY {self.table_name} ({column_sql}) '
+                            f'FROM STDIN WITH (FORMAT csv);',
+                            f)
+                    cursor.execute(
+                        f'CREATE TEMP TABLE {LOAD_STAGING_TABLE} '
+                        f'(LIKE {self.table_name}) ON COMMIT DROP;')
+                    self._copy_from(
+                        cursor,
+                        f'COPY {LOAD_STAGING_TABLE} ({column_sql}) '
+                        f'FROM STDIN WITH (FORMAT csv);',
+                        f)
+                    select_sql = f'SELECT {column_sql} ' \
+                                 f'FROM {LOAD_STAGING_TABLE}'
+                else:
+                    cursor.execute(
+                        f'CREATE TEMP TABLE {LOAD_STAGING_TABLE} '
+                        f'(doc jsonb) ON COMMIT DROP;')
+                    self._copy_from(
+                        cursor,
+                        f'COPY {LOAD_STAGING_TABLE} (doc) '
+                        f'FROM STDIN WITH ({JSONL_COPY_OPTIONS});',
+                        f)
+                    cursor.execute(
+                        'SELECT attname FROM pg_attribute '
+                        'WHERE attrelid = %s::regclass '
+                        'AND attnum > 0 AND NOT attisdropped '
+                        'ORDER BY attnum;',
+                        [self.table_name])
+                    columns = [x[0] for x in cursor.fetchall()]
+                    column_sql = ','.join(columns)
+                    select_sql = \
+                        f'SELECT {",".join(f"r.{x}" for x in columns)} ' \
+                        f'FROM {LOAD_STAGING_TABLE}, jsonb_populate_record(' \
+                        f'NULL::{self.table_name}, doc) AS r'
+                on_conflict_sql = self._get_on_conflict_sql(
+                    columns, on_conflict)
+                cursor.execute(
+                    f'INSERT INTO {self.table_name} AS tn ({column_sql}) '
+                    f'{select_sql}{on_conflict_sql};')
+                return cursor.rowcount
+
+    def load_parallel(self,
+                      items: Iterable[MutableMapping],
+                      num_connections: int = 4,
+                      on_conflict: str = 'error',
+                      batch_size: Optional[int] = None,
+                      timeout: Optional[float] = None) -> Dict[str, float]:
+        """Bulk load a stream of items concurrently over several connections.
+
+        Items are partitioned by the hash of their key, so all writes of a key
+        go through the same partition, in input order, and partitions never
+        contend for rows. Each partition is written on its own connection in
+        its own transaction, in multi-row INSERTs of `batch_size` items sorted
+        by key. Partitions commit independently, so if one fails, the others
+        may still commit.
+
+        Args:
+          items: Iterable of items, e.g. a generator; it is read once.
+          num_connections: int, number of partitions and connections.
+          on_conflict: str, one of `CONFLICT_MODES`.
+          batch_size: int, optional, defaults to `chunk_size`.
+          timeout: float, optional, seconds, per partition transaction.
+
+        Returns:
+          Dict with the number of `rows` written, the `seconds` taken, and
+            `rows_per_second`.
+        """
+        if on_conflict not in CONFLICT_MODES:
+            raise ValueError(f'Unexpected on_conflict: {on_conflict}. '
+                             f'Expected one of {CONFLICT_MODES}.')
+        batch_size = batch_size or self.chunk_size
+        # NOTE: small queues keep memory bounded if the database falls behind.
+        queues = [queue.Queue(maxsize=2) for _ in range(num_connections)]
+        # NOTE: set to make every partition roll back. An event rather than a
+        # marker on each queue, which could block on a full queue.
+        aborted = threading.Event()
+
+        def get(index: int) -> Optional[List[Dict]]:
+            while not aborted.is_set():
+                try:
+                    batch = queues[index].get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if not aborted.is_set():
+                    return batch
+            raise RuntimeError('Load aborted.')
+
+        def write_partition(index: int) -> int:
+            num_rows = 0
+            with self._transaction(timeout) as conn:
+                with conn.cursor() as cursor:
+                    for batch in iter(lambda: get(index), None):
+                        num_rows += self._write_values(
+                            cursor, batch, on_conflict)
+            return num_rows
+
+        def put(index: int, batch: Optional[List[Dict]]) -> None:
+            while True:
+                try:
+                    queues[index].put(batch, timeout=0.1)
+                    return
+                except queue.Full:
+                    # NOTE: a failed partition stops reading, so raise its
+                    # error rather than wait forever.
+                    if futures[index].done():
+                        futures[index].result()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=num_connections) as executor:
+            futures = [executor.submit(write_partition, i)
+                       for i in range(num_connections)]
+            buffers = [[] for _ in range(num_connections)]
+            try:
+                for chunk in util.iter_chunks(items, batch_size):
+                    for item in self.map_batch_in(chunk):
+                        key = repr(self._get_key(item)).encode()
+                        index = zlib.crc32(key) % num_connections
+                        buffers[index].append(item)
+                        if len(buffers[index]) >= batch_size:
+                            put(index, buffers[index])
+                            buffers[index] = []
+                for index, buffer in enumerate(buffers):
+                    if buffer:
+                        put(index, buffer)
+                    put(index, None)
+            except BaseException:
+                aborted.set()
+                raise
+            num_rows = sum(x.result() for x in futures)
+        seconds = time.perf_counter() - start
+        stats = {
+            'rows': num_rows,
+            'seconds': seconds,
+            'rows_per_second': num_rows / seconds if seconds else 0.,
+        }
+        logging.info(f'Loaded {num_rows} rows into {self.table_name} '
+                     f'({stats["rows_per_second"]:.1f}/s).')
+        return stats
+
+    def ensure_indexes(self) -> None:
+        # NOTE: CONCURRENTLY avoids locking the table against writes, but can't
+        # run inside a transaction block, hence autocommit.
+        conn = self.connection_factory()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                invalid = self._get_invalid_index_names(cursor)
+                for columns, sql in zip(self.indexes,
+                                        self._get_index_statements()):
+                    name = self._get_index_name(columns)
+                    # NOTE: a failed concurrent build leaves an INVALID index,
+                    # which IF NOT EXISTS would skip, so drop and rebuild it.
+                    if name in invalid:
+                        cursor.execute(
+                            f'DROP INDEX CONCURRENTLY IF EXISTS {name};')
+                    try:
+                        cursor.execute(sql)
+                    except Exception:
+                        cursor.execute(
+                            f'DROP INDEX CONCURRENTLY IF EXISTS {name};')
+                        raise
+        finally:
+            conn.close()
 
     def exists(self, *args, **kwargs) -> bool:
         # NOTE: only handles `=` conditions
+        timeout = kwargs.pop('timeout', None)
+        self._check_index(self._get_filter_fields(**kwargs))
         conditions, values = self._get_conditions_and_values(**kwargs)
         sql = f'SELECT COUNT(*) FROM {self.table_name} ' \
               f'WHERE {conditions};'
-        with self.connection_factory() as conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        with self._transaction(timeout, read_only=True) as conn:
+            with self._cursor(conn) as cursor:
                 cursor.execute(sql, values)
                 result = cursor.fetchone()
                 return result['count'] > 0
 
     def get(self, *args, **kwargs) \
             -> Union[MutableMapping, None]:
+        timeout = kwargs.pop('timeout', None)
         conditions, values = self._get_conditions_and_values(
             join_char=' AND ',
             **kwargs)
         sql = f'SELECT * FROM {self.table_name} WHERE {conditions};'
-        return self._execute_single_return(sql, values)
+        return self._execute_single_return(
+            sql, values, timeout, read_only=True)
+
+    def get_many(self,
+                 keys: List[Any],
+                 projection: Optional[List[str]] = None,
+                 timeout: Optional[float] = None,
+                 **kwargs) -> List[Optional[MutableMapping]]:
+        """Get many rows by primary key, in one query per `chunk_size` keys.
+
+        Args:
+          keys: List of primary key values, or tuples in the order of
+            `primary_keys` for a composite key. See `_get_key`.
+          projection: List, optional, of columns to select. The primary key
+            columns are always selected.
+          timeout: float, optional, seconds.
+
+        Returns:
+          List of the rows, in the order of `keys`, with None for any not
+            found.
+        """
+        if not keys:
+            return []
+        # NOTE: keys are numbered in the query, and rows matched back to them
+        #  by number, as a row's key can differ from the one asked for, e.g. a
+        #  datetime for a string.
+        unique_keys = list(dict.fromkeys(keys))
+        selector = 'tn.*'
+        if projection:
+            selector = ','.join(
+                f'tn.{x}' for x in dict.fromkeys(self.primary_keys + projection))
+        key_columns = ','.join(self.primary_keys)
+        conditions = ' AND '.join(f'tn.{k} = k.{k}' for k in self.primary_keys)
+        rows = {}
+        with self._transaction(timeout, read_only=True) as conn:
+            with self._cursor(conn) as cursor:
+                # NOTE: casts type the values like their columns, where a
+                #  VALUES list would type a string as text.
+                placeholders = ','.join(
+                    f'%s::{x}' for x in self._get_key_type_names(cursor))
+                for start in range(0, len(unique_keys), self.chunk_size):
+                    chunk = unique_keys[start:start + self.chunk_size]
+                    values_sql = ','.join(
+                        [f'(%s::int,{placeholders})'] * len(chunk))
+                    values = []
+                    for index, key in enumerate(chunk, start):
+                        values.append(index)
+                        values.extend(
+                            key if len(self.primary_keys) > 1 else [key])
+                    cursor.execute(
+                        f'SELECT k._key_index, {selector} '
+                        f'FROM (VALUES {values_sql}) '
+                        f'AS k (_key_index,{key_columns}) '
+                        f'JOIN {self.table_name} AS tn ON {conditions};',
+                        values)
+                    for row in cursor.fetchall():
+                        row = dict(row)
+                        rows[row.pop('_key_index')] = row
+        rows = dict(zip(rows.keys(), self.map_batch_out(list(rows.values()))))
+        indexes = {x: i for i, x in enumerate(unique_keys)}
+        return [rows.get(indexes[x]) for x in keys]
+
+    def sample(self,
+               size: Union[int, float],
+               seed: Optional[int] = None,
+               method: str = 'system',
+               oversample: float = 2.,
+               **kwargs) -> Generator:
+        """Get a random sample of the rows matching `kwargs`.
+
+        Uses `TABLESAMPLE`, so only the sampled part of the table is read with
+        the `system` method, which samples whole pages. The `bernoulli` method
+        samples rows, so is less clumpy, but reads every page.
+
+        For a number of rows, the sample percentage is estimated from the
+        planner's row count, times `oversample` to allow for filters and
+        estimation error, and the result is limited to `size`. So fewer rows
+        than asked for may be returned.
+
+        Args:
+          size: int, the number of rows, or float, the fraction of rows.
+          seed: int, optional. The same seed gives the same sample while the
+            table is unchanged.
+          method: str, one of `SAMPLE_METHODS`.
+          oversample: float, factor on the estimated percentage for a number
+            of rows.
+          timeout: float, optional, seconds.
+        """
+        if method not in SAMPLE_METHODS:
+            raise ValueError(f'Unexpected method: {method}. '
+                             f'Expected one of {SAMPLE_METHODS}.')
+        timeout = kwargs.pop('timeout', None)
+        n, fraction = self._get_sample_size(size)
+        if fraction is None:
+            num_rows = self._estimate_count(timeout)
+            fraction = min(1., n * oversample / num_rows) if num_rows > 0 \
+                else 1.
+        sql = f'SELECT tn.* FROM {self.table_name} AS tn ' \
+              f'TABLESAMPLE {method.upper()} (%s)'
+        values = [fraction * 100]
+        if seed is not None:
+            sql += ' REPEATABLE (%s)'
+            values.append(seed)
+        conditions, condition_values = self._get_conditions_and_values(
+            alias='tn',
+            join_char=' AND ',
+            **kwargs)
+        if conditions:
+            sql += f' WHERE {conditions}'
+            values += condition_values
+        if n is not None:
+            # NOTE: the sample comes back in page order, so shuffle it before
+            #  the limit; hashing ctid with the seed keeps it repeatable.
+            if seed is None:
+                sql += ' ORDER BY random()'
+            else:
+                sql += ' ORDER BY md5(tn.ctid::text || %s)'
+                values.append(str(seed))
+            sql += ' LIMIT %s'
+            values.append(n)
+        return self._execute_generator_return(
+            sql + ';', values, timeout, read_only=True)
 
     def search(self, *args, **kwargs) -> Generator:
         # NOTE: only handles `=` conditions
+        timeout = kwargs.pop('timeout', None)
+        self._check_index(self._get_filter_fields(**kwargs))
         conditions, values = self._get_conditions_and_values(
             join_char=' AND ',
             **kwargs)
         selector = self._get_selector(**kwargs)
         sql = f'SELECT {selector} FROM {self.table_name} WHERE {conditions};'
-        return self._execute_generator_return(sql, values)
+        return self._execute_generator_return(
+            sql, values, timeout, read_only=True)
 
     def update(self,
                item: MutableMapping,
                condition_keys: List[str],
-               update_keys: List[str]) -> None:
+               update_keys: List[str],
+               timeout: Optional[float] = None) -> None:
         sql, values = self._get_update_sql_and_values(
             item, condition_keys, update_keys)
-        self._execute_no_return(sql, values)
+        self._execute_no_return(sql, values, timeout)
 
     def update_many(self,
                     items: List[MutableMapping],
                     condition_keys: List[str],
-                    update_keys: List[str]) -> None:
-        with self.connection_factory() as conn:
+                    update_keys: List[str],
+                    timeout: Optional[float] = None) -> None:
+        with self._transaction(timeout) as conn:
             with conn.cursor() as cursor:
-                for item in items:
-                    sql, values = self._get_update_sql_and_values(
+                self._execute_each(cursor, (
+                    self._get_update_sql_and_values(
                         item, condition_keys, update_keys)
-                    cursor.execute(sql, values)
-
-    def upsert(self, item: MutableMapping, **kwargs) -> None:
-        item = self._map_item_in(item)
-        sql, values = self._item_to_insert_statement(item, upsert=True)
-        self._execute_no_return(sql, values)
-
-    def upsert_many(self, items: List[MutableMapping], **kwargs) -> None:
-        with self.connection_factory() as conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                for item in items:
-                    item = self._map_item_in(item)
-                    sql, values = self._item_to_insert_statement(
-                        item, upsert=True)
-                    _ = cursor.execute(sql, values)
+                    for item in items))
+
+    def upsert(self,
+               item: MutableMapping,
+               skip_unchanged: bool = False,
+               **kwargs) -> Optional[Dict[str, int]]:
+        """Insert an item, or update it if it exists.
+
+        Args:
+          item: the item.
+          skip_unchanged: bool, if True, an existing row is only updated when
+            some column is distinct from the incoming value, saving a dead
+            tuple and WAL for unchanged rows. The counts of inserted, updated,
+            and unchanged rows are returned.
+        """
+        return self.upsert_many([item], skip_unchanged=skip_unchanged, **kwargs)
+
+    def upsert_many(self,
+                    items: List[MutableMapping],
+                    skip_unchanged: bool = False,
+                    **kwargs) -> Optional[Dict[str, int]]:
+        """Upsert many items in one transaction. See `upsert`.
+
+        Each chunk is sent as one multi-row `INSERT ... ON CONFLICT DO UPDATE
+        SET col = EXCLUDED.col` per column shape, with the items for a
+        repeated key merged first, and counted once. See `_get_value_rows`.
+        """
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        with self._transaction(kwargs.get('timeout')) as conn:
+            with self._cursor(conn) as cursor:
+                for chunk in self._iter_chunks(items):
+                    chunk = self.map_batch_in(chunk)
+                    if not skip_unchanged:
+                        self._write_values(cursor, chunk, on_conflict='upsert')
+                        continue
+                    for columns, rows in self._get_value_rows(
+                            chunk, on_conflict='upsert'):
+                        results = self._fetch_skip_unchanged_upsert(
+                            cursor, columns, rows)
+                        inserted = sum(1 for x in results if x['inserted'])
+                        counts['inserted'] += inserted
+                        counts['updated'] += len(results) - inserted
+                        counts['unchanged'] += len(rows) - len(results)
+        if skip_unchanged:
+            return counts
+        return None
+
+    def watch(self,
+              token: Optional[List[Any]] = None,
+              poll_interval: float = 1.,
+              channel: Optional[str] = None,
+              batch_size: int = 1000) -> Generator:
+        """Yield changes as they happen, from `token` onwards, indefinitely.
+
+        Polls `changes_since` every `poll_interval` seconds. If `channel` is
+        given, it also LISTENs on it, and polls as soon as it is notified, e.g.
+        by a trigger that calls `pg_notify(channel, '')` on write.
+
+        Yields:
+          Tuples of (token, item), as `changes_since`.
+        """
+        listen_conn = None
+        if channel:
+            listen_conn = self.connection_factory()
+            listen_conn.autocommit = True
+            with listen_conn.cursor() as cursor:
+                cursor.execute(f'LISTEN {channel};')
+        try:
+            while True:
+                num_changes = 0
+                for token, item in self.changes_since(token, batch_size):
+                    num_changes += 1
+                    yield token, item
+                if num_changes == batch_size:
+                    continue
+                if listen_conn:
+                    self._wait_for_notify(listen_conn, poll_interval)
+                else:
+                    time.sleep(poll_interval)
+        finally:
+            if listen_conn:
+                listen_conn.close()
@@ -0,0 +1,276 @@
+from contextlib import contextmanager
+import threading
+from typing import Any, BinaryIO, Dict, Iterable, List, Optional, \
+    Tuple
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+from psycopg.errors import QueryCanceled
+from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool, PoolTimeout
+
+from dbi_repositories import postgres, profiling
+from dbi_repositories.base import DeadlineExceeded
+
+
+"""
+PostgresRepository on psycopg 3, with the same API as `postgres`.
+
+Swap the imports of `ConnectionFactory` and `PostgresRepository` from
+`dbi_repositories.postgres` to `dbi_repositories.postgres3` to use it. The
+differences are underneath:
+  * connections come from a `psycopg_pool.ConnectionPool` per database,
+  * the `*_many` writes are sent in pipeline mode, without a round trip per
+    statement,
+  * plain inserts in `add_many` and `load_parallel` use binary COPY,
+  * results use the binary protocol.
+
+Errors are psycopg's, e.g. `psycopg.errors.UniqueViolation`.
+
+Ref:
+https://www.psycopg.org/psycopg3/docs/advanced/pipeline.html
+"""
+
+
+# NOTE: bytes read from a file per write in `COPY ... FROM STDIN`.
+COPY_BUFFER_SIZE = 2 ** 16
+
+
+class ConnectionFactory:
+    """Makes pooled psycopg 3 connections.
+
+    Replicas aren't supported; `read_only` connections go to the primary.
+    """
+
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 user: str,
+                 password: str,
+                 db_name: str,
+                 ssl: bool = False,
+                 connect_timeout: Optional[int] = None,
+                 min_size: int = 1,
+                 max_size: int = 10,
+                 pool_timeout: float = 30.):
+        """Create a new ConnectionFactory.
+
+        Args:
+          min_size: int, connections each pool keeps open.
+          max_size: int, maximum connections per pool.
+          pool_timeout: float, seconds to wait for a free pooled connection.
+        """
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.db_name = db_name
+        self.ssl = ssl
+        self.connect_timeout = connect_timeout
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool_timeout = pool_timeout
+        self._pools: Dict[str, ConnectionPool] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, db_name: Optional[str] = None) -> psycopg.Connection:
+        """A new, unpooled connection, which the caller must close."""
+        conn = psycopg.connect(self._get_conninfo(db_name))
+        self._record_connection(conn)
+        return conn
+
+    def _get_conninfo(self, db_name: Optional[str] = None) -> str:
+        kwargs = {}
+        if self.connect_timeout:
+            kwargs['connect_timeout'] = self.connect_timeout
+        return make_conninfo(
+            host=self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            dbname=db_name or self.db_name,
+            sslmode='require' if self.ssl else 'allow',
+            **kwargs)
+
+    @staticmethod
+    def _record_connection(conn: psycopg.Connection) -> None:
+        info = conn.info
+        profiling.record_connection(
+            'postgres', f'{info.host}:{info.port}/{info.dbname}')
+
+    def close(self) -> None:
+        """Close all pools."""
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools.clear()
+
+    @contextmanager
+    def connection(self,
+                   db_name: Optional[str] = None,
+                   read_only: bool = False):
+        """Context yielding a pooled connection in a transaction.
+
+        The transaction commits on exit, or rolls back on error, and the
+        connection goes back to the pool.
+        """
+        try:
+            with self.pool(db_name).connection(timeout=self.pool_timeout) \
+                    as conn:
+                yield conn
+        except PoolTimeout as e:
+            raise DeadlineExceeded(
+                f'No pooled connection free after {self.pool_timeout}s.') \
+                from e
+
+    def pool(self, db_name: Optional[str] = None) -> ConnectionPool:
+        """Get the pool for a database, opening it if necessary."""
+        db_name = db_name or self.db_name
+        with self._lock:
+            if db_name not in self._pools:
+                self._pools[db_name] = ConnectionPool(
+                    self._get_conninfo(db_name),
+                    min_size=self.min_size,
+                    max_size=self.max_size,
+                    configure=self._record_connection,
+                    open=True)
+            return self._pools[db_name]
+
+
+class PostgresRepository(postgres.PostgresRepository):
+    """Base Postgres repository on psycopg 3. See `postgres`."""
+
+    def __init__(self,
+                 connection_factory: ConnectionFactory,
+                 table_name: str,
+                 primary_keys: List[str],
+                 **kwargs):
+        super().__init__(
+            connection_factory=connection_factory,
+            table_name=table_name,
+            primary_keys=primary_keys,
+            **kwargs)
+        self._column_types = None
+
+    @contextmanager
+    def _transaction(self,
+                     timeout: Optional[float] = None,
+                     read_only: bool = False):
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            with self.connection_factory.connection(read_only=read_only) \
+                    as conn:
+                conn = profiling.wrap_connection(conn, self.table_name)
+                if timeout:
+                    self._set_statement_timeout(conn, timeout)
+                yield conn
+        except QueryCanceled as e:
+            # NOTE: without a timeout, the cancel came from elsewhere, e.g.
+            # `pg_cancel_backend` or Ctrl-C.
+            if not timeout:
+                raise
+            raise DeadlineExceeded(
+                f'Statement on {self.table_name} took longer than '
+                f'{timeout}s.') from e
+
+    @staticmethod
+    def _cursor(conn: psycopg.Connection) -> psycopg.Cursor:
+        return conn.cursor(row_factory=dict_row, binary=True)
+
+    @staticmethod
+    def _copy_from(cursor: psycopg.Cursor, sql: str, file: BinaryIO) -> int:
+        with cursor.copy(sql) as copy:
+            for data in iter(lambda: file.read(COPY_BUFFER_SIZE), b''):
+                copy.write(data)
+        return cursor.rowcount
+
+    @staticmethod
+    def _copy_to(cursor: psycopg.Cursor, sql: str, file: BinaryIO) -> int:
+        with cursor.copy(sql) as copy:
+            for data in copy:
+                file.write(data)
+        return cursor.rowcount
+
+    @staticmethod
+    def _execute_each(cursor: psycopg.Cursor,
+                      statements: Iterable[Tuple[str, List[Any]]]) -> None:
+        # NOTE: in pipeline mode statements are sent without waiting for each
+        # result; errors surface when the pipeline syncs on exit.
+        with cursor.connection.pipeline():
+            for sql, values in statements:
+                cursor.execute(sql, values)
+
+    @staticmethod
+    def _wait_for_notify(conn: psycopg.Connection, timeout: float) -> None:
+        for _ in conn.notifies(timeout=timeout, stop_after=1):
+            pass
+
+    def _copy_rows(self,
+                   cursor: psycopg.Cursor,
+                   columns: List[str],
+                   rows: List[Tuple]) -> int:
+        """Insert rows with binary COPY.
+
+        Returns:
+          Int, the number of rows copied.
+        """
+        column_types = self._get_column_types(cursor)
+        sql = f'COPY {self.table_name} ({",".join(columns)}) ' \
+              f'FROM STDIN (FORMAT BINARY)'
+        with cursor.copy(sql) as copy:
+            # NOTE: binary COPY needs the exact column types, e.g. int4 rather
+            # than the int8 a Python int would be sent as.
+            copy.set_types([column_types[x] for x in columns])
+            for row in rows:
+                copy.write_row(row)
+        return len(rows)
+
+    def _get_column_types(self, cursor: psycopg.Cursor) -> Dict[str, int]:
+        """Map of column name to type oid, cached after the first call."""
+        if self._column_types is None:
+            with cursor.connection.cursor() as types_cursor:
+                types_cursor.execute(
+                    'SELECT attname, atttypid::int FROM pg_attribute '
+                    'WHERE attrelid = %s::regclass '
+                    'AND attnum > 0 AND NOT attisdropped;',
+                    [self.table_name])
+                self._column_types = dict(types_cursor.fetchall())
+        return self._column_types
+
+    def _write_values(self,
+                      cursor: psycopg.Cursor,
+                      items: List[Dict],
+                      on_conflict: str = 'error') -> int:
+        num_rows = 0
+        for columns, rows in self._get_value_rows(items, on_conflict):
+            if on_conflict == 'error':
+                num_rows += self._copy_rows(cursor, columns, rows)
+                continue
+            # NOTE: executemany pipelines the statements.
+            sql = self._get_values_insert_sql(columns, on_conflict)
+            placeholders = ','.join(['%s'] * len(columns))
+            sql = sql.replace('VALUES %s', f'VALUES ({placeholders})')
+            cursor.executemany(sql, rows)
+            num_rows += cursor.rowcount
+        return num_rows
+
+    def _fetch_skip_unchanged_upsert(self,
+                                     cursor: psycopg.Cursor,
+                                     columns: List[str],
+                                     rows: List[Tuple]) -> List[Dict]:
+        placeholders = ','.join(['%s'] * len(columns))
+        sql = f'INSERT INTO {self.table_name} AS tn ' \
+              f'({",".join(columns)}) VALUES ({placeholders})'
+        sql += self._get_skip_unchanged_upsert_sql(
+            update_keys=[k for k in columns if k not in self.primary_keys])
+        # NOTE: executemany pipelines the statements, keeping each result.
+        cursor.executemany(sql, rows, returning=True)
+        results = []
+        while True:
+            results += cursor.fetchall()
+            if not cursor.nextset():
+                return results
+
+    def dispose(self):
+        self.connection_factory.close()
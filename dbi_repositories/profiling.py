@@ -0,0 +1,254 @@
+from collections import Counter
+from contextlib import contextmanager
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Generator, List, NamedTuple, \
+    Optional, Tuple
+
+
+"""
+Profiling of database round trips, to find N+1 query patterns, e.g. `get`
+called in a loop.
+
+    with profiling.profile():
+        for tweet_id in tweet_ids:
+            repo.get(tweet_id)
+
+Round trips from any PostgresRepository, and from MongoRepositories whose
+client came from `mongo.get_client(..., profile=True)`, are recorded while any
+profiler is active, in any thread. Outside `profile` the only cost for
+Postgres is a check of an empty list. Mongo clients with `profile=True` have
+pymongo build an event per command even then, so only ask for it where
+needed.
+"""
+
+
+# NOTE: statement shapes repeated at least this many times are flagged.
+N_PLUS_ONE_THRESHOLD = 5
+
+# NOTE: (backend, shape prefix, method); the first match gives the suggestion
+# for a repeated shape.
+SUGGESTIONS = [
+    ('postgres', 'INSERT', 'add_many or upsert_many'),
+    ('postgres', 'UPDATE', 'update_many'),
+    ('postgres', 'DELETE', 'delete_many'),
+    ('postgres', 'SELECT', 'get_many, or a dataloader.Dataloader for '
+                           'concurrent lookups'),
+    ('mongo', 'insert', 'add_many'),
+    ('mongo', 'update', 'update_attributes_many'),
+    ('mongo', 'find', 'get_many, or a dataloader.Dataloader for '
+                      'concurrent lookups'),
+]
+
+_profilers = []
+_profilers_lock = threading.Lock()
+
+
+class RoundTrip(NamedTuple):
+    backend: str
+    target: str
+    shape: str
+    seconds: float
+    rows: Optional[int]
+
+
+class Profiler:
+    """Records round trips and connections while active. See `profile`."""
+
+    def __init__(self, threshold: int = N_PLUS_ONE_THRESHOLD):
+        self.threshold = threshold
+        self.round_trips: List[RoundTrip] = []
+        self.connections: List[Tuple[str, str]] = []
+        self._lock = threading.Lock()
+
+    def record(self, round_trip: RoundTrip) -> None:
+        with self._lock:
+            self.round_trips.append(round_trip)
+
+    def record_connection(self, backend: str, target: str) -> None:
+        with self._lock:
+            self.connections.append((backend, target))
+
+    def repeated_shapes(self) -> List[Tuple[RoundTrip, int, Optional[str]]]:
+        """Shapes run at least `threshold` times, most frequent first.
+
+        Returns:
+          List of tuples of (an example round trip, count, suggested method).
+        """
+        counts = Counter((x.backend, x.target, x.shape)
+                         for x in self.round_trips)
+        examples = {(x.backend, x.target, x.shape): x
+                    for x in self.round_trips}
+        repeated = []
+        for key, count in counts.most_common():
+            if count < self.threshold:
+                break
+            backend, _, shape = key
+            suggestion = next((method for x, prefix, method in SUGGESTIONS
+                               if x == backend and shape.startswith(prefix)),
+                              None)
+            repeated.append((examples[key], count, suggestion))
+        return repeated
+
+    def summary(self) -> str:
+        """Totals per shape, slowest first, then any N+1 patterns."""
+        totals: Dict[Tuple[str, str, str], List[float]] = {}
+        for x in self.round_trips:
+            total = totals.setdefault((x.backend, x.target, x.shape),
+                                      [0, 0., 0])
+            total[0] += 1
+            total[1] += x.seconds
+            total[2] += x.rows or 0
+        seconds = sum(x.seconds for x in self.round_trips)
+        lines = [f'{len(self.round_trips)} round trips in {seconds:.3f}s, '
+                 f'{len(self.connections)} connections opened.']
+        for (backend, target, shape), (count, seconds, rows) in sorted(
+                totals.items(), key=lambda x: -x[1][1]):
+            lines.append(f'  {count:>6}x {seconds:8.3f}s {rows:>8} rows  '
+                         f'{backend} {target}: {shape}')
+        for round_trip, count, suggestion in self.repeated_shapes():
+            line = f'N+1: {count} round trips of the same shape on ' \
+                   f'{round_trip.target}: {round_trip.shape}'
+            if suggestion:
+                line += f' Consider {suggestion}.'
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+class ProfiledCursor:
+    """Proxy for a DB-API cursor that records each execute."""
+
+    def __init__(self, cursor: Any, target: str):
+        self._cursor = cursor
+        self._target = target
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._cursor.__exit__(*args)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _timed(self, method: Callable, sql: Any, *args, **kwargs) -> Any:
+        start = time.perf_counter()
+        try:
+            return method(sql, *args, **kwargs)
+        finally:
+            record('postgres', self._target, get_sql_shape(sql),
+                   time.perf_counter() - start, self._get_rowcount())
+
+    def _get_rowcount(self) -> Optional[int]:
+        rowcount = getattr(self._cursor, 'rowcount', -1)
+        return rowcount if rowcount >= 0 else None
+
+    @contextmanager
+    def copy(self, sql: Any, *args, **kwargs):
+        # NOTE: psycopg 3 COPY, timed from start to end of the block.
+        start = time.perf_counter()
+        try:
+            with self._cursor.copy(sql, *args, **kwargs) as copy:
+                yield copy
+        finally:
+            record('postgres', self._target, get_sql_shape(sql),
+                   time.perf_counter() - start, self._get_rowcount())
+
+    def copy_expert(self, sql: Any, *args, **kwargs) -> Any:
+        return self._timed(self._cursor.copy_expert, sql, *args, **kwargs)
+
+    def execute(self, sql: Any, *args, **kwargs) -> Any:
+        return self._timed(self._cursor.execute, sql, *args, **kwargs)
+
+    def executemany(self, sql: Any, *args, **kwargs) -> Any:
+        return self._timed(self._cursor.executemany, sql, *args, **kwargs)
+
+
+class ProfiledConnection:
+    """Proxy for a DB-API connection whose cursors are profiled."""
+
+    def __init__(self, conn: Any, target: str):
+        self._conn = conn
+        self._target = target
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+
+    def cursor(self, *args, **kwargs) -> ProfiledCursor:
+        return ProfiledCursor(self._conn.cursor(*args, **kwargs), self._target)
+
+
+def get_sql_shape(sql: Any) -> str:
+    """SQL with literals and parameters replaced by `?`, and repeated tuples,
+    e.g. from a multi-row VALUES, collapsed."""
+    if isinstance(sql, bytes):
+        sql = sql.decode(errors='replace')
+    elif not isinstance(sql, str):
+        # NOTE: e.g. a psycopg `sql.Composed`.
+        sql = str(sql)
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'%s|\$\d+|\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\s+', ' ', sql).strip()
+    sql = re.sub(r'ARRAY\[[^\]]*\]', '?', sql)
+    sql = re.sub(r'(\([^()]*\))(?:\s*,\s*\([^()]*\))+', r'\1, ...', sql)
+    return sql
+
+
+def is_profiling() -> bool:
+    return bool(_profilers)
+
+
+@contextmanager
+def profile(threshold: int = N_PLUS_ONE_THRESHOLD,
+            output: Optional[Callable[[str], Any]] = print) \
+        -> Generator[Profiler, None, None]:
+    """Record database round trips made inside the block, in any thread.
+
+    Args:
+      threshold: int, number of round trips of the same shape that is
+        flagged as an N+1 pattern.
+      output: Callable, optional, given the summary at the end, e.g. `print`
+        (the default) or `logging.info`.
+
+    Yields:
+      The Profiler, whose `round_trips` and `connections` can be inspected.
+    """
+    profiler = Profiler(threshold)
+    with _profilers_lock:
+        _profilers.append(profiler)
+    try:
+        yield profiler
+    finally:
+        with _profilers_lock:
+            _profilers.remove(profiler)
+        if output:
+            output(profiler.summary())
+
+
+def record(backend: str,
+           target: str,
+           shape: str,
+           seconds: float,
+           rows: Optional[int] = None) -> None:
+    """Record a round trip on all active profilers."""
+    round_trip = RoundTrip(backend, target, shape, seconds, rows)
+    for profiler in list(_profilers):
+        profiler.record(round_trip)
+
+
+def record_connection(backend: str, target: str) -> None:
+    """Record a connection opened on all active profilers."""
+    for profiler in list(_profilers):
+        profiler.record_connection(backend, target)
+
+
+def wrap_connection(conn: Any, target: str) -> Any:
+    """Profile the connection's cursors, if any profiler is active."""
+    if not _profilers:
+        return conn
+    return ProfiledConnection(conn, target)
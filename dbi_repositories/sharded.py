@@ -0,0 +1,318 @@
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import random
+import threading
+from typing import Any, Callable, Dict, Generator, List, Mapping, Optional, \
+    Union
+import zlib
+
+from dbi_repositories.base import Repository
+
+
+"""
+Hash sharding across several repositories of the same kind, e.g. the same
+table in several Postgres databases, or the same collection on several Mongo
+clients.
+"""
+
+
+class ShardedRepository(Repository):
+    """Routes calls to one of N underlying repositories by key.
+
+    Writes are routed by the hash of each item's key: the primary key for a
+    PostgresRepository, and `_id` (or `_id_attr`) for a MongoRepository. Calls
+    that identify a single key (`get`, `exists`, `delete`, ...) go to one
+    shard, and anything else (`all`, `search`, `count`, ...) is scattered to
+    all shards in parallel and the results gathered.
+
+    The shard of a key depends on the number of shards, so changing it means
+    moving the data.
+    """
+
+    def __init__(self,
+                 shards: List[Repository],
+                 key: Optional[Callable[[Mapping], Any]] = None,
+                 queue_size: int = 1000):
+        """Create a new ShardedRepository.
+
+        Args:
+          shards: List of Repositories, in a fixed order.
+          key: Callable, optional, getting the key of an item. Defaults to the
+            first shard's `_get_key`.
+          queue_size: int, maximum number of items buffered per scatter-gather
+            read.
+        """
+        super().__init__()
+        if not shards:
+            raise ValueError('At least one shard is required.')
+        self.shards = shards
+        self.key = key or shards[0]._get_key
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=len(shards))
+
+    def _get_call_key(self, *args, **kwargs) -> Any:
+        """Key of a lookup call, or None if it doesn't identify a single key.
+
+        A lookup identifies a key either positionally, e.g. `get(1)`, or with
+        all the key fields as keyword arguments, e.g. `get(tweet_id=1)`, or in
+        a conditions dict, e.g. `delete({'tweet_id': 1})`.
+        """
+        if args and not isinstance(args[0], Mapping):
+            return args[0]
+        conditions = args[0] if args else kwargs
+        try:
+            return self.key(conditions)
+        except (KeyError, ValueError):
+            return None
+
+    def _get_key(self, item: Mapping) -> Any:
+        return self.key(item)
+
+    def _get_shard_index(self, key: Any) -> int:
+        # NOTE: crc32 rather than hash(), which is salted per process for str.
+        return zlib.crc32(repr(key).encode()) % len(self.shards)
+
+    def _group_by_shard(self,
+                        items: List[Any],
+                        key: Optional[Callable[[Any], Any]] = None) \
+            -> Dict[int, List[Any]]:
+        key = key or self.key
+        groups = {}
+        for item in items:
+            index = self._get_shard_index(key(item))
+            groups.setdefault(index, []).append(item)
+        return groups
+
+    def _run_grouped(self,
+                     method: str,
+                     groups: Dict[int, List[Any]],
+                     *args,
+                     **kwargs) -> List[Any]:
+        futures = [self._executor.submit(
+                       getattr(self.shards[index], method), group,
+                       *args, **kwargs)
+                   for index, group in groups.items()]
+        return [x.result() for x in futures]
+
+    def _scatter(self, method: str, *args, **kwargs) -> List[Any]:
+        futures = [self._executor.submit(getattr(shard, method),
+                                         *args, **kwargs)
+                   for shard in self.shards]
+        return [x.result() for x in futures]
+
+    def _scatter_gather(self, method: str, *args, **kwargs) -> Generator:
+        """Stream the results of a generator method from all shards at once.
+
+        Each shard is read in its own thread into a bounded queue, so results
+        are yielded as they arrive, in no particular order.
+        """
+        results = queue.Queue(maxsize=self.queue_size)
+        done = object()
+        stop = threading.Event()
+
+        def read(shard):
+            try:
+                for item in getattr(shard, method)(*args, **kwargs):
+                    if stop.is_set():
+                        return
+                    results.put(item)
+            except Exception as e:
+                results.put(e)
+            finally:
+                results.put(done)
+
+        # NOTE: own threads rather than the executor, so a slow consumer can't
+        # starve point lookups of workers.
+        threads = [threading.Thread(target=read, args=(shard,), daemon=True)
+                   for shard in self.shards]
+        for thread in threads:
+            thread.start()
+        num_done = 0
+        try:
+            while num_done < len(self.shards):
+                item = results.get()
+                if item is done:
+                    num_done += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+            # NOTE: unblock any reader waiting on a full queue.
+            while any(x.is_alive() for x in threads):
+                try:
+                    results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def _route_or_scatter(self, method: str, *args, **kwargs) -> List[Any]:
+        key = self._get_call_key(*args, **kwargs)
+        if key is not None:
+            shard = self.shards[self._get_shard_index(key)]
+            return [getattr(shard, method)(*args, **kwargs)]
+        return self._scatter(method, *args, **kwargs)
+
+    def shard_for(self, item: Mapping) -> Repository:
+        """Get the shard an item belongs to."""
+        return self.shards[self._get_shard_index(self.key(item))]
+
+    def add(self, item: Mapping, *args, **kwargs):
+        return self.shard_for(item).add(item, *args, **kwargs)
+
+    def add_many(self, items: List[Mapping], *args, **kwargs) -> None:
+        self._run_grouped('add_many', self._group_by_shard(items),
+                          *args, **kwargs)
+
+    def aggregate(self,
+                  group_by: Optional[List[str]] = None,
+                  metrics: Optional[Dict[str, str]] = None,
+                  **kwargs) -> List[Dict]:
+        """Aggregate on every shard, and merge the groups.
+
+        The `avg` function isn't supported, since averages can't be merged.
+        """
+        group_by = group_by or []
+        metrics = self._get_metrics(metrics or {})
+        if any(function == 'avg' for _, _, function in metrics):
+            raise ValueError('avg can not be merged across shards; '
+                             'aggregate sum and count instead.')
+        shard_metrics = {field: function for _, field, function in metrics}
+
+        def read(shard):
+            return list(shard.aggregate(group_by, shard_metrics, **kwargs))
+
+        futures = [self._executor.submit(read, shard) for shard in self.shards]
+        results = [x.result() for x in futures]
+        groups = {}
+        for item in (x for shard_results in results for x in shard_results):
+            key = tuple(item[x] for x in group_by)
+            if key not in groups:
+                groups[key] = item
+                continue
+            group = groups[key]
+            for name, _, function in metrics:
+                values = [x for x in (group[name], item[name])
+                          if x is not None]
+                if not values:
+                    group[name] = None
+                elif function in ('count', 'sum'):
+                    group[name] = sum(values)
+                else:
+                    group[name] = min(values) if function == 'min' \
+                        else max(values)
+        try:
+            return [groups[x] for x in sorted(groups)]
+        except TypeError:
+            return list(groups.values())
+
+    def all(self, **kwargs) -> Generator:
+        return self._scatter_gather('all', **kwargs)
+
+    def commit(self):
+        self._scatter('commit')
+
+    def connect(self):
+        for shard in self.shards:
+            try:
+                shard.connect()
+            except NotImplementedError:
+                pass
+
+    def count(self, *args, **kwargs) -> int:
+        return sum(self._scatter('count', *args, **kwargs))
+
+    def delete(self, *args, **kwargs) -> None:
+        self._route_or_scatter('delete', *args, **kwargs)
+
+    def delete_many(self, conditions: List[Any], *args, **kwargs) -> int:
+        # NOTE: conditions that don't identify a key go to every shard.
+        routable = [x for x in conditions
+                    if self._get_call_key(x) is not None]
+        unroutable = [x for x in conditions
+                      if self._get_call_key(x) is None]
+        groups = self._group_by_shard(routable, key=self._get_call_key)
+        if unroutable:
+            for index in range(len(self.shards)):
+                groups.setdefault(index, []).extend(unroutable)
+        results = self._run_grouped('delete_many', groups, *args, **kwargs)
+        return sum(x or 0 for x in results)
+
+    def dispose(self):
+        for shard in self.shards:
+            try:
+                shard.dispose()
+            except NotImplementedError:
+                pass
+        self._executor.shutdown()
+
+    def ensure_indexes(self):
+        self._scatter('ensure_indexes')
+
+    def exists(self, *args, **kwargs) -> bool:
+        return any(self._route_or_scatter('exists', *args, **kwargs))
+
+    def get(self, *args, **kwargs):
+        results = self._route_or_scatter('get', *args, **kwargs)
+        return next((x for x in results if x is not None), None)
+
+    def get_many(self, keys: List[Any], *args, **kwargs) -> List[Any]:
+        groups = self._group_by_shard(keys, key=lambda x: x)
+        results = self._run_grouped('get_many', groups, *args, **kwargs)
+        items = {}
+        for group, result in zip(groups.values(), results):
+            items.update(zip(group, result))
+        return [items.get(x) for x in keys]
+
+    def sample(self,
+               size: Union[int, float],
+               seed: Optional[int] = None,
+               **kwargs) -> List[Any]:
+        """Sample every shard, and for a number of items, sample the union.
+
+        Each shard is asked for `size` items, so items on shards with fewer
+        matching items are over-represented compared to a true sample.
+        """
+        n, _ = self._get_sample_size(size)
+
+        def read(shard):
+            return list(shard.sample(size, seed, **kwargs))
+
+        futures = [self._executor.submit(read, shard) for shard in self.shards]
+        items = [x for future in futures for x in future.result()]
+        if n is None or len(items) <= n:
+            return items
+        return random.Random(seed).sample(items, n)
+
+    def search(self, *args, **kwargs) -> Generator:
+        return self._scatter_gather('search', *args, **kwargs)
+
+    def update(self, item: Mapping, *args, **kwargs):
+        return self.shard_for(item).update(item, *args, **kwargs)
+
+    def update_attributes(self, key: Any, **kwargs):
+        shard = self.shards[self._get_shard_index(key)]
+        return shard.update_attributes(key, **kwargs)
+
+    def update_attributes_many(self, updates: Mapping, **kwargs) -> int:
+        groups = {}
+        for key, attributes in updates.items():
+            index = self._get_shard_index(key)
+            groups.setdefault(index, {})[key] = attributes
+        return sum(self._run_grouped('update_attributes_many', groups,
+                                     **kwargs))
+
+    def update_many(self, items: List[Mapping], *args, **kwargs) -> None:
+        self._run_grouped('update_many', self._group_by_shard(items),
+                          *args, **kwargs)
+
+    def upsert(self, item: Mapping, *args, **kwargs):
+        return self.shard_for(item).upsert(item, *args, **kwargs)
+
+    def upsert_many(self, items: List[Mapping], *args, **kwargs):
+        results = self._run_grouped(
+            'upsert_many', self._group_by_shard(items), *args, **kwargs)
+        if results and all(isinstance(x, dict) for x in results):
+            # NOTE: sum the counts from `skip_unchanged` upserts.
+            return {k: sum(x[k] for x in results) for k in results[0]}
+        return None
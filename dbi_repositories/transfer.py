@@ -0,0 +1,167 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from dbi_repositories import util
+from dbi_repositories.base import Repository
+
+
+"""
+Streaming copies between repositories, e.g. raw tweets in a MongoRepository
+into a PostgresRepository table.
+"""
+
+
+def get_key_sort(source: Repository) -> Optional[List[Tuple[str, int]]]:
+    """Sort of `source.all` by key, or None if it can't be read in a fixed
+    order."""
+    if hasattr(source, 'shards'):
+        # NOTE: shards are read concurrently, so their items interleave.
+        return None
+    if getattr(source, 'primary_keys', None):
+        return [(k, 1) for k in source.primary_keys]
+    if hasattr(source, 'collection'):
+        return [('_id', 1)]
+    return None
+
+
+def read_checkpoint(checkpoint_path: Optional[str]) -> int:
+    """Get the number of source items already copied, or 0."""
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return 0
+    with open(checkpoint_path) as f:
+        return json.loads(f.read())['num_read']
+
+
+def write_checkpoint(checkpoint_path: str, num_read: int) -> None:
+    # NOTE: write then rename, so a crash never leaves a partial checkpoint.
+    temp_path = f'{checkpoint_path}.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(json.dumps({'num_read': num_read}))
+    os.replace(temp_path, checkpoint_path)
+
+
+def copy_repository(source: Repository,
+                    sink: Repository,
+                    transform: Optional[Callable] = None,
+                    batch_size: int = 1000,
+                    num_writers: int = 1,
+                    checkpoint_path: Optional[str] = None,
+                    write_method: str = 'add_many',
+                    read_kwargs: Optional[Dict] = None,
+                    write_kwargs: Optional[Dict] = None,
+                    report_every: float = 10.) -> Dict[str, float]:
+    """Stream all items from `source` into `sink`.
+
+    Items are read from `source.all` in batches of `batch_size`, transformed,
+    and written with `num_writers` threads. At most two batches per writer are
+    held in memory at any time.
+
+    If `checkpoint_path` is given, the number of source items whose batch (and
+    every batch before it) has been written is saved there, and a later call
+    with the same path skips that many items. This relies on `source.all`
+    returning items in the same order each time, so with a checkpoint they are
+    read in key order, unless `read_kwargs` has another `sort`; sources that
+    can't be read in a fixed order, like a ShardedRepository, are rejected.
+    Items added to the source before the checkpoint in that order shift it, so
+    don't resume over a source that has been written to. Batches after the
+    checkpoint may also have been written before a failure, so resume with an
+    idempotent `write_method`, like `upsert_many`. The file is removed when
+    the copy completes.
+
+    Args:
+      source: Repository to read from.
+      sink: Repository to write to.
+      transform: Callable, optional, mapping a source item to a sink item, or
+        to None to skip it.
+      batch_size: int, number of items per write.
+      num_writers: int, number of concurrent writes.
+      checkpoint_path: str, optional, file to save progress to.
+      write_method: str, name of the `sink` method to write batches with, e.g.
+        `add_many` or `upsert_many`.
+      read_kwargs: Dict, optional, passed to `source.all`.
+      write_kwargs: Dict, optional, passed to the write method.
+      report_every: float, seconds between throughput log messages.
+
+    Returns:
+      Dict with the number of items `read`, `written` and `skipped` by the
+        transform, the `seconds` taken, and `items_per_second` written.
+    """
+    write = getattr(sink, write_method)
+    read_kwargs = dict(read_kwargs or {})
+    if checkpoint_path and not read_kwargs.get('sort'):
+        sort = get_key_sort(source)
+        if sort is None:
+            raise ValueError(f'{type(source).__name__} cannot be read in a '
+                             f'fixed order, so cannot resume from a '
+                             f'checkpoint.')
+        read_kwargs['sort'] = sort
+    write_kwargs = write_kwargs or {}
+    num_done = read_checkpoint(checkpoint_path)
+    stats = {'read': 0, 'written': 0, 'skipped': 0}
+
+    def write_batch(batch):
+        if transform:
+            batch = [transform(x) for x in batch]
+            batch = [x for x in batch if x is not None]
+        if batch:
+            write(batch, **write_kwargs)
+        return len(batch)
+
+    def report():
+        seconds = time.perf_counter() - start
+        stats['seconds'] = seconds
+        stats['items_per_second'] = stats['written'] / seconds \
+            if seconds else 0.
+        logging.info(f'Copied {stats["written"]} items '
+                     f'({stats["items_per_second"]:.1f}/s).')
+
+    # NOTE: batches can finish out of order, so the checkpoint only advances
+    # over the contiguous run of finished batches from the start.
+    pending = {}
+    finished = {}
+    next_to_checkpoint = 0
+
+    def collect(done):
+        nonlocal num_done, next_to_checkpoint
+        for future in done:
+            index, num_items = pending.pop(future)
+            num_written = future.result()
+            stats['written'] += num_written
+            stats['skipped'] += num_items - num_written
+            finished[index] = num_items
+        advanced = False
+        while next_to_checkpoint in finished:
+            num_done += finished.pop(next_to_checkpoint)
+            next_to_checkpoint += 1
+            advanced = True
+        if checkpoint_path and advanced:
+            write_checkpoint(checkpoint_path, num_done)
+
+    start = time.perf_counter()
+    last_report = start
+    items = iter(source.all(**read_kwargs))
+    for _ in range(num_done):
+        if next(items, None) is None:
+            break
+    with ThreadPoolExecutor(max_workers=num_writers) as executor:
+        batches = util.iter_chunks(items, batch_size)
+        for index, batch in enumerate(batches):
+            stats['read'] += len(batch)
+            future = executor.submit(write_batch, batch)
+            pending[future] = (index, len(batch))
+            if len(pending) >= 2 * num_writers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            if time.perf_counter() - last_report >= report_every:
+                report()
+                last_report = time.perf_counter()
+        done, _ = wait(pending)
+        collect(done)
+    report()
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return stats
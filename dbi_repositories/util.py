@@ -1,7 +1,115 @@
+import bz2
+import gzip
+from itertools import islice
+import lzma
 import time
-from typing import List
+from typing import Any, BinaryIO, Callable, Generator, Iterable, List, \
+    Optional
 
-import psycopg2
+
+# NOTE: compression for `dump` and `load`, keyed by name, with the file
+# extension it is inferred from.
+COMPRESSIONS = {
+    'gzip': ('.gz', gzip.open),
+    'bz2': ('.bz2', bz2.open),
+    'lzma': ('.xz', lzma.open),
+}
+
+
+class AdaptiveChunker:
+    """Splits items into chunks sized by encoded bytes and observed latency.
+
+    A chunk is cut when it reaches `target_bytes`, or the current item limit.
+    The item limit starts at `initial_items`, and after each full chunk it is
+    scaled towards the number of items that would take `target_seconds`,
+    measured as the time the consumer takes before asking for the next chunk,
+    i.e. to write it. It changes by at most a factor of 2 per chunk.
+
+    A single item over `target_bytes` is still sent, alone. `max_bytes` is the
+    server's hard limit, which `target_bytes` is capped at.
+    """
+
+    def __init__(self,
+                 size_of: Callable[[Any], int],
+                 target_bytes: int = 4 * 2 ** 20,
+                 target_seconds: float = 0.5,
+                 max_bytes: Optional[int] = None,
+                 initial_items: int = 1000,
+                 min_items: int = 1,
+                 max_items: int = 100000):
+        """Create a new AdaptiveChunker.
+
+        Args:
+          size_of: Callable, giving the (estimated) encoded bytes of an item.
+          target_bytes: int, payload per chunk to aim for.
+          target_seconds: float, time per chunk to aim for.
+          max_bytes: int, optional, payload per chunk never to exceed.
+          initial_items: int, item limit of the first chunk.
+          min_items: int, least the item limit can fall to.
+          max_items: int, most the item limit can rise to.
+        """
+        self.size_of = size_of
+        self.target_bytes = min(target_bytes, max_bytes or target_bytes)
+        self.target_seconds = target_seconds
+        self.min_items = min_items
+        self.max_items = max_items
+        self.item_limit = initial_items
+        self.stats = {
+            'chunks': 0,
+            'items': 0,
+            'bytes': 0,
+            'seconds': 0.,
+            'item_limit': initial_items,
+            'last_chunk_items': 0,
+            'last_chunk_bytes': 0,
+            'min_chunk_items': None,
+            'max_chunk_items': None,
+        }
+
+    def _observe(self,
+                 num_items: int,
+                 num_bytes: int,
+                 seconds: float,
+                 full: bool) -> None:
+        stats = self.stats
+        stats['chunks'] += 1
+        stats['items'] += num_items
+        stats['bytes'] += num_bytes
+        stats['seconds'] += seconds
+        stats['last_chunk_items'] = num_items
+        stats['last_chunk_bytes'] = num_bytes
+        stats['min_chunk_items'] = min(stats['min_chunk_items'] or num_items,
+                                       num_items)
+        stats['max_chunk_items'] = max(stats['max_chunk_items'] or num_items,
+                                       num_items)
+        # NOTE: the last, partial chunk says little about the right size.
+        if full and seconds > 0:
+            factor = min(2., max(0.5, self.target_seconds / seconds))
+            self.item_limit = int(min(self.max_items, max(
+                self.min_items, num_items * factor)))
+            stats['item_limit'] = self.item_limit
+
+    def chunks(self, items: Iterable) -> Generator[List, None, None]:
+        """Yield chunks of items; consume each before asking for the next."""
+        chunk = []
+        chunk_bytes = 0
+        for item in items:
+            size = self.size_of(item)
+            if chunk and (len(chunk) >= self.item_limit
+                          or chunk_bytes + size > self.target_bytes):
+                start = time.perf_counter()
+                yield chunk
+                self._observe(len(chunk), chunk_bytes,
+                              time.perf_counter() - start, full=True)
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(item)
+            chunk_bytes += size
+        if chunk:
+            start = time.perf_counter()
+            yield chunk
+            self._observe(len(chunk), chunk_bytes,
+                          time.perf_counter() - start, full=False)
 
 
 def get_chunks(items: List, n: int):
@@ -13,7 +121,46 @@ def get_chunks(items: List, n: int):
         yield items[i:i + n]
 
 
+def iter_chunks(items: Iterable, n: int) -> Generator[List, None, None]:
+    """Yield successive n-sized chunks from any iterable, e.g. a generator.
+
+    Only one chunk is held in memory at a time.
+    """
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+def open_file(path: str,
+              mode: str,
+              compress: Optional[str] = None) -> BinaryIO:
+    """Open a file in binary mode, through a compressor if needed.
+
+    Args:
+      path: str.
+      mode: str, `rb` or `wb`.
+      compress: str, optional, one of `COMPRESSIONS`. If None, it is inferred
+        from the extension of `path`, e.g. `.gz` for gzip.
+    """
+    if compress is None:
+        compress = next((name for name, (extension, _) in COMPRESSIONS.items()
+                         if path.endswith(extension)), None)
+    if compress is None:
+        return open(path, mode)
+    if compress not in COMPRESSIONS:
+        raise ValueError(f'Unexpected compress: {compress}. '
+                         f'Expected one of {list(COMPRESSIONS)}.')
+    return COMPRESSIONS[compress][1](path, mode)
+
+
 def wait_for_pgsql(connection_factory, sleep_for: float = 0.1):
+    # NOTE: imported here so that importing util (e.g. from the mongo module)
+    # doesn't load the psycopg2 C extension.
+    import psycopg2
+
     ready = False
     while not ready:
         try:
@@ -3,8 +3,17 @@ import setuptools
 
 with open('version') as f:
     version = f.read().strip()
-with open('requirements.txt') as f:
-    required = f.read().splitlines()
+
+# NOTE: each backend's driver is an optional extra, e.g.
+# `pip install dbi_repositories[mongo]`; requirements.txt pins everything for
+# the test image.
+extras_require = {
+    'mongo': ['pymongo>=4.2', 'pydash'],
+    'postgres': ['psycopg2-binary'],
+    'postgres3': ['psycopg[binary]>=3.2', 'psycopg_pool'],
+}
+extras_require['all'] = sorted(
+    set(x for reqs in extras_require.values() for x in reqs))
 
 
 setuptools.setup(
@@ -16,4 +25,5 @@ setuptools.setup(
     url=f'https://github.com/timniven/dbi-repositories.git#{version}',
     packages=setuptools.find_packages(),
     python_requires='>=3.8',
-    install_requires=required)
+    install_requires=[],
+    extras_require=extras_require)
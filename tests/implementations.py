@@ -3,8 +3,8 @@ import os
 from typing import Dict, Optional, List
 
 from dbi_repositories.mongo import get_client, MongoRepository
-from dbi_repositories.postgres import ConnectionFactory, create_db, \
-    PostgresRepository
+from dbi_repositories.postgres import ConnectionFactory, PostgresRepository, \
+    recycle_db
 
 
 with open('docker/provisions/postgres/startup/test_schema.sql') as f:
@@ -22,8 +22,10 @@ def get_test_connection_factory(db_name: str = os.environ['PGSQL_DB_NAME']) \
 
 
 def create_test_database(db_name: str, schema: str = test_schema):
+    # NOTE: cloned from a template built once from the schema, and replaced if
+    # left over from a previous run.
     connection_factory = get_test_connection_factory()
-    create_db(connection_factory, db_name, schema)
+    recycle_db(connection_factory, db_name, schema)
 
 
 class TweetPgsqlRepository(PostgresRepository):
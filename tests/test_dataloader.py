@@ -0,0 +1,82 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import unittest
+
+from dbi_repositories import profiling
+from dbi_repositories.dataloader import Dataloader
+from tests.implementations import create_test_database, \
+    TweetMongoRepository, TweetPgsqlRepository
+
+
+class TestDataloader(unittest.TestCase):
+
+    def get_postgres_repo(self, db_name: str):
+        create_test_database(db_name)
+        repo = TweetPgsqlRepository(db_name=db_name)
+        repo.add_many([{'tweet_id': i, 'tweet': f'tweet{i}'}
+                       for i in range(10)])
+        return repo
+
+    def test_concurrent_gets_are_batched(self):
+        repo = self.get_postgres_repo('test_concurrent_gets_are_batched')
+        loader = Dataloader(repo, window=0.1)
+        with profiling.profile(output=None) as profiler, \
+                ThreadPoolExecutor(max_workers=20) as executor:
+            tweet_ids = [i % 12 for i in range(20)]
+            items = list(executor.map(
+                lambda x: loader.get(tweet_id=x), tweet_ids))
+        self.assertEqual([x if x < 10 else None for x in tweet_ids],
+                         [x and x['tweet_id'] for x in items])
+        selects = [x for x in profiler.round_trips
+                   if '_key_index' in x.shape]
+        self.assertEqual(1, len(selects))
+
+    def test_max_batch_size_splits_batches(self):
+        repo = self.get_postgres_repo('test_max_batch_size_splits_batches')
+        loader = Dataloader(repo, window=0.5, max_batch_size=5)
+        with profiling.profile(output=None) as profiler, \
+                ThreadPoolExecutor(max_workers=10) as executor:
+            results = list(executor.map(
+                lambda x: loader.exists(tweet_id=x), range(10)))
+        self.assertTrue(all(results))
+        selects = [x for x in profiler.round_trips
+                   if '_key_index' in x.shape]
+        self.assertEqual(2, len(selects))
+
+    def test_errors_reach_every_caller(self):
+        repo = self.get_postgres_repo('test_errors_reach_every_caller')
+        repo.table_name = 'missing'
+        loader = Dataloader(repo, window=0.1)
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [executor.submit(loader.get, tweet_id=x)
+                       for x in range(3)]
+        for future in futures:
+            self.assertIsNotNone(future.exception())
+
+    def test_lookup_with_other_conditions_raises(self):
+        repo = self.get_postgres_repo(
+            'test_lookup_with_other_conditions_raises')
+        loader = Dataloader(repo, window=0.01)
+        with self.assertRaises(ValueError):
+            loader.get(tweet_id=1, label='zzz')
+        with self.assertRaises(ValueError):
+            loader.exists(tweet_id=1, label='zzz')
+        self.assertTrue(loader.exists(tweet_id=1, label=None))
+
+    def test_lookup_without_key_raises(self):
+        loader = Dataloader(TweetMongoRepository('test_lookup_without_key'))
+        with self.assertRaises(ValueError):
+            loader.get(text='tweet1')
+
+    def test_mongo_get_async(self):
+        repo = TweetMongoRepository('test_mongo_get_async')
+        repo.collection.drop()
+        repo.add_many([{'id': i, 'text': f'tweet{i}'} for i in range(3)])
+        loader = Dataloader(repo, window=0.1)
+
+        async def get_all():
+            return await asyncio.gather(
+                *[loader.get_async(x) for x in [0, 1, 1, 5]])
+
+        items = asyncio.run(get_all())
+        self.assertEqual([0, 1, 1, None], [x and x['_id'] for x in items])
@@ -0,0 +1,58 @@
+import subprocess
+import sys
+import unittest
+
+
+def import_in_subprocess(module: str):
+    """Import `module` in a fresh interpreter.
+
+    Returns:
+      Tuple of the import time in seconds, and the set of top level modules
+        loaded by the import.
+    """
+    code = f'import sys, time\n' \
+           f'before = set(sys.modules)\n' \
+           f'start = time.perf_counter()\n' \
+           f'import {module}\n' \
+           f'took = time.perf_counter() - start\n' \
+           f'loaded = set(x.split(".")[0] for x in set(sys.modules) - before)\n' \
+           f'print(took)\n' \
+           f'print(",".join(sorted(loaded)))\n'
+    output = subprocess.check_output([sys.executable, '-c', code], text=True)
+    took, loaded = output.strip().split('\n')
+    return float(took), set(loaded.split(','))
+
+
+class TestImports(unittest.TestCase):
+
+    def test_import_base_loads_no_drivers(self):
+        took, loaded = import_in_subprocess('dbi_repositories.base')
+        print(f'import dbi_repositories.base: {took * 1000:.1f}ms')
+        for driver in ['bson', 'psycopg2', 'pydash', 'pymongo']:
+            self.assertNotIn(driver, loaded)
+
+    def test_import_mongo_does_not_load_psycopg2(self):
+        took, loaded = import_in_subprocess('dbi_repositories.mongo')
+        print(f'import dbi_repositories.mongo: {took * 1000:.1f}ms')
+        self.assertIn('pymongo', loaded)
+        self.assertNotIn('psycopg2', loaded)
+
+    def test_import_postgres_does_not_load_pymongo(self):
+        took, loaded = import_in_subprocess('dbi_repositories.postgres')
+        print(f'import dbi_repositories.postgres: {took * 1000:.1f}ms')
+        self.assertIn('psycopg2', loaded)
+        self.assertNotIn('pymongo', loaded)
+        self.assertNotIn('pydash', loaded)
+
+    def test_missing_psycopg2_names_extra(self):
+        # NOTE: a None entry in sys.modules makes the import fail.
+        code = 'import sys\n' \
+               'sys.modules["psycopg2"] = None\n' \
+               'from dbi_repositories import postgres\n' \
+               'try:\n' \
+               '    postgres.get_connection("localhost", 5432, "", "", "")\n' \
+               'except ImportError as e:\n' \
+               '    print(e)\n'
+        output = subprocess.check_output(
+            [sys.executable, '-c', code], text=True)
+        self.assertIn('dbi_repositories[postgres]', output)
@@ -1,11 +1,89 @@
 import json
+import os
+import tempfile
 import unittest
 
+import bson
+from bson.raw_bson import RawBSONDocument
+from pymongo import ReadPreference
 from pymongo.errors import BulkWriteError, DuplicateKeyError
 
+from dbi_repositories import mongo, util
+from dbi_repositories.base import DeadlineExceeded, UnindexedQueryError
 from tests.implementations import TweetMongoRepository, WeiboMongoRepository
 
 
+def get_test_client(**kwargs):
+    return mongo.get_client(
+        host=os.environ['MONGO_HOST'],
+        port=int(os.environ['MONGO_PORT']),
+        username=os.environ['MONGO_USERNAME'],
+        password=os.environ['MONGO_PASSWORD'],
+        **kwargs)
+
+
+class TestGetClient(unittest.TestCase):
+
+    def test_repositories_share_client(self):
+        repo1 = TweetMongoRepository('test_repositories_share_client')
+        repo2 = WeiboMongoRepository('test_repositories_share_client')
+        self.assertIs(repo1.client, repo2.client)
+
+    def test_different_pool_size_gets_different_client(self):
+        client1 = get_test_client()
+        client2 = get_test_client(max_pool_size=5)
+        self.assertIsNot(client1, client2)
+        self.assertEqual(5, client2.options.pool_options.max_pool_size)
+
+    def test_unshared_client_is_new(self):
+        client1 = get_test_client()
+        client2 = get_test_client(shared=False)
+        self.assertIsNot(client1, client2)
+        client2.close()
+
+    def test_unhashable_options_share_client(self):
+        client1 = get_test_client(
+            authMechanismProperties={'SERVICE_NAME': 'mongodb'},
+            connect=False)
+        client2 = get_test_client(
+            authMechanismProperties={'SERVICE_NAME': 'mongodb'},
+            connect=False)
+        self.assertIs(client1, client2)
+
+    def test_forked_child_repository_gets_new_client(self):
+        repo = TweetMongoRepository('test_forked_child_repository')
+        client = repo.client
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            is_new = repo.client is not client \
+                and repo.collection.database.client is repo.client
+            os.write(write, b'1' if is_new else b'0')
+            os._exit(0)
+        os.close(write)
+        result = os.read(read, 1)
+        os.close(read)
+        os.waitpid(pid, 0)
+        self.assertEqual(b'1', result)
+        self.assertIs(client, repo.client)
+
+    def test_forked_child_gets_new_client(self):
+        client = get_test_client()
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            is_new = get_test_client() is not client
+            os.write(write, b'1' if is_new else b'0')
+            os._exit(0)
+        os.close(write)
+        result = os.read(read, 1)
+        os.close(read)
+        os.waitpid(pid, 0)
+        self.assertEqual(b'1', result)
+
+
 class TestMongoRepository(unittest.TestCase):
 
     def test_add(self):
@@ -192,3 +270,170 @@ class TestMongoRepository(unittest.TestCase):
         repo.upsert(tweet)
         result = repo.get(1)
         self.assertEqual('b', result['label'])
+
+    def test_all_raw_documents(self):
+        repo = TweetMongoRepository('test_all_raw_documents')
+        repo.add({'id': 1, 'text': 'tweet1'})
+        tweets = list(repo.all(raw='document'))
+        self.assertEqual(1, len(tweets))
+        self.assertIsInstance(tweets[0], RawBSONDocument)
+        self.assertEqual('tweet1', tweets[0]['text'])
+
+    def test_all_raw_bytes(self):
+        repo = TweetMongoRepository('test_all_raw_bytes')
+        repo.add({'id': 1, 'text': 'tweet1'})
+        tweets = list(repo.all(raw='bytes'))
+        self.assertEqual(1, len(tweets))
+        self.assertIsInstance(tweets[0], bytes)
+        expected = {'_id': 1, 'id': 1, 'text': 'tweet1'}
+        self.assertEqual(expected, bson.decode(tweets[0]))
+
+    def test_search_with_read_options(self):
+        repo = TweetMongoRepository('test_search_with_read_options')
+        repo.add({'id': 1, 'text': 'tweet1', 'label': 'a'})
+        repo.add({'id': 2, 'text': 'tweet2', 'label': 'a'})
+        repo.add({'id': 3, 'text': 'tweet3', 'label': 'b'})
+        tweets = list(repo.search(
+            label='a',
+            projection=['text'],
+            sort=[('id', -1)],
+            batch_size=1))
+        expected = [
+            {'_id': 2, 'text': 'tweet2'},
+            {'_id': 1, 'text': 'tweet1'},
+        ]
+        self.assertEqual(expected, tweets)
+
+    def test_ensure_indexes(self):
+        repo = TweetMongoRepository('test_ensure_indexes')
+        repo.indexes = ['label', [('text', 1), ('label', 1)]]
+        repo.ensure_indexes()
+        names = set(repo.collection.index_information().keys())
+        self.assertIn('label_1', names)
+        self.assertIn('text_1_label_1', names)
+
+    def test_index_check_raises_on_unindexed_filter(self):
+        repo = TweetMongoRepository('test_index_check_raises')
+        repo.indexes = ['label']
+        repo.index_check = 'raise'
+        _ = list(repo.search(label='a'))
+        self.assertFalse(repo.exists(_id=1))
+        with self.assertRaises(UnindexedQueryError):
+            _ = list(repo.search(text='tweet1'))
+
+    def test_timeout_raises_deadline_exceeded(self):
+        repo = TweetMongoRepository('test_timeout_raises_deadline_exceeded')
+        repo.add({'id': 1, 'text': 'tweet1'})
+        slow_filter = {'$where': 'sleep(1000) || true'}
+        with self.assertRaises(DeadlineExceeded):
+            _ = list(repo.search(timeout=0.1, **slow_filter))
+        tweets = list(repo.search(timeout=5, **slow_filter))
+        self.assertEqual(1, len(tweets))
+
+    def test_write_timeout_raises_deadline_exceeded(self):
+        repo = TweetMongoRepository(
+            'test_write_timeout_raises_deadline_exceeded')
+        repo.collection.drop()
+        with self.assertRaises(DeadlineExceeded):
+            repo.add({'id': 1, 'text': 'tweet1'}, timeout=1e-6)
+        with self.assertRaises(DeadlineExceeded):
+            repo.add_many([{'id': 2, 'text': 'tweet2'}], timeout=1e-6)
+        repo.add({'id': 3, 'text': 'tweet3'}, timeout=5)
+        self.assertTrue(repo.exists(_id=3))
+
+    def test_read_preference_per_operation(self):
+        repo = TweetMongoRepository('test_read_preference_per_operation')
+        repo.add({'id': 1, 'text': 'tweet1', 'label': 'a'})
+        read_preference = ReadPreference.PRIMARY_PREFERRED
+        tweets = list(repo.search(label='a', read_preference=read_preference))
+        self.assertEqual(1, len(tweets))
+        self.assertIsNotNone(repo.get(1, read_preference=read_preference))
+        self.assertTrue(repo.exists(_id=1, read_preference=read_preference))
+        self.assertEqual(1, repo.count(read_preference=read_preference))
+
+    def test_update_attributes_many(self):
+        repo = TweetMongoRepository('test_update_attributes_many')
+        repo.add_many([
+            {'id': 1, 'text': 'tweet1', 'label': 'a'},
+            {'id': 2, 'text': 'tweet2', 'label': 'a'},
+            {'id': 3, 'text': 'tweet3', 'label': 'a'},
+        ])
+        modified = repo.update_attributes_many({
+            1: {'label': 'b', 'lang': 'en'},
+            2: {'label': 'b', 'lang': 'en'},
+            3: {'label': 'c'},
+        })
+        self.assertEqual(3, modified)
+        self.assertEqual('b', repo.get(1)['label'])
+        self.assertEqual('en', repo.get(2)['lang'])
+        self.assertEqual('c', repo.get(3)['label'])
+        self.assertNotIn('lang', repo.get(3))
+
+    def test_aggregate(self):
+        repo = TweetMongoRepository('test_aggregate')
+        repo.collection.drop()
+        repo.add_many([
+            {'id': i, 'label': 'a' if i < 3 else 'b', 'user': {'lang': 'en'},
+             'num_likes': i}
+            for i in range(5)])
+        results = list(repo.aggregate(
+            group_by=['label', 'user.lang'],
+            metrics={'num_likes': 'sum', '*': 'count'}))
+        expected = [
+            {'label': 'a', 'user.lang': 'en', 'num_likes_sum': 3, 'count': 3},
+            {'label': 'b', 'user.lang': 'en', 'num_likes_sum': 7, 'count': 2},
+        ]
+        self.assertEqual(expected, results)
+        results = list(repo.aggregate(
+            metrics={'num_likes': 'max'}, label='a'))
+        self.assertEqual([{'num_likes_max': 2}], results)
+
+    def test_sample(self):
+        repo = TweetMongoRepository('test_sample')
+        repo.collection.drop()
+        repo.add_many([{'id': i, 'label': 'a' if i < 5 else 'b'}
+                       for i in range(10)])
+        sample = list(repo.sample(3))
+        self.assertEqual(3, len(set(x['_id'] for x in sample)))
+        sample = list(repo.sample(0.5, label='a'))
+        self.assertTrue(1 <= len(sample) <= 3)
+        self.assertEqual({'a'}, set(x['label'] for x in sample))
+        with self.assertRaises(ValueError):
+            repo.sample(3, seed=1)
+
+    def test_get_many(self):
+        repo = TweetMongoRepository('test_get_many')
+        repo.collection.drop()
+        repo.add_many([{'id': i, 'text': f'tweet{i}'} for i in range(3)])
+        items = repo.get_many([2, 5, 0, 2])
+        self.assertEqual([2, None, 0, 2], [x and x['_id'] for x in items])
+        items = repo.get_many([1], projection=['text'])
+        self.assertEqual([{'_id': 1, 'text': 'tweet1'}], items)
+
+    def test_dump_and_load(self):
+        repo = TweetMongoRepository('test_dump_and_load')
+        repo.collection.drop()
+        tweets = [{'_id': i, 'id': i, 'text': f'tweet{i}',
+                   'user': {'followers': 2 ** 40}}
+                  for i in range(10)]
+        repo.add_many(tweets)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'tweets.jsonl.gz')
+            self.assertEqual(10, repo.dump(path))
+            for i in range(5):
+                repo.delete(i)
+            self.assertEqual(5, repo.load(path))
+            self.assertEqual(tweets, list(repo.all(sort=[('_id', 1)])))
+            self.assertEqual(10, repo.load(path, on_conflict='upsert'))
+            with self.assertRaises(BulkWriteError):
+                repo.load(path, on_conflict='error')
+
+    def test_add_many_adaptive_chunking(self):
+        repo = TweetMongoRepository('test_add_many_adaptive_chunking')
+        repo.collection.drop()
+        repo.chunker = util.AdaptiveChunker(
+            size_of=repo._get_encoded_size, target_bytes=2 ** 16)
+        repo.add_many([{'id': i, 'text': 'x' * 2 ** 12} for i in range(100)])
+        self.assertEqual(100, repo.count())
+        self.assertEqual(100, repo.chunk_stats['items'])
+        self.assertTrue(repo.chunk_stats['max_chunk_items'] < 16)
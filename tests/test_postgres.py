@@ -1,9 +1,18 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import itertools
+import os
+import tempfile
 import unittest
 
-from psycopg2.errors import UniqueViolation
+from psycopg2.errors import QueryCanceled, UniqueViolation
+from psycopg2.extras import Json
 
-from tests.implementations import create_test_database, TweetPgsqlRepository, \
+from dbi_repositories import profiling
+from dbi_repositories.base import DeadlineExceeded, UnindexedQueryError
+from dbi_repositories.postgres import ConnectionFactory, create_db, \
+    DatabasePool, drop_db, get_template_name, PostgresRepository
+from tests.implementations import create_test_database, \
+    get_test_connection_factory, test_schema, TweetPgsqlRepository, \
     TweetStatsRepository
 
 
@@ -18,6 +27,229 @@ class TestItemToInsertStatement(unittest.TestCase):
         sql, _ = repo._item_to_insert_statement(item, upsert=True)
         self.assertIn('SET num_likes = ', sql)
 
+    def test_values_insert_sql_upsert(self):
+        repo = TweetStatsRepository()
+        sql = repo._get_values_insert_sql(
+            ['tweet_id', 'collected_at', 'num_likes'], on_conflict='upsert')
+        expected = 'INSERT INTO tweet_stats AS tn ' \
+                   '(tweet_id,collected_at,num_likes) VALUES %s ' \
+                   'ON CONFLICT (tweet_id,collected_at) DO UPDATE ' \
+                   'SET num_likes = EXCLUDED.num_likes;'
+        self.assertEqual(expected, sql)
+
+    def test_skip_unchanged_upsert(self):
+        repo = TweetStatsRepository()
+        item = {'tweet_id': 1, 'collected_at': datetime(2021, 11, 29),
+                'num_likes': 0}
+        sql, values = repo._item_to_insert_statement(
+            item, upsert=True, skip_unchanged=True)
+        expected = 'INSERT INTO tweet_stats AS tn ' \
+                   '(tweet_id,collected_at,num_likes) VALUES (%s,%s,%s) ' \
+                   'ON CONFLICT (tweet_id,collected_at) DO UPDATE ' \
+                   'SET num_likes = EXCLUDED.num_likes ' \
+                   'WHERE (tn.num_likes) IS DISTINCT FROM ' \
+                   '(EXCLUDED.num_likes) ' \
+                   'RETURNING (xmax = 0) AS inserted;'
+        self.assertEqual(expected, sql)
+        self.assertEqual(list(item.values()), values)
+
+    def test_delete_sql_single_column(self):
+        repo = TweetStatsRepository()
+        sql, values = repo._get_delete_sql_and_values(
+            ['tweet_id'], [(1,), (2,)])
+        self.assertEqual(
+            'DELETE FROM tweet_stats WHERE tweet_id IN (%s,%s);', sql)
+        self.assertEqual([1, 2], values)
+
+    def test_delete_sql_multiple_columns(self):
+        repo = TweetStatsRepository()
+        now = datetime(2022, 1, 1)
+        sql, values = repo._get_delete_sql_and_values(
+            ['collected_at', 'tweet_id'], [(now, 1), (now, 2)])
+        expected = 'DELETE FROM tweet_stats ' \
+                   'WHERE (collected_at,tweet_id) IN ((%s,%s),(%s,%s));'
+        self.assertEqual(expected, sql)
+        self.assertEqual([now, 1, now, 2], values)
+
+    def test_value_rows_merge_repeated_keys_on_upsert(self):
+        repo = TweetStatsRepository()
+        now = datetime(2022, 1, 1)
+        items = [{'tweet_id': 2, 'collected_at': now, 'num_likes': 1},
+                 {'tweet_id': 1, 'collected_at': now, 'num_likes': 1},
+                 {'tweet_id': 2, 'collected_at': now, 'num_likes': 2},
+                 {'tweet_id': 3, 'collected_at': now}]
+        rows = list(repo._get_value_rows(items, on_conflict='upsert'))
+        expected = [(['tweet_id', 'collected_at', 'num_likes'],
+                     [(1, now, 1), (2, now, 2)]),
+                    (['tweet_id', 'collected_at'], [(3, now)])]
+        self.assertEqual(expected, rows)
+        rows = list(repo._get_value_rows(items, on_conflict='ignore'))
+        self.assertEqual([(1, now, 1), (2, now, 1)], rows[0][1])
+
+    def test_estimate_item_bytes_sizes_json(self):
+        payload = {'text': 'x' * 10000}
+        size = PostgresRepository._estimate_item_bytes(
+            {'tweet_id': 1, 'raw': Json(payload), 'tags': ['a'] * 1000})
+        self.assertGreater(size, 10000 + 5000)
+
+
+class TestIndexes(unittest.TestCase):
+
+    def test_get_index_statements(self):
+        repo = PostgresRepository(
+            connection_factory=get_test_connection_factory(),
+            table_name='tweet',
+            primary_keys=['tweet_id'],
+            indexes=['label', ['tweet', 'label']])
+        expected = [
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS tweet_label_idx '
+            'ON tweet (label);',
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS tweet_tweet_label_idx '
+            'ON tweet (tweet,label);',
+        ]
+        self.assertEqual(expected, repo._get_index_statements())
+
+    def test_index_check_raises_on_unindexed_filter(self):
+        repo = PostgresRepository(
+            connection_factory=get_test_connection_factory(),
+            table_name='tweet',
+            primary_keys=['tweet_id'],
+            indexes=['label'],
+            index_check='raise')
+        repo._check_index(['tweet_id'])
+        repo._check_index(['label', 'tweet'])
+        with self.assertRaises(UnindexedQueryError):
+            repo._check_index(['tweet'])
+
+    def test_ensure_indexes_creates_indexes(self):
+        db_name = 'test_ensure_indexes_creates_indexes'
+        create_test_database(db_name)
+        repo = PostgresRepository(
+            connection_factory=get_test_connection_factory(db_name),
+            table_name='tweet',
+            primary_keys=['tweet_id'],
+            indexes=['tweet'])
+        repo.ensure_indexes()
+        repo.ensure_indexes()
+        conn = repo.connection_factory()
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT indexname FROM pg_indexes WHERE tablename = 'tweet';")
+            names = {x[0] for x in cursor.fetchall()}
+        conn.close()
+        self.assertIn('tweet_tweet_idx', names)
+
+    def test_ensure_indexes_rebuilds_invalid_index(self):
+        db_name = 'test_ensure_indexes_rebuilds_invalid_index'
+        create_test_database(db_name)
+        repo = PostgresRepository(
+            connection_factory=get_test_connection_factory(db_name),
+            table_name='tweet',
+            primary_keys=['tweet_id'],
+            indexes=['tweet'])
+        repo.add_many([{'tweet_id': 1, 'tweet': 'a'},
+                       {'tweet_id': 2, 'tweet': 'a'}])
+        conn = repo.connection_factory()
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                # NOTE: fails on the duplicates, leaving an INVALID index.
+                with self.assertRaises(UniqueViolation):
+                    cursor.execute('CREATE UNIQUE INDEX CONCURRENTLY '
+                                   'tweet_tweet_idx ON tweet (tweet);')
+                self.assertEqual(['tweet_tweet_idx'],
+                                 repo._get_invalid_index_names(cursor))
+                repo.ensure_indexes()
+                self.assertEqual([], repo._get_invalid_index_names(cursor))
+        finally:
+            conn.close()
+
+
+class TestCreateDb(unittest.TestCase):
+
+    def test_create_db_from_template(self):
+        db_name = 'test_create_db_from_template'
+        connection_factory = get_test_connection_factory()
+        drop_db(connection_factory, db_name)
+        create_db(connection_factory, db_name, test_schema, template=True)
+        conn = connection_factory()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    'SELECT datname FROM pg_database WHERE datistemplate;')
+                templates = [x[0] for x in cursor.fetchall()]
+        finally:
+            conn.close()
+        self.assertIn(get_template_name(test_schema), templates)
+        repo = TweetPgsqlRepository(db_name=db_name)
+        repo.add({'tweet_id': 1, 'tweet': 'tweet1'})
+        self.assertTrue(repo.exists(1))
+        drop_db(connection_factory, db_name)
+
+    def test_database_pool_recycles_databases(self):
+        pool = DatabasePool(get_test_connection_factory(), test_schema, size=1)
+        db_name = pool.acquire()
+        repo = TweetPgsqlRepository(db_name=db_name)
+        repo.add({'tweet_id': 1, 'tweet': 'tweet1'})
+        other_db_name = pool.acquire()
+        self.assertNotEqual(db_name, other_db_name)
+        pool.release(db_name)
+        pool.release(other_db_name)
+        pool._executor.shutdown(wait=True)
+        recycled = {pool.acquire(), pool.acquire()}
+        self.assertEqual({db_name, other_db_name}, recycled)
+        self.assertEqual(0, TweetPgsqlRepository(db_name=db_name).count())
+        pool.close()
+
+
+class TestReplicaRouting(unittest.TestCase):
+
+    @staticmethod
+    def get_factory(db_name: str, **kwargs) -> ConnectionFactory:
+        # NOTE: the test server stands in as its own replica.
+        factory = get_test_connection_factory(db_name)
+        return ConnectionFactory(
+            host=factory.host,
+            port=factory.port,
+            user=factory.user,
+            password=factory.password,
+            db_name=db_name,
+            replicas=[(factory.host, factory.port),
+                      (factory.host, factory.port)],
+            **kwargs)
+
+    def test_round_robin_alternates_replicas(self):
+        factory = self.get_factory('test')
+        with factory.connection(read_only=True):
+            self.assertEqual([1, 0], factory._in_flight)
+        with factory.connection(read_only=True):
+            self.assertEqual([0, 1], factory._in_flight)
+        self.assertEqual([0, 0], factory._in_flight)
+
+    def test_writes_do_not_use_replicas(self):
+        factory = self.get_factory('test')
+        with factory.connection():
+            self.assertEqual([0, 0], factory._in_flight)
+
+    def test_least_loaded_picks_idle_replica(self):
+        factory = self.get_factory('test', replica_strategy='least_loaded')
+        with factory.connection(read_only=True):
+            with factory.connection(read_only=True):
+                self.assertEqual([1, 1], factory._in_flight)
+        self.assertEqual([0, 0], factory._in_flight)
+
+    def test_repository_reads_from_replica(self):
+        db_name = 'test_repository_reads_from_replica'
+        create_test_database(db_name)
+        repo = TweetPgsqlRepository(db_name=db_name)
+        repo.connection_factory = self.get_factory(
+            db_name, max_replica_lag=10.)
+        repo.add({'tweet_id': 1, 'tweet': 'tweet1'})
+        self.assertTrue(repo.exists(1))
+        self.assertEqual(1, repo.count())
+        self.assertEqual(1, len(list(repo.all())))
+        self.assertEqual([0, 0], repo.connection_factory._in_flight)
+
 
 class TestPostgresRepository(unittest.TestCase):
 
@@ -97,6 +329,22 @@ class TestPostgresRepository(unittest.TestCase):
         self.assertTrue(repo.exists(1))
         self.assertTrue(repo.exists(2))
 
+    def test_add_many_ignore_duplicates(self):
+        db_name = 'test_add_many_ignore_duplicates'
+        create_test_database(db_name)
+        repo = TweetPgsqlRepository(db_name=db_name)
+        repo.chunk_size = 2
+        repo.add({'tweet_id': 1, 'tweet': 'tweet1'})
+        with profiling.profile(output=None) as profiler:
+            repo.add_many([{'tweet_id': i, 'tweet': f'new{i}'}
+                           for i in [0, 1, 2, 2]],
+                          ignore_duplicates=True)
+        inserts = [x for x in profiler.round_trips
+                   if x.shape.startswith('INSERT')]
+        self.assertEqual(2, len(inserts))
+        self.assertEqual(['new0', 'tweet1', 'new2'],
+                         [repo.get(i)['tweet'] for i in range(3)])
+
     def test_add_many_rolls_back_on_error(self):
         db_name = 'test_add_many_rolls_back_on_error'
         create_test_database(db_name)
@@ -153,10 +401,75 @@ class TestPostgresRepository(unittest.TestCase):
         repo.add_many([tweet1, tweet2])
         self.assertTrue(repo.exists(1))
         self.assertTrue(repo.exists(2))
-        repo.delete_many([{'tweet_id': 1}, {'tweet_id': 2}])
+        num_deleted = repo.delete_many([{'tweet_id': 1}, {'tweet_id': 2}])
+        self.assertEqual(2, num_deleted)
         self.assertFalse(repo.exists(1))
         self.assertFalse(repo.exists(2))
 
+    def test_delete_many_with_two_primary_keys(self):
+        db_name = 'test_delete_many_with_two_primary_keys'
+        create_test_database(db_name)
+        repo = TweetStatsRepository(db_name=db_name)
+        repo.chunk_size = 2
+        start = datetime(2022, 1, 1)
+        repo.add_many([{'tweet_id': i % 2,
+                        'collected_at': start + timedelta(days=i),
+                        'num_likes': i}
+                       for i in range(6)])
+        num_deleted = repo.delete_many(
+            [{'tweet_id': 0, 'collected_at': start},
+             {'tweet_id': 1, 'collected_at': start + timedelta(days=1)},
+             {'tweet_id': 1, 'collected_at': start},
+             {'tweet_id': 0, 'collected_at': start + timedelta(days=4)}])
+        self.assertEqual(3, num_deleted)
+        self.assertEqual(3, repo.count())
+        self.assertIsNone(repo.get(0, start + timedelta(days=4)))
+        self.assertIsNotNone(repo.get(0, start + timedelta(days=2)))
+
+    def test_delete_many_with_string_keys(self):
+        db_name = 'test_delete_many_with_string_keys'
+        create_test_database(db_name)
+        repo = TweetStatsRepository(db_name=db_name)
+        repo.add_many([{'tweet_id': 1,
+                        'collected_at': datetime(2022, 1, i),
+                        'num_likes': i}
+                       for i in range(1, 4)])
+        num_deleted = repo.delete_many(
+            [{'tweet_id': 1, 'collected_at': '2022-01-01'},
+             {'tweet_id': 1, 'collected_at': '2022-01-02 00:00:00'}])
+        self.assertEqual(2, num_deleted)
+        self.assertEqual(1, repo.count())
+
+    def test_get_many(self):
+        db_name = 'test_get_many'
+        create_test_database(db_name)
+        repo = TweetPgsqlRepository(db_name=db_name)
+        repo.add_many([{'tweet_id': i, 'tweet': f'tweet{i}'}
+                       for i in range(3)])
+        repo.chunk_size = 2
+        items = repo.get_many([2, 5, 0, 2])
+        self.assertEqual([2, None, 0, 2],
+                         [x and x['tweet_id'] for x in items])
+        items = repo.get_many([1], projection=['tweet'])
+        self.assertEqual([{'tweet_id': 1, 'tweet': 'tweet1'}], items)
+        self.assertEqual([], repo.get_many([]))
+
+    def test_get_many_with_two_primary_keys(self):
+        db_name = 'test_get_many_with_two_primary_keys'
+        create_test_database(db_name)
+        repo = TweetStatsRepository(db_name=db_name)
+        start = datetime(2022, 1, 1)
+        repo.add_many([{'tweet_id': i % 2,
+                        'collected_at': start + timedelta(days=i),
+                        'num_likes': i}
+                       for i in range(4)])
+        items = repo.get_many([(1, start + timedelta(days=3)),
+                               (1, start),
+                               (0, start),
+                               (0, '2022-01-01 00:00:00')])
+        self.assertEqual([3, None, 0, 0],
+                         [x and x['num_likes'] for x in items])
+
     def test_exists_returns_true_when_item_exists(self):
         db_name = 'test_exists_returns_true_when_item_exists'
         create_test_database(db_name)
@@ -290,3 +603,218 @@ class TestPostgresRepository(unittest.TestCase):
         repo.upsert(tweet_stats)
         result = repo.get(1, now)
         self.assertEqual(tweet_stats, result)
+
+    def test_timeout_raises_deadline_exceeded(self):
+        db_name = 'test_timeout_raises_deadline_exceeded'
+        create_test_database(db_name)
+        repo = TweetPgsqlRepository(db_name=db_name)
+        with self.assertRaises(DeadlineExceeded):
+            repo._execute_no_return('SELECT pg_sleep(1);', timeout=0.1)
+
+    def test_cancel_without_timeout_is_not_deadline_exceeded(self):
+        db_name = 'test_cancel_without_timeout'
+        create_test_database(db_name)
+        repo = TweetPgsqlRepository(db_name=db_name)
+        with self.assertRaises(QueryCanceled):
+            repo._execute_no_return(
+                'SELECT pg_cancel_backend(pg_backend_pid()), pg_sleep(1);')
+
+    def test_default_timeout_applies_to_calls(self):
+        db_name = 'test_default_timeout_applies_to_calls'
+        create_test_database(db_name)
+        repo = TweetPgsqlRepository(db_name=db_name)
+        repo.timeout = 0.1
+        repo.add({'tweet_id': 1, 'tweet': 'tweet1'})
+        self.assertTrue(repo.exists(1))
+        with self.assertRaises(DeadlineExceeded):
+            repo._execute_no_return('SELECT pg_sleep(1);')
+        repo._execute_no_return('SELECT pg_sleep(0.2);', timeout=1)
+
+    def test_upsert_many_skip_unchanged_counts(self):
+        db_name = 'test_upsert_many_skip_unchanged_counts'
+        create_test_database(db_name)
+        repo = TweetPgsqlRepository(db_name=db_name)
+        tweet1 = {'tweet_id': 1, 'tweet': 'tweet1', 'label': 'a'}
+        tweet2 = {'tweet_id': 2, 'tweet': 'tweet2', 'label': None}
+        counts = repo.upsert_many([tweet1, tweet2], skip_unchanged=True)
+        self.assertEqual(
+            {'inserted': 2, 'updated': 0, 'unchanged': 0}, counts)
+        tweet1['label'] = 'b'
+        tweet3 = {'tweet_id': 3, 'tweet': 'tweet3', 'label': 'a'}
+        counts = repo.upsert_many(
+            [tweet1, tweet2, tweet3], skip_unchanged=True)
+        self.assertEqual(
+            {'inserted': 1, 'updated': 1, 'unchanged': 1}, counts)
+        self.assertEqual('b', repo.get(1)['label'])
+        counts = repo.upsert(tweet1, skip_unchanged=True)
+        self.assertEqual(
+            {'inserted': 0, 'updated': 0, 'unchanged': 1}, counts)
+        counts = repo.upsert_many(
+            [tweet3, dict(tweet3, label='c')], skip_unchanged=True)
+        self.assertEqual(
+            {'inserted': 0, 'updated': 1, 'unchanged': 0}, counts)
+        self.assertEqual('c', repo.get(3)['label'])
+
+    def test_changes_since_resumes_from_token(self):
+        db_name = 'test_changes_since_resumes_from_token'
+        create_test_database(db_name)
+        repo = TweetPgsqlRepository(db_name=db_name)
+        # NOTE: ids are inserted in increasing order here, so stand in for an
+        #  updated_at column.
+        repo.change_column = 'tweet_id'
+        repo.add_many([{'tweet_id': 1, 'tweet': 'tweet1'},
+                       {'tweet_id': 2, 'tweet': 'tweet2'}])
+        changes = list(repo.changes_since())
+        self.assertEqual([1, 2], [x['tweet_id'] for _, x in changes])
+        token = changes[-1][0]
+        self.assertEqual([], list(repo.changes_since(token)))
+        repo.add({'tweet_id': 3, 'tweet': 'tweet3'})
+        changes = list(repo.changes_since(token))
+        self.assertEqual([3], [x['tweet_id'] for _, x in changes])
+        changes = list(repo.changes_since(limit=1))
+        self.assertEqual([1], [x['tweet_id'] for _, x in changes])
+
+    def test_watch_polls_for_new_changes(self):
+        db_name = 'test_watch_polls_for_new_changes'
+        create_test_database(db_name)
+        repo = TweetPgsqlRepository(db_name=db_name)
+        repo.change_column = 'tweet_id'
+        repo.add_many([{'tweet_id': i, 'tweet': f'tweet{i}'}
+                       for i in range(1, 4)])
+        changes = repo.watch(poll_interval=0.01, batch_size=2)
+        first = list(itertools.islice(changes, 3))
+        self.assertEqual([1, 2, 3], [x['tweet_id'] for _, x in first])
+        repo.add({'tweet_id': 4, 'tweet': 'tweet4'})
+        token, item = next(changes)
+        changes.close()
+        self.assertEqual(4, item['tweet_id'])
+        changes = repo.watch(token, poll_interval=0.01)
+        repo.add({'tweet_id': 5, 'tweet': 'tweet5'})
+        _, item = next(changes)
+        changes.close()
+        self.assertEqual(5, item['tweet_id'])
+
+    def test_batch_mapping_hooks(self):
+        db_name = 'test_batch_mapping_hooks'
+        create_test_database(db_name)
+        batches_in = []
+        batches_out = []
+
+        class BatchMappedRepository(TweetPgsqlRepository):
+
+            def map_batch_in(self, items):
+                batches_in.append(len(items))
+                return [dict(x, label='a') for x in items]
+
+            def map_batch_out(self, rows):
+                batches_out.append(len(rows))
+                return rows
+
+        repo = BatchMappedRepository(db_name=db_name)
+        repo.chunk_size = 2
+        repo.add_many([{'tweet_id': i, 'tweet': f'tweet{i}'}
+                       for i in range(5)])
+        self.assertEqual([2, 2, 1], batches_in)
+        items = list(repo.all())
+        self.assertEqual([2, 2, 1], batches_out)
+        self.assertEqual({'a'}, set(x['label'] for x in items))
+        repo.add({'tweet_id': 9, 'tweet': 'tweet9'})
+        self.assertEqual([2, 2, 1, 1], batches_in)
+        self.assertEqual('a', repo.get(9)['label'])
+        self.assertEqual([2, 2, 1, 1], batches_out)
+
+    def test_load_parallel(self):
+        db_name = 'test_load_parallel'
+        create_test_database(db_name)
+        repo = TweetStatsRepository(db_name=db_name)
+        start = datetime(2022, 1, 1)
+        stats = (
+            {'tweet_id': i % 10,
+             'collected_at': start + timedelta(days=i // 10),
+             'num_likes': i}
+            for i in range(100))
+        result = repo.load_parallel(stats, num_connections=3, batch_size=7)
+        self.assertEqual(100, result['rows'])
+        self.assertEqual(100, repo.count())
+        updated = [{'tweet_id': 1, 'collected_at': start, 'num_likes': -1},
+                   {'tweet_id': 1, 'collected_at': start, 'num_likes': -2}]
+        result = repo.load_parallel(updated, on_conflict='upsert')
+        self.assertEqual(1, result['rows'])
+        self.assertEqual(-2, repo.get(1, start)['num_likes'])
+        with self.assertRaises(UniqueViolation):
+            repo.load_parallel(updated, on_conflict='error')
+
+    def test_aggregate(self):
+        db_name = 'test_aggregate'
+        create_test_database(db_name)
+        repo = TweetStatsRepository(db_name=db_name)
+        start = datetime(2022, 1, 1)
+        repo.add_many([{'tweet_id': i % 2,
+                        'collected_at': start + timedelta(days=i),
+                        'num_likes': i}
+                       for i in range(5)])
+        results = list(repo.aggregate(
+            group_by=['tweet_id'],
+            metrics={'num_likes': 'sum', '*': 'count'}))
+        expected = [{'tweet_id': 0, 'num_likes_sum': 6, 'count': 3},
+                    {'tweet_id': 1, 'num_likes_sum': 4, 'count': 2}]
+        self.assertEqual(expected, results)
+        results = list(repo.aggregate(
+            metrics={'num_likes': 'max', 'collected_at': 'min'}, tweet_id=1))
+        expected = [{'num_likes_max': 3,
+                     'collected_at_min': start + timedelta(days=1)}]
+        self.assertEqual(expected, results)
+        with self.assertRaises(ValueError):
+            list(repo.aggregate(metrics={'num_likes': 'median'}))
+
+    def test_sample(self):
+        db_name = 'test_sample'
+        create_test_database(db_name)
+        repo = TweetPgsqlRepository(db_name=db_name)
+        repo.add_many([{'tweet_id': i, 'tweet': f'tweet{i % 2}'}
+                       for i in range(20)])
+        self.assertEqual(20, len(list(repo.sample(1.))))
+        sample = list(repo.sample(5, seed=1))
+        self.assertEqual(5, len(sample))
+        self.assertEqual(5, len(set(x['tweet_id'] for x in sample)))
+        self.assertEqual(sample, list(repo.sample(5, seed=1)))
+        sample = list(repo.sample(5, method='bernoulli', tweet='tweet1'))
+        self.assertEqual({'tweet1'}, set(x['tweet'] for x in sample))
+        with self.assertRaises(ValueError):
+            repo.sample(1.5)
+
+    def test_dump_and_load(self):
+        db_name = 'test_dump_and_load'
+        create_test_database(db_name)
+        repo = TweetPgsqlRepository(db_name=db_name)
+        tweets = [{'label': None, 'tweet_id': i, 'tweet': f'tweet, "{i}"\n'}
+                  for i in range(10)]
+        repo.add_many(tweets)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for format, file_name in [('csv', 'tweets.csv.gz'),
+                                      ('jsonl', 'tweets.jsonl')]:
+                path = os.path.join(temp_dir, file_name)
+                self.assertEqual(10, repo.dump(path, format=format))
+                repo.delete_many([{'tweet_id': i} for i in range(5)])
+                num_rows = repo.load(path, format=format, on_conflict='ignore')
+                self.assertEqual(5, num_rows)
+                items = sorted(repo.all(), key=lambda x: x['tweet_id'])
+                self.assertEqual(tweets, items)
+                with self.assertRaises(UniqueViolation):
+                    repo.load(path, format=format)
+
+    def test_upsert_many_with_repeated_keys_and_shapes(self):
+        db_name = 'test_upsert_many_with_repeated_keys_and_shapes'
+        create_test_database(db_name)
+        repo = TweetPgsqlRepository(db_name=db_name)
+        repo.add({'tweet_id': 1, 'tweet': 'tweet1', 'label': 'a'})
+        repo.upsert_many([
+            {'tweet_id': 1, 'label': 'b'},
+            {'tweet_id': 2, 'tweet': 'tweet2'},
+            {'tweet_id': 1, 'tweet': 'tweet1b'},
+            {'tweet_id': 2, 'tweet': 'tweet2b', 'label': 'c'},
+        ])
+        self.assertEqual({'label': 'b', 'tweet_id': 1, 'tweet': 'tweet1b'},
+                         repo.get(1))
+        self.assertEqual({'label': 'c', 'tweet_id': 2, 'tweet': 'tweet2b'},
+                         repo.get(2))
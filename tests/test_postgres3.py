@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta
+import os
+import unittest
+
+from psycopg.errors import UniqueViolation
+
+from dbi_repositories.base import DeadlineExceeded
+from dbi_repositories.postgres3 import ConnectionFactory, PostgresRepository
+from tests.implementations import create_test_database
+
+
+def get_test_connection_factory(db_name: str) -> ConnectionFactory:
+    return ConnectionFactory(
+        host=os.environ['PGSQL_HOST'],
+        port=int(os.environ['PGSQL_PORT']),
+        user=os.environ['PGSQL_USERNAME'],
+        password=os.environ['PGSQL_PASSWORD'],
+        db_name=db_name,
+        max_size=4)
+
+
+class TweetStatsRepository(PostgresRepository):
+
+    def __init__(self, db_name: str):
+        super().__init__(
+            connection_factory=get_test_connection_factory(db_name),
+            table_name='tweet_stats',
+            primary_keys=['tweet_id', 'collected_at'])
+
+    def get(self, tweet_id: int, collected_at: datetime):
+        return super().get(tweet_id=tweet_id, collected_at=collected_at)
+
+
+class TestPostgres3Repository(unittest.TestCase):
+
+    def test_add_many_copies_items(self):
+        db_name = 'test_pg3_add_many_copies_items'
+        create_test_database(db_name)
+        repo = TweetStatsRepository(db_name)
+        now = datetime(2022, 1, 1)
+        stats = [{'tweet_id': i, 'collected_at': now, 'num_likes': i}
+                 for i in range(10)]
+        repo.add_many(stats)
+        self.assertEqual(10, repo.count())
+        self.assertEqual(stats[3], repo.get(3, now))
+        repo.dispose()
+
+    def test_add_many_rolls_back_on_error(self):
+        db_name = 'test_pg3_add_many_rolls_back_on_error'
+        create_test_database(db_name)
+        repo = TweetStatsRepository(db_name)
+        now = datetime(2022, 1, 1)
+        stat = {'tweet_id': 1, 'collected_at': now, 'num_likes': 1}
+        with self.assertRaises(UniqueViolation):
+            repo.add_many([stat, stat])
+        self.assertEqual(0, repo.count())
+        repo.dispose()
+
+    def test_upsert_many_pipelined(self):
+        db_name = 'test_pg3_upsert_many_pipelined'
+        create_test_database(db_name)
+        repo = TweetStatsRepository(db_name)
+        now = datetime(2022, 1, 1)
+        repo.upsert_many([{'tweet_id': i, 'collected_at': now, 'num_likes': 0}
+                          for i in range(5)])
+        repo.upsert_many([{'tweet_id': i, 'collected_at': now, 'num_likes': 1}
+                          for i in range(3, 7)])
+        self.assertEqual(7, repo.count())
+        self.assertEqual(0, repo.get(2, now)['num_likes'])
+        self.assertEqual(1, repo.get(3, now)['num_likes'])
+        repo.dispose()
+
+    def test_load_parallel(self):
+        db_name = 'test_pg3_load_parallel'
+        create_test_database(db_name)
+        repo = TweetStatsRepository(db_name)
+        start = datetime(2022, 1, 1)
+        stats = (
+            {'tweet_id': i % 10,
+             'collected_at': start + timedelta(days=i // 10),
+             'num_likes': i}
+            for i in range(100))
+        result = repo.load_parallel(stats, num_connections=3, batch_size=7)
+        self.assertEqual(100, result['rows'])
+        updated = [{'tweet_id': 1, 'collected_at': start, 'num_likes': -1}]
+        repo.load_parallel(updated, on_conflict='upsert')
+        self.assertEqual(-1, repo.get(1, start)['num_likes'])
+        repo.dispose()
+
+    def test_timeout_raises_deadline_exceeded(self):
+        db_name = 'test_pg3_timeout_raises_deadline_exceeded'
+        create_test_database(db_name)
+        repo = TweetStatsRepository(db_name)
+        with self.assertRaises(DeadlineExceeded):
+            repo._execute_no_return('SELECT pg_sleep(1);', timeout=0.1)
+        repo.dispose()
@@ -0,0 +1,107 @@
+import os
+import unittest
+
+from dbi_repositories import mongo, profiling
+from tests.implementations import create_test_database, TweetPgsqlRepository
+
+
+class TestGetSqlShape(unittest.TestCase):
+
+    def test_parameters_and_literals_are_replaced(self):
+        shape = profiling.get_sql_shape(
+            "SELECT * FROM tweet WHERE tweet_id = %s AND tweet = 'a''b' "
+            "LIMIT 10;")
+        self.assertEqual(
+            'SELECT * FROM tweet WHERE tweet_id = ? AND tweet = ? LIMIT ?;',
+            shape)
+
+    def test_multi_row_values_are_collapsed(self):
+        one = profiling.get_sql_shape(
+            b'INSERT INTO tweet (tweet_id,tweet) VALUES (1,\'a\');')
+        two = profiling.get_sql_shape(
+            b'INSERT INTO tweet (tweet_id,tweet) VALUES (1,\'a\'),(2,\'b\');')
+        self.assertEqual(
+            'INSERT INTO tweet (tweet_id,tweet) VALUES (?,?);', one)
+        self.assertEqual(
+            'INSERT INTO tweet (tweet_id,tweet) VALUES (?,?), ...;', two)
+
+    def test_mongo_filter_values_are_replaced(self):
+        shape = mongo.get_value_shape({'_id': {'$in': [1, 2]}, 'text': 'a'})
+        self.assertEqual({'_id': {'$in': '?'}, 'text': '?'}, shape)
+
+
+class TestProfile(unittest.TestCase):
+
+    def test_nothing_recorded_outside_profile(self):
+        profiling.record('postgres', 'tweet', 'SELECT ?;', 0.1)
+        with profiling.profile(output=None) as profiler:
+            pass
+        self.assertEqual([], profiler.round_trips)
+
+    def test_repeated_shapes_are_flagged(self):
+        with profiling.profile(threshold=3, output=None) as profiler:
+            for _ in range(3):
+                profiling.record('postgres', 'tweet', 'SELECT ?;', 0.1, 1)
+            profiling.record('postgres', 'tweet', 'DELETE ?;', 0.1, 1)
+        repeated = profiler.repeated_shapes()
+        self.assertEqual(1, len(repeated))
+        round_trip, count, suggestion = repeated[0]
+        self.assertEqual('SELECT ?;', round_trip.shape)
+        self.assertEqual(3, count)
+        self.assertIn('get_many', suggestion)
+        self.assertIn('N+1: 3 round trips', profiler.summary())
+
+    def test_postgres_get_in_loop_is_flagged(self):
+        db_name = 'test_profile_postgres'
+        create_test_database(db_name)
+        repo = TweetPgsqlRepository(db_name=db_name)
+        repo.add_many([{'tweet_id': x, 'tweet': f'tweet{x}'}
+                       for x in range(10)])
+        with profiling.profile(output=None) as profiler:
+            for tweet_id in range(10):
+                repo.get(tweet_id)
+        shapes = [x.shape for x in profiler.round_trips]
+        self.assertTrue(any(x.startswith('SELECT') and 'tweet_id = ?' in x
+                            for x in shapes))
+        round_trip, count, _ = profiler.repeated_shapes()[0]
+        self.assertEqual(10, count)
+        self.assertEqual('tweet', round_trip.target)
+
+    def test_mongo_get_in_loop_is_flagged(self):
+        client = mongo.get_client(
+            host=os.environ['MONGO_HOST'],
+            port=int(os.environ['MONGO_PORT']),
+            username=os.environ['MONGO_USERNAME'],
+            password=os.environ['MONGO_PASSWORD'],
+            profile=True)
+        repo = mongo.MongoRepository(
+            client=client,
+            db_name='test_mongo_twitter',
+            collection_name='test_profile_mongo',
+            _id_attr='id')
+        repo.collection.drop()
+        repo.add_many([{'id': x, 'text': f'tweet{x}'} for x in range(10)])
+        with profiling.profile(output=None) as profiler:
+            for tweet_id in range(10):
+                repo.get(tweet_id)
+        round_trip, count, suggestion = profiler.repeated_shapes()[0]
+        self.assertEqual(10, count)
+        self.assertTrue(round_trip.shape.startswith('find'))
+        self.assertEqual(
+            'test_mongo_twitter.test_profile_mongo', round_trip.target)
+        self.assertIn('get_many', suggestion)
+
+    def test_mongo_client_keeps_own_listeners(self):
+        listener = mongo.ProfilingListener()
+        client = mongo.get_client(
+            host=os.environ['MONGO_HOST'],
+            port=int(os.environ['MONGO_PORT']),
+            username=os.environ['MONGO_USERNAME'],
+            password=os.environ['MONGO_PASSWORD'],
+            shared=False,
+            profile=True,
+            event_listeners=[listener])
+        listeners = client.options.event_listeners
+        client.close()
+        self.assertIn(listener, listeners)
+        self.assertIn(mongo._profiling_listener, listeners)
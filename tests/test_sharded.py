@@ -0,0 +1,73 @@
+import unittest
+
+from dbi_repositories.sharded import ShardedRepository
+from tests.implementations import create_test_database, TweetMongoRepository, \
+    TweetPgsqlRepository
+
+
+class TestShardedRepository(unittest.TestCase):
+
+    def get_postgres_shards(self, name: str, num_shards: int = 3):
+        shards = []
+        for i in range(num_shards):
+            db_name = f'{name}_{i}'
+            create_test_database(db_name)
+            shards.append(TweetPgsqlRepository(db_name=db_name))
+        return ShardedRepository(shards)
+
+    def test_add_many_spreads_items_across_shards(self):
+        repo = self.get_postgres_shards(
+            'test_add_many_spreads_items_across_shards')
+        repo.add_many([{'tweet_id': i, 'tweet': f'tweet{i}'}
+                       for i in range(30)])
+        counts = [x.count() for x in repo.shards]
+        self.assertEqual(30, sum(counts))
+        self.assertTrue(all(x > 0 for x in counts))
+        self.assertEqual(30, repo.count())
+        self.assertEqual(30, len(list(repo.all())))
+
+    def test_get_routes_to_one_shard(self):
+        repo = self.get_postgres_shards('test_get_routes_to_one_shard')
+        tweet = {'label': None, 'tweet_id': 7, 'tweet': 'tweet7'}
+        repo.add(tweet)
+        self.assertEqual(tweet, repo.get(7))
+        self.assertTrue(repo.shard_for(tweet).exists(7))
+        self.assertTrue(repo.exists(7))
+        self.assertFalse(repo.exists(8))
+
+    def test_get_many_groups_keys_by_shard(self):
+        repo = self.get_postgres_shards('test_get_many_groups_keys_by_shard')
+        repo.add_many([{'tweet_id': i, 'tweet': f'tweet{i}'}
+                       for i in range(10)])
+        items = repo.get_many([9, 12, 0, 4])
+        self.assertEqual([9, None, 0, 4],
+                         [x and x['tweet_id'] for x in items])
+
+    def test_search_and_delete_scatter(self):
+        repo = self.get_postgres_shards('test_search_and_delete_scatter')
+        repo.add_many([{'tweet_id': i, 'tweet': f'tweet{i % 2}'}
+                       for i in range(10)])
+        self.assertEqual(5, len(list(repo.search(tweet='tweet1'))))
+        repo.delete_many([{'tweet_id': 1}, {'tweet_id': 2}])
+        self.assertEqual(8, repo.count())
+
+    def test_aggregate_merges_groups(self):
+        repo = self.get_postgres_shards('test_aggregate_merges_groups')
+        repo.add_many([{'tweet_id': i, 'tweet': f'tweet{i % 2}'}
+                       for i in range(10)])
+        results = repo.aggregate(
+            group_by=['tweet'], metrics={'tweet_id': 'max', '*': 'count'})
+        expected = [{'tweet': 'tweet0', 'tweet_id_max': 8, 'count': 5},
+                    {'tweet': 'tweet1', 'tweet_id_max': 9, 'count': 5}]
+        self.assertEqual(expected, results)
+
+    def test_mongo_shards(self):
+        shards = [TweetMongoRepository(f'test_mongo_shards_{i}')
+                  for i in range(2)]
+        for shard in shards:
+            shard.collection.drop()
+        repo = ShardedRepository(shards)
+        repo.add_many([{'id': i, 'text': f'tweet{i}'} for i in range(10)])
+        self.assertEqual(10, repo.count())
+        self.assertEqual('tweet3', repo.get(3)['text'])
+        self.assertTrue(repo.exists(_id=4))
@@ -0,0 +1,99 @@
+import os
+import tempfile
+import unittest
+
+from dbi_repositories.sharded import ShardedRepository
+from dbi_repositories.transfer import copy_repository, read_checkpoint, \
+    write_checkpoint
+from tests.implementations import create_test_database, TweetMongoRepository, \
+    TweetPgsqlRepository
+
+
+def tweet_to_row(tweet):
+    if tweet['text'] == 'skip':
+        return None
+    return {'tweet_id': tweet['id'], 'tweet': tweet['text']}
+
+
+class TestCopyRepository(unittest.TestCase):
+
+    def test_copy_mongo_to_postgres(self):
+        db_name = 'test_copy_mongo_to_postgres'
+        create_test_database(db_name)
+        source = TweetMongoRepository('test_copy_mongo_to_postgres')
+        source.collection.drop()
+        source.add_many([{'id': i, 'text': f'tweet{i}'} for i in range(25)]
+                        + [{'id': 25, 'text': 'skip'}])
+        sink = TweetPgsqlRepository(db_name=db_name)
+        stats = copy_repository(
+            source=source,
+            sink=sink,
+            transform=tweet_to_row,
+            batch_size=10,
+            num_writers=2)
+        self.assertEqual(26, stats['read'])
+        self.assertEqual(25, stats['written'])
+        self.assertEqual(1, stats['skipped'])
+        self.assertEqual(25, sink.count())
+        self.assertEqual('tweet7', sink.get(7)['tweet'])
+
+    def test_copy_resumes_from_checkpoint(self):
+        db_name = 'test_copy_resumes_from_checkpoint'
+        create_test_database(db_name)
+        source = TweetMongoRepository('test_copy_resumes_from_checkpoint')
+        source.collection.drop()
+        source.add_many([{'id': i, 'text': f'tweet{i}'} for i in range(20)])
+        sink = TweetPgsqlRepository(db_name=db_name)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            checkpoint_path = os.path.join(temp_dir, 'checkpoint.json')
+            write_checkpoint(checkpoint_path, 15)
+            self.assertEqual(15, read_checkpoint(checkpoint_path))
+            stats = copy_repository(
+                source=source,
+                sink=sink,
+                transform=tweet_to_row,
+                batch_size=10,
+                checkpoint_path=checkpoint_path,
+                read_kwargs={'sort': [('_id', 1)]})
+            self.assertFalse(os.path.exists(checkpoint_path))
+        self.assertEqual(5, stats['written'])
+        self.assertFalse(sink.exists(14))
+        self.assertTrue(sink.exists(15))
+
+    def test_copy_from_postgres_resumes_in_key_order(self):
+        db_name = 'test_copy_from_postgres_resumes_in_key_order'
+        create_test_database(db_name)
+        source = TweetPgsqlRepository(db_name=db_name)
+        source.add_many([{'tweet_id': i, 'tweet': f'tweet{i}'}
+                         for i in range(20)])
+        # NOTE: moves the updated rows to the end of the heap.
+        source.update_many([{'tweet_id': i, 'tweet': f'updated{i}'}
+                            for i in range(10)],
+                           condition_keys=['tweet_id'],
+                           update_keys=['tweet'])
+        sink = TweetMongoRepository(
+            'test_copy_from_postgres_resumes_in_key_order')
+        sink.collection.drop()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            checkpoint_path = os.path.join(temp_dir, 'checkpoint.json')
+            write_checkpoint(checkpoint_path, 15)
+            stats = copy_repository(
+                source=source,
+                sink=sink,
+                transform=lambda x: {'id': x['tweet_id'],
+                                     'text': x['tweet']},
+                checkpoint_path=checkpoint_path)
+        self.assertEqual(5, stats['written'])
+        self.assertEqual(list(range(15, 20)),
+                         sorted(x['_id'] for x in sink.all()))
+
+    def test_checkpoint_rejects_unordered_source(self):
+        source = ShardedRepository(
+            [TweetMongoRepository(f'test_checkpoint_rejects_{i}')
+             for i in range(2)])
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                self.assertRaises(ValueError):
+            copy_repository(
+                source=source,
+                sink=TweetMongoRepository('test_checkpoint_rejects_sink'),
+                checkpoint_path=os.path.join(temp_dir, 'checkpoint.json'))
@@ -0,0 +1,34 @@
+import time
+import unittest
+
+from dbi_repositories import util
+
+
+class TestAdaptiveChunker(unittest.TestCase):
+
+    def test_chunks_are_cut_at_target_bytes(self):
+        chunker = util.AdaptiveChunker(
+            size_of=len, target_bytes=10, initial_items=100)
+        chunks = list(chunker.chunks(['abcd'] * 5 + ['x' * 20]))
+        self.assertEqual([2, 2, 1, 1], [len(x) for x in chunks])
+        self.assertEqual(6, chunker.stats['items'])
+        self.assertEqual(40, chunker.stats['bytes'])
+
+    def test_max_bytes_caps_target_bytes(self):
+        chunker = util.AdaptiveChunker(
+            size_of=len, target_bytes=100, max_bytes=10)
+        self.assertEqual(10, chunker.target_bytes)
+
+    def test_item_limit_follows_latency(self):
+        chunker = util.AdaptiveChunker(
+            size_of=len, target_seconds=0.001, initial_items=8)
+        chunks = chunker.chunks(['a'] * 100)
+        first = next(chunks)
+        time.sleep(0.01)
+        second = next(chunks)
+        self.assertEqual(8, len(first))
+        self.assertEqual(4, len(second))
+        self.assertEqual(4, chunker.stats['item_limit'])
+        chunker.target_seconds = 60.
+        _ = next(chunks)
+        self.assertEqual(8, chunker.stats['item_limit'])